@@ -0,0 +1,203 @@
+"""Пропускная способность рассылки на поддельном Bot API.
+
+Запуск: python -m benchmarks.bench_broadcast [--sizes 1000,10000,100000]
+        [--rate 5000] [--latency 0.02] [--rate-limited 0] [--blocked 0.01]
+
+Для каждого размера создает базу с синтетическими пользователями и
+прогоняет /broadcast_all целиком: BroadcastJobRunner ставит рассылку в
+очередь, BroadcastWorker отправляет куски через Broadcaster в поддельный
+API (benchmarks/fake_api.py) и пишет историю в базу.
+
+Отчет: msg/s, p50/p99 задержки sendMessage (вместе с ожиданием лимитов
+и повторами) и время, которое соединение-писатель было занято. Лимит
+rate по умолчанию поднят выше лимита Telegram, чтобы мерить накладные
+расходы бота, а не 30 msg/s.
+
+Результаты дописываются в benchmarks/results/bench_broadcast.jsonl
+(с коммитом и параметрами) — с предыдущим запуском сравнивает --compare.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import time
+from contextlib import asynccontextmanager
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+from benchmarks.fake_api import FAKE_TOKEN, FakeBotAPI
+from bot.database.db import Database
+from bot.services.broadcaster import Broadcaster
+from bot.services.jobs import BroadcastJobRunner, BroadcastWorker
+
+RESULTS_PATH = os.path.join(os.path.dirname(__file__), "results", "bench_broadcast.jsonl")
+SENDER_ID = 1
+
+
+def percentile(samples: list, p: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))] if samples else 0.0
+
+
+class SendTimer(BaseRequestMiddleware):
+    """Время каждого вызова sendMessage, включая повторы внутри aiogram"""
+
+    def __init__(self):
+        self.samples = []
+
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            if method.__api_method__ == "sendMessage":
+                self.samples.append(time.perf_counter() - started)
+
+
+def time_writes(db: Database) -> dict:
+    """Считать, сколько секунд соединение-писатель было занято"""
+    stats = {"seconds": 0.0}
+    write = db.pool.write
+
+    @asynccontextmanager
+    async def timed_write():
+        async with write() as conn:
+            started = time.perf_counter()
+            try:
+                yield conn
+            finally:
+                stats["seconds"] += time.perf_counter() - started
+
+    db.pool.write = timed_write
+    return stats
+
+
+async def bench(size: int, args) -> dict:
+    api = FakeBotAPI(latency=args.latency, rate_limited=args.rate_limited,
+                     retry_after=args.retry_after, blocked=args.blocked)
+    await api.start()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, "broadcast.db"))
+        await db.init_db()
+        async with db.pool.write() as conn:
+            await conn.executemany(
+                "INSERT INTO users (user_id, first_name) VALUES (?, ?)",
+                [(user_id, f"User {user_id}") for user_id in range(1, size + 1)]
+            )
+            await conn.commit()
+        writes = time_writes(db)
+
+        bot = Bot(FAKE_TOKEN, session=api.session())
+        timer = SendTimer()
+        bot.session.middleware(timer)
+        broadcaster = Broadcaster(rate=args.rate, workers=args.workers)
+        worker = BroadcastWorker(db, bot, broadcaster, rate=args.rate, poll_interval=0.05)
+        runner = BroadcastJobRunner(db, worker=worker)
+
+        started = time.perf_counter()
+        worker.start()
+        job_id = await runner.start(SENDER_ID, "Benchmark broadcast", size)
+        while (await db.get_broadcast_job(job_id))['status'] == 'running':
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - started
+
+        job = await db.get_broadcast_job(job_id)
+        await worker.stop()
+        await bot.session.close()
+        await db.close()
+
+    await api.stop()
+    processed = job['successful_sends'] + job['failed_sends']
+    ms = [s * 1000 for s in timer.samples]
+    return {
+        "recipients": size,
+        "successful": job['successful_sends'],
+        "failed": job['failed_sends'],
+        "http_429": api.errors.get(429, 0),
+        "http_403": api.errors.get(403, 0),
+        "seconds": round(elapsed, 3),
+        "msgs_per_sec": round(processed / elapsed, 1),
+        "p50_ms": round(percentile(ms, 0.5), 2),
+        "p99_ms": round(percentile(ms, 0.99), 2),
+        "db_write_seconds": round(writes["seconds"], 3),
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def load_previous(params: dict) -> dict:
+    """Последний сохраненный запуск с теми же параметрами: recipients -> результат"""
+    if not os.path.exists(RESULTS_PATH):
+        return {}
+    previous = {}
+    with open(RESULTS_PATH, encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if record["params"] == params:
+                previous = {r["recipients"]: r for r in record["results"]}
+    return previous
+
+
+def print_row(result: dict, previous: dict = None):
+    line = (f"{result['recipients']:>7} recipients: {result['msgs_per_sec']:8.1f} msg/s   "
+            f"p50 {result['p50_ms']:7.2f} ms   p99 {result['p99_ms']:7.2f} ms   "
+            f"db writes {result['db_write_seconds']:6.2f} s   "
+            f"ok {result['successful']} / failed {result['failed']}")
+    if previous:
+        change = (result['msgs_per_sec'] / previous['msgs_per_sec'] - 1) * 100
+        line += f"   ({change:+.1f}% msg/s vs {previous['commit']})"
+    print(line)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1000,10000,100000")
+    parser.add_argument("--rate", type=float, default=5000, help="лимит msg/s")
+    parser.add_argument("--workers", type=int, default=10, help="параллельных отправок")
+    parser.add_argument("--latency", type=float, default=0.02, help="задержка API, с")
+    parser.add_argument("--rate-limited", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--blocked", type=float, default=0.01, help="доля чатов с 403")
+    parser.add_argument("--compare", action="store_true",
+                        help="сравнить с прошлым запуском с теми же параметрами")
+    parser.add_argument("--no-save", action="store_true", help="не сохранять результаты")
+    args = parser.parse_args()
+    # Каждый 403 логируется воркером — в бенчмарке это шум
+    logging.basicConfig(level=logging.ERROR)
+
+    params = {key: value for key, value in vars(args).items()
+              if key not in ("sizes", "compare", "no_save")}
+    previous = load_previous(params) if args.compare else {}
+    commit = git_commit()
+
+    results = []
+    for size in (int(s) for s in args.sizes.split(",")):
+        result = await bench(size, args)
+        results.append(result)
+        print_row(result, previous.get(size))
+
+    if not args.no_save:
+        os.makedirs(os.path.dirname(RESULTS_PATH), exist_ok=True)
+        with open(RESULTS_PATH, "a", encoding="utf-8") as f:
+            f.write(json.dumps({
+                "commit": commit,
+                "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "params": params,
+                "results": [{**r, "commit": commit} for r in results],
+            }) + "\n")
+        print(f"\nРезультаты дописаны в {os.path.relpath(RESULTS_PATH)}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
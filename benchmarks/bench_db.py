@@ -0,0 +1,334 @@
+"""Время методов Database на синтетических данных разного объема.
+
+Запуск: python -m benchmarks.bench_db [--scales 10k,100k,1m] [--repeat 5]
+        [--save-baseline] [--threshold 0.5] [--plans]
+
+Для каждого масштаба N создает базу с N пользователями, N сообщениями и
+N/100 рассылками, вызывает каждый публичный async-метод Database (медиана
+из --repeat запусков) и через trace callback соединений собирает SQL,
+который метод выполнил, и его EXPLAIN QUERY PLAN.
+
+Результаты сравниваются с benchmarks/results/bench_db_baseline.json:
+если метод стал медленнее базовой линии больше чем на --threshold и
+разница больше шума замера, код возврата 1. Шум — разброс повторов (MAD,
+медиана отклонений от медианы) в базовой линии и сейчас, но не меньше
+MIN_NOISE. --save-baseline перезаписывает базовую линию текущими
+результатами. Метод без сценария в CASES — тоже ошибка, чтобы новые методы
+не выпадали из замеров; методы без базовой линии перечисляются отдельно.
+"""
+import argparse
+import asyncio
+import inspect
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import bot.database.db as db_module
+from benchmarks.query_plans import capture_plans, plan_problems
+from bot.database.db import Database
+from bot.database.migrations import body_hash
+from bot.database.search import MessageSearch
+from bot.database.segments import Segment
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "results", "bench_db_baseline.json")
+# Разница меньше NOISE_SIGMAS разбросов повторов считается шумом,
+# но разброс не меньше MIN_NOISE секунд (таймер, планировщик ОС)
+NOISE_SIGMAS = 3
+MIN_NOISE = 0.00005
+# Не замеряются: жизненный цикл соединений
+SKIP_METHODS = {"init_db", "close"}
+
+# Доля сообщений от пользователя 1 в generate()
+ADMIN_SHARE = 0.9
+
+FIRST_NAMES = ["Алия", "Данияр", "Айгерим", "Тимур", "Мадина", "Арман", "Dana", "Alex", "Sam"]
+
+
+def parse_scale(value: str) -> int:
+    value = value.strip().lower()
+    multiplier = {"k": 1_000, "m": 1_000_000}.get(value[-1], 1)
+    return int(float(value.rstrip("km")) * multiplier)
+
+
+def timestamps(rng: random.Random, days: int = 365):
+    now = datetime(2025, 1, 1)
+    while True:
+        yield (now - timedelta(seconds=rng.randrange(days * 86400))).strftime("%Y-%m-%d %H:%M:%S")
+
+
+async def generate(db: Database, users: int):
+    """Заполнить базу: users пользователей, столько же сообщений, users/100 рассылок.
+
+    Доля ADMIN_SHARE сообщений отправлена пользователем 1, остальные — случайными.
+    """
+    rng = random.Random(42)
+    ts = timestamps(rng)
+
+    user_rows = (
+        (i, f"user{i}" if i % 3 else None, f"{rng.choice(FIRST_NAMES)}{i}", None,
+         0 if i % 20 == 0 else 1, next(ts), next(ts))
+        for i in range(1, users + 1)
+    )
+    # Как в боте: почти все сообщения — рассылки одного админа (user 1)
+    message_rows = (
+        (1 if rng.random() < ADMIN_SHARE else rng.randint(1, users), rng.randint(1, users),
+         body_hash(f"Сообщение {i}"), f"Сообщение {i}", next(ts))
+        for i in range(users)
+    )
+    broadcast_rows = (
+        (rng.randint(1, users), users, users - 10, 10, next(ts))
+        for i in range(max(1, users // 100))
+    )
+
+    async with db.pool.write() as conn:
+        await conn.executemany("""
+            INSERT INTO users (user_id, username, first_name, last_name, is_active,
+                               created_at, last_activity)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, user_rows)
+        await conn.executemany("""
+            INSERT INTO message_log (sender_id, recipient_id, body_hash, message_text,
+                                     created_at)
+            VALUES (?, ?, ?, ?, ?)
+        """, message_rows)
+        await conn.executemany("""
+            INSERT INTO broadcasts (sender_id, body_id, total_recipients,
+                                    successful_sends, failed_sends, created_at)
+            VALUES (?, 1, ?, ?, ?, ?)
+        """, broadcast_rows)
+        await conn.executemany(
+            "INSERT INTO admins (user_id, added_by) VALUES (?, 1)",
+            [(i,) for i in range(2, 12)]
+        )
+        await conn.commit()
+
+
+# Сценарии: метод -> async (db, state, i). state общий для всех методов одного
+# масштаба, i — номер повтора; меняющие данные методы берут разные ID.
+CASES = {
+    "add_user": lambda db, s, i: db.add_user(s["users"] + 1 + i, "new", "New"),
+    "upsert_users": lambda db, s, i: db.upsert_users(
+        [(u, f"user{u}", "Name", None, "2025-01-02 00:00:00") for u in range(1 + i * 100, 101 + i * 100)]),
+    "count_active_users": lambda db, s, i: db.count_active_users(exclude_user_id=1),
+    "get_users_page": lambda db, s, i: db.get_users_page(limit=10, exclude_user_id=1),
+    "get_user_by_id": lambda db, s, i: db.get_user_by_id(s["users"] // 2 + i),
+    "get_users_by_ids": lambda db, s, i: db.get_users_by_ids(range(1 + i * 200, 201 + i * 200)),
+    "add_message": lambda db, s, i: db.add_message(1, 2, "Привет"),
+    "get_recent_messages": lambda db, s, i: db.get_recent_messages(50),
+    "get_messages_page": lambda db, s, i: db.get_messages_page(limit=20, after=s["message_cursor"]),
+    "search_messages": lambda db, s, i: db.search_messages(s["search"], limit=11, offset=i * 10),
+    # Отправитель, которому принадлежит почти вся история
+    "search_messages(from)": lambda db, s, i: db.search_messages(
+        s["admin_search"], limit=11, offset=i * 10),
+    "archive_messages": lambda db, s, i: db.archive_messages(1, batch=500),
+    "incremental_vacuum": lambda db, s, i: db.incremental_vacuum(256),
+    "enable_incremental_vacuum": lambda db, s, i: db.enable_incremental_vacuum(),
+    "get_user_stats": lambda db, s, i: db.get_user_stats(),
+    "rebuild_stats_counters": lambda db, s, i: db.rebuild_stats_counters(),
+    "add_broadcast": lambda db, s, i: db.add_broadcast(1, "Рассылка", s["users"]),
+    "update_broadcast_stats": lambda db, s, i: db.update_broadcast_stats(1, 10, 1),
+    "create_broadcast_job": lambda db, s, i: db.create_broadcast_job(1, "Рассылка", s["users"]),
+    "get_broadcast_job": lambda db, s, i: db.get_broadcast_job(1),
+    "get_unfinished_broadcast_jobs": lambda db, s, i: db.get_unfinished_broadcast_jobs(),
+    "get_active_user_ids_range": lambda db, s, i: db.get_active_user_ids_range(0, 200),
+    "claim_broadcast_chunk": lambda db, s, i: claim(db, s, i),
+    "extend_broadcast_chunk_lease": lambda db, s, i: db.extend_broadcast_chunk_lease(
+        s["chunks"][i]["id"], f"bench-{i}", 60),
+    "count_active_broadcast_workers": lambda db, s, i: db.count_active_broadcast_workers(),
+    "release_broadcast_chunk": lambda db, s, i: db.release_broadcast_chunk(
+        s["chunks"][i]["id"], f"bench-{i}"),
+    "complete_broadcast_chunk": lambda db, s, i: db.complete_broadcast_chunk(
+        s["chunks"][i]["id"], f"bench-{i}", s["chunks"][i]["job_id"], 200, 0),
+    "finish_broadcast_job": lambda db, s, i: db.finish_broadcast_job(1),
+    "count_segment_users": lambda db, s, i: db.count_segment_users(s["segment"]),
+    "iter_active_user_ids": lambda db, s, i: consume(db.iter_active_user_ids()),
+    "save_segment": lambda db, s, i: db.save_segment(f"bench{i}", s["segment"], 1),
+    "get_segment": lambda db, s, i: db.get_segment("bench0"),
+    "get_all_segments": lambda db, s, i: db.get_all_segments(),
+    "delete_segment": lambda db, s, i: db.delete_segment(f"bench{i}"),
+    "deactivate_user": lambda db, s, i: db.deactivate_user(s["users"] // 3 + i),
+    "delete_user": lambda db, s, i: db.delete_user(s["users"] // 4 + i),
+    "add_admin": lambda db, s, i: db.add_admin(100 + i, 1),
+    "remove_admin": lambda db, s, i: db.remove_admin(100 + i),
+    "is_admin": lambda db, s, i: db.is_admin(5),
+    "get_admin_ids": lambda db, s, i: db.get_admin_ids(),
+    "get_all_admins": lambda db, s, i: db.get_all_admins(),
+}
+
+
+async def claim(db: Database, state: dict, i: int):
+    chunk = await db.claim_broadcast_chunk(f"bench-{i}", 60)
+    state["chunks"].append(chunk)
+    return chunk
+
+
+async def consume(iterator) -> int:
+    count = 0
+    async for _ in iterator:
+        count += 1
+    return count
+
+
+async def measure(call, samples: list):
+    """Выполнить call и добавить его время в samples"""
+    started = time.perf_counter()
+    result = await call
+    samples.append(time.perf_counter() - started)
+    return result
+
+
+async def middle_message(db: Database) -> tuple:
+    """Курсор (created_at, id) из середины истории — глубокая страница"""
+    async with db.pool.read() as conn:
+        async with conn.execute("""
+            SELECT created_at, id FROM messages
+            ORDER BY created_at, id
+            LIMIT 1 OFFSET (SELECT COUNT(*) / 2 FROM messages)
+        """) as cursor:
+            return tuple(await cursor.fetchone())
+
+
+async def case_state(db: Database, users: int) -> dict:
+    """Общее состояние сценариев CASES для базы из generate(db, users)"""
+    # Сегмент с фильтрами по всем индексам: активность, дата прихода, переписка
+    segment = Segment(active_days=180, joined_after="2024-03-01", contact=1, role="user")
+    return {"users": users, "chunks": [], "segment": segment,
+            "search": MessageSearch.parse("сообщение 12*"),
+            "admin_search": MessageSearch.parse("сообщение 12* from=1"),
+            "message_cursor": await middle_message(db)}
+
+
+def spread(samples: list) -> float:
+    """Разброс повторов: медиана отклонений от медианы (MAD)"""
+    median = statistics.median(samples)
+    return statistics.median(abs(sample - median) for sample in samples)
+
+
+def baseline_entry(value) -> tuple:
+    """(медиана, разброс) из базовой линии; в старом формате — только медиана"""
+    if isinstance(value, dict):
+        return value["median"], value["spread"]
+    return value, 0.0
+
+
+def is_regression(median: float, noise: float, base: float, base_noise: float,
+                  threshold: float) -> bool:
+    """Медленнее базовой линии больше чем на threshold и больше шума"""
+    floor = max(MIN_NOISE, NOISE_SIGMAS * max(noise, base_noise))
+    return median > base * (1 + threshold) and median - base > floor
+
+
+def public_methods() -> list:
+    return [name for name, _ in inspect.getmembers(Database, inspect.iscoroutinefunction)
+            if not name.startswith("_") and name not in SKIP_METHODS]
+
+
+async def bench_scale(users: int, repeat: int) -> dict:
+    """Медиана времени и планы запросов каждого метода: name -> {...}"""
+    # Кэш статистики спрятал бы сам запрос
+    db_module.STATS_CACHE_TTL = 0
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, "bench.db"))
+        await db.init_db()
+        started = time.perf_counter()
+        await generate(db, users)
+        print(f"  данные сгенерированы за {time.perf_counter() - started:.1f} s")
+
+        state = await case_state(db, users)
+        # Порядок CASES важен: куски сначала берутся, потом продлеваются и закрываются
+        for name, case in CASES.items():
+            samples = []
+            plans = {}
+            for i in range(repeat):
+                run = measure(case(db, state, i), samples)
+                if i == 0:
+                    _, plans = await capture_plans(db, lambda: run)
+                else:
+                    await run
+            results[name] = {"median": statistics.median(samples), "spread": spread(samples),
+                             "plans": plans}
+
+        await db.close()
+    return results
+
+
+def print_plans(results: dict):
+    for name, result in results.items():
+        for sql, plan in result["plans"].items():
+            flag = "!" if plan_problems(plan) else " "
+            print(f"   {flag} {name}: {sql[:110]}")
+            for detail in plan:
+                print(f"          {detail}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scales", default="10k,100k")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--threshold", type=float, default=0.5,
+                        help="допустимое замедление относительно базовой линии (0.5 = +50%%)")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--plans", action="store_true", help="печатать планы запросов")
+    args = parser.parse_args()
+
+    missing = sorted(set(public_methods()) - set(CASES))
+    if missing:
+        print(f"Нет сценария для методов: {', '.join(missing)}")
+        sys.exit(1)
+
+    baseline = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    regressions = []
+    unknown = []
+    current = {}
+    for scale in args.scales.split(","):
+        users = parse_scale(scale)
+        print(f"\n== {scale}: {users} пользователей и сообщений ==")
+        results = await bench_scale(users, args.repeat)
+        current[scale] = {name: {"median": round(r["median"], 6), "spread": round(r["spread"], 6)}
+                          for name, r in results.items()}
+
+        for name, result in results.items():
+            median = result["median"]
+            line = f"  {name:<32} {median * 1000:10.2f} ms ±{result['spread'] * 1000:.2f}"
+            if name in baseline.get(scale, {}):
+                base, base_spread = baseline_entry(baseline[scale][name])
+                line += f"   {(median / base - 1) * 100:+7.1f}%"
+                if is_regression(median, result["spread"], base, base_spread, args.threshold):
+                    line += "   РЕГРЕССИЯ"
+                    regressions.append(f"{scale} {name}")
+            else:
+                line += "   (нет базовой линии)"
+                unknown.append(f"{scale} {name}")
+            if any(plan_problems(plan) for plan in result["plans"].values()):
+                line += "   (полный проход)"
+            print(line)
+        if args.plans:
+            print_plans(results)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(BASELINE_PATH), exist_ok=True)
+        baseline.update(current)
+        with open(BASELINE_PATH, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"\nБазовая линия сохранена в {os.path.relpath(BASELINE_PATH)}")
+
+    if unknown and not args.save_baseline:
+        print(f"\nНет в базовой линии (сохраните --save-baseline): {', '.join(unknown)}")
+    if regressions:
+        print(f"\nРегрессии: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
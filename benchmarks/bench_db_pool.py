@@ -0,0 +1,80 @@
+"""Сравнение пула соединений с подключением на каждый запрос.
+
+Запуск: python -m benchmarks.bench_db_pool [итераций] [параллельность]
+
+Нагрузка повторяет /start: add_user и два is_admin на одно обновление.
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import aiosqlite
+
+from bot.database.db import Database
+
+
+async def legacy_start(db_path: str, user_id: int):
+    """Старое поведение: новое соединение на каждый запрос"""
+    async with aiosqlite.connect(db_path) as db:
+        await db.execute("""
+            INSERT INTO users (user_id, username, first_name, last_name, last_activity)
+            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(user_id) DO UPDATE SET
+                username = excluded.username,
+                first_name = excluded.first_name,
+                last_name = excluded.last_name,
+                last_activity = CURRENT_TIMESTAMP
+        """, (user_id, f"user{user_id}", "Test", None))
+        await db.commit()
+    for _ in range(2):
+        async with aiosqlite.connect(db_path) as db:
+            async with db.execute("SELECT 1 FROM admins WHERE user_id = ?", (user_id,)) as cursor:
+                await cursor.fetchone()
+
+
+async def pooled_start(db: Database, user_id: int):
+    """Новое поведение: долгоживущие соединения из пула"""
+    await db.add_user(user_id, f"user{user_id}", "Test")
+    await db.is_admin(user_id)
+    await db.is_admin(user_id)
+
+
+async def run(label: str, func, iterations: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        async with semaphore:
+            await func(i % 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(iterations)))
+    elapsed = time.perf_counter() - started
+    # Одно обновление /start = 3 запроса
+    qps = iterations * 3 / elapsed
+    print(f"{label:<20} {elapsed:8.2f} s  {qps:10.0f} queries/s")
+    return qps
+
+
+async def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bench.db")
+        db = Database(db_path)
+        await db.init_db()
+
+        print(f"{iterations} x /start, параллельность {concurrency}")
+        legacy = await run("connect-per-call", lambda uid: legacy_start(db_path, uid),
+                           iterations, concurrency)
+        pooled = await run("pool", lambda uid: pooled_start(db, uid),
+                           iterations, concurrency)
+        print(f"Ускорение: x{pooled / legacy:.1f}")
+
+        await db.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
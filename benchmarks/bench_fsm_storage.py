@@ -0,0 +1,85 @@
+"""Задержка FSM-хранилища: SQLiteStorage против MemoryStorage.
+
+Запуск: python -m benchmarks.bench_fsm_storage [операций] [пользователей]
+
+Меряет get_state и update_data (типичный шаг выбора получателей) и
+отдельно время сброса накопленных изменений в базу.
+"""
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from bot.database.db import Database
+from bot.database.fsm_storage import SQLiteStorage
+
+
+def percentile(samples: list, p: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def report(label: str, samples: list):
+    us = [s * 1e6 for s in samples]
+    print(f"{label:<28} p50 {percentile(us, 0.5):8.1f} us   "
+          f"p99 {percentile(us, 0.99):8.1f} us   mean {statistics.mean(us):8.1f} us")
+
+
+async def bench(label: str, storage, operations: int, users: int):
+    keys = [StorageKey(bot_id=1, chat_id=i, user_id=i) for i in range(users)]
+    for key in keys:
+        await storage.set_state(key, "MessageStates:selecting_recipients")
+        await storage.set_data(key, {'selected_users': [], 'picker_query': None})
+    if isinstance(storage, SQLiteStorage):
+        await storage.flush()
+
+    get_state, update_data = [], []
+    for i in range(operations):
+        key = keys[i % users]
+
+        started = time.perf_counter()
+        await storage.get_state(key)
+        get_state.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await storage.update_data(key, {'selected_users': list(range(i % 30))})
+        update_data.append(time.perf_counter() - started)
+
+        # Периодически сбрасываем, чтобы часть чтений шла из базы
+        if isinstance(storage, SQLiteStorage) and i % 100 == 99:
+            await storage.flush()
+
+    report(f"{label} get_state", get_state)
+    report(f"{label} update_data", update_data)
+
+
+async def main():
+    operations = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    await bench("memory", MemoryStorage(), operations, users)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, "fsm.db"))
+        await db.init_db()
+        storage = SQLiteStorage(db)
+        await bench("sqlite", storage, operations, users)
+
+        # Стоимость пачки: users изменений одним сбросом
+        for i in range(users):
+            await storage.set_data(StorageKey(bot_id=1, chat_id=i, user_id=i), {'n': i})
+        started = time.perf_counter()
+        await storage.flush()
+        print(f"flush of {users} keys: {(time.perf_counter() - started) * 1000:.1f} ms")
+
+        await storage.close()
+        await db.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
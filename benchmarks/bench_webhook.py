@@ -0,0 +1,156 @@
+"""Задержка доставки апдейтов: long polling против вебхука.
+
+Запуск: python -m benchmarks.bench_webhook [апдейтов] [задержка хэндлера, мс]
+
+Бот работает против поддельного Bot API (benchmarks/fake_api.py) и на
+каждое сообщение отвечает эхом. Задержка — время от появления апдейта
+(push в очередь getUpdates или POST на вебхук) до прихода sendMessage.
+Два сценария: апдейты по одному с паузой и пачкой все сразу.
+"""
+import asyncio
+import statistics
+import sys
+import time
+
+from aiohttp import ClientSession, web
+from aiogram import Bot, Dispatcher, F, Router
+from aiogram.types import Message
+
+from benchmarks.fake_api import FAKE_TOKEN, FakeBotAPI, make_text_update
+from bot.webhook import build_webhook_app
+
+SECRET = "bench-secret"
+WEBHOOK_PATH = "/webhook"
+
+
+def percentile(samples: list, p: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def echo_dispatcher(handler_delay: float) -> Dispatcher:
+    router = Router()
+
+    @router.message(F.text)
+    async def echo(message: Message):
+        # Имитация работы хэндлера (запросы в базу и т.п.)
+        await asyncio.sleep(handler_delay)
+        await message.answer(message.text)
+
+    dp = Dispatcher()
+    dp.include_router(router)
+    return dp
+
+
+async def wait_sent(api: FakeBotAPI, count: int, timeout: float = 60):
+    deadline = time.perf_counter() + timeout
+    while len(api.sent) < count:
+        if time.perf_counter() > deadline:
+            raise TimeoutError(f"Получено {len(api.sent)} ответов из {count}")
+        await asyncio.sleep(0.001)
+
+
+async def deliver(api: FakeBotAPI, push, updates: int, interval: float) -> list:
+    """Отправить апдейты через push и вернуть задержки до ответа"""
+    api.sent.clear()
+    pushed = {}
+    for i in range(updates):
+        text = f"msg-{i}"
+        pushed[text] = time.perf_counter()
+        await push(make_text_update(i + 1, 1000 + i, text))
+        if interval:
+            await asyncio.sleep(interval)
+    await wait_sent(api, updates)
+    return [sent_at - pushed[params["text"]] for sent_at, params in api.sent]
+
+
+def report(label: str, latencies: list, elapsed: float = None):
+    ms = [s * 1000 for s in latencies]
+    line = (f"{label:<22} p50 {percentile(ms, 0.5):7.2f} ms   "
+            f"p99 {percentile(ms, 0.99):7.2f} ms   mean {statistics.mean(ms):7.2f} ms")
+    if elapsed is not None:
+        line += f"   {len(ms) / elapsed:8.0f} upd/s"
+    print(line)
+
+
+async def bench_polling(updates: int, handler_delay: float):
+    api = FakeBotAPI()
+    await api.start()
+    bot = Bot(FAKE_TOKEN, session=api.session())
+    dp = echo_dispatcher(handler_delay)
+    polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False))
+    await asyncio.sleep(0.2)
+
+    report("polling sequential", await deliver(api, api.push_update, updates, 0.005))
+
+    api.updates.clear()
+    offset = updates
+    started = time.perf_counter()
+
+    async def push_burst(update):
+        update["update_id"] += offset
+        await api.push_update(update)
+
+    latencies = await deliver(api, push_burst, updates, 0)
+    report("polling burst", latencies, time.perf_counter() - started)
+
+    await dp.stop_polling()
+    await polling
+    await bot.session.close()
+    await api.stop()
+
+
+async def bench_webhook(updates: int, handler_delay: float):
+    api = FakeBotAPI()
+    await api.start()
+    bot = Bot(FAKE_TOKEN, session=api.session())
+    dp = echo_dispatcher(handler_delay)
+
+    app = build_webhook_app(dp, bot, WEBHOOK_PATH, secret_token=SECRET)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    url = f"http://127.0.0.1:{port}{WEBHOOK_PATH}"
+
+    async with ClientSession() as client:
+        # Запрос без секрета должен отклоняться
+        async with client.post(url, json=make_text_update(0, 1, "x")) as resp:
+            print(f"webhook without secret: HTTP {resp.status}")
+
+        headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET}
+
+        async def post(update):
+            async with client.post(url, json=update, headers=headers) as resp:
+                resp.raise_for_status()
+
+        report("webhook sequential", await deliver(api, post, updates, 0.005))
+
+        started = time.perf_counter()
+        pending = []
+
+        async def post_burst(update):
+            # Telegram шлет апдейты параллельно (до max_connections запросов)
+            pending.append(asyncio.create_task(post(update)))
+
+        latencies = await deliver(api, post_burst, updates, 0)
+        await asyncio.gather(*pending)
+        report("webhook burst", latencies, time.perf_counter() - started)
+
+    await runner.cleanup()
+    await bot.session.close()
+    await api.stop()
+
+
+async def main():
+    updates = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    handler_delay = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.0
+
+    print(f"{updates} updates, handler delay {handler_delay * 1000:.0f} ms\n")
+    await bench_polling(updates, handler_delay)
+    await bench_webhook(updates, handler_delay)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,128 @@
+"""Пропускная способность рассылки в зависимости от числа процессов-воркеров.
+
+Запуск: python -m benchmarks.bench_workers [получателей] [лимит msg/s]
+
+Для 1, 2 и 4 процессов BroadcastWorker рассылает одну рассылку через
+поддельный Bot API с задержкой ответа 200 мс. Каждый процесс держит
+ограниченное число параллельных отправок, поэтому один воркер упирается
+в сеть, а несколько вместе — в общий лимит бота, который они делят.
+Задержка выбрана большой, чтобы на машине с одним ядром упираться в сеть,
+а не в CPU поддельного API.
+
+Кроме средней скорости печатается пик за любую секунду (он не должен
+заметно превышать общий лимит) и сколько кусков взял каждый воркер.
+"""
+import asyncio
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+from aiogram import Bot
+
+from benchmarks.fake_api import FAKE_TOKEN, FakeBotAPI
+from bot.database.db import Database
+from bot.services.broadcaster import Broadcaster
+from bot.services.jobs import BroadcastJobRunner, BroadcastWorker
+
+LATENCY = 0.2
+CONCURRENCY = 5   # параллельных отправок на процесс: ~25 msg/s на воркер
+
+
+async def worker_main(db_path: str, api_url: str, rate: float, job_id: int, ready):
+    db = Database(db_path)
+    await db.init_db()
+    bot = Bot(FAKE_TOKEN, session=FakeBotAPI.session_for(api_url))
+    worker = BroadcastWorker(db, bot, Broadcaster(rate=rate, workers=CONCURRENCY),
+                             rate=rate, lease=10, poll_interval=0.05)
+    worker.start()
+    ready.set()
+    while (await db.get_broadcast_job(job_id)) is None:
+        await asyncio.sleep(0.05)
+    while (await db.get_broadcast_job(job_id))['status'] == 'running':
+        await asyncio.sleep(0.05)
+    await worker.stop()
+    await bot.session.close()
+    await db.close()
+
+
+def run_worker(*args):
+    asyncio.run(worker_main(*args))
+
+
+async def bench(processes: int, recipients: int, rate: float):
+    api = FakeBotAPI(latency=LATENCY)
+    await api.start()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "workers.db")
+        db = Database(db_path)
+        await db.init_db()
+        async with db.pool.write() as conn:
+            await conn.executemany(
+                "INSERT INTO users (user_id, first_name) VALUES (?, ?)",
+                [(i, f"User {i}") for i in range(1, recipients + 1)]
+            )
+            await conn.commit()
+
+        # Процессы стартуют до постановки рассылки, чтобы не мерить их запуск
+        job_id = 1
+        ctx = multiprocessing.get_context("spawn")
+        ready = [ctx.Event() for _ in range(processes)]
+        workers = [
+            ctx.Process(target=run_worker, args=(db_path, api.base_url, rate, job_id, event))
+            for event in ready
+        ]
+        for process in workers:
+            process.start()
+        loop = asyncio.get_running_loop()
+        for event in ready:
+            await loop.run_in_executor(None, event.wait)
+
+        started = time.perf_counter()
+        assert await BroadcastJobRunner(db).start(1, "bench", recipients) == job_id
+        while (await db.get_broadcast_job(job_id))['status'] == 'running':
+            await asyncio.sleep(0.02)
+        elapsed = time.perf_counter() - started
+
+        for process in workers:
+            await loop.run_in_executor(None, process.join)
+        job = await db.get_broadcast_job(job_id)
+        async with db.pool.read() as conn:
+            async with conn.execute("""
+                SELECT COUNT(*) FROM broadcast_chunks WHERE job_id = ? GROUP BY worker_id
+            """, (job_id,)) as cursor:
+                chunks = sorted((row[0] for row in await cursor.fetchall()), reverse=True)
+        await db.close()
+
+    await api.stop()
+    print(f"{processes} worker(s): {job['successful_sends']:6} sent in {elapsed:6.2f} s "
+          f"= {job['successful_sends'] / elapsed:7.1f} msg/s, "
+          f"peak {peak_rate([sent for sent, _ in api.sent]):5.1f} msg/s, "
+          f"chunks per worker {chunks}")
+
+
+def peak_rate(times: list, window: float = 1.0) -> float:
+    """Наибольшее число отправок за любое окно window секунд, в msg/s"""
+    times = sorted(times)
+    peak = start = 0
+    for end, moment in enumerate(times):
+        while moment - times[start] > window:
+            start += 1
+        peak = max(peak, end - start + 1)
+    return peak / window
+
+
+async def main():
+    recipients = int(sys.argv[1]) if len(sys.argv) > 1 else 800
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 60
+
+    print(f"{recipients} recipients, API latency {LATENCY * 1000:.0f} ms, "
+          f"shared limit {rate:.0f} msg/s\n")
+    for processes in (1, 2, 4):
+        await bench(processes, recipients, rate)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,173 @@
+"""Поддельный Bot API для бенчмарков: aiohttp-сервер на localhost.
+
+Отвечает на методы, которые использует бот (getMe, getUpdates,
+sendMessage, setWebhook, deleteWebhook), остальные просто возвращают True.
+Апдейты для long polling подкладываются через push_update, а время
+каждого успешного sendMessage записывается в sent. latency — задержка
+ответа на sendMessage в секундах (имитация сети до api.telegram.org).
+
+Ошибки Telegram: rate_limited — доля sendMessage, получающих 429 с
+retry_after секунд; blocked — доля чатов, заблокировавших бота (403,
+постоянно для одного и того же chat_id).
+
+    api = FakeBotAPI()
+    await api.start()
+    bot = Bot(FAKE_TOKEN, session=api.session())
+"""
+import asyncio
+import itertools
+import random
+import time
+import zlib
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+FAKE_TOKEN = "123456:TEST-fake-token"
+
+
+def make_text_update(update_id: int, user_id: int, text: str) -> Dict[str, Any]:
+    """Апдейт с текстовым сообщением, как его присылает Telegram"""
+    user = {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": user["first_name"]},
+            "from": user,
+            "text": text,
+        },
+    }
+
+
+class TelegramError(Exception):
+    """Ответ Bot API с ошибкой"""
+
+    def __init__(self, code: int, description: str, retry_after: int = None):
+        super().__init__(description)
+        self.code = code
+        self.payload = {"ok": False, "error_code": code, "description": description}
+        if retry_after is not None:
+            self.payload["parameters"] = {"retry_after": retry_after}
+
+
+class FakeBotAPI:
+    """Минимальная замена api.telegram.org"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0,
+                 rate_limited: float = 0.0, retry_after: int = 1, blocked: float = 0.0,
+                 seed: int = 0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.rate_limited = rate_limited
+        self.retry_after = retry_after
+        self.blocked = blocked
+        self._random = random.Random(seed)
+        self.updates: List[Dict[str, Any]] = []
+        self._new_updates = asyncio.Condition()
+        self._message_ids = itertools.count(1)
+        # (время прихода, параметры запроса) каждого sendMessage
+        self.sent: List[tuple] = []
+        self.calls: Dict[str, int] = {}
+        self.errors: Dict[int, int] = {}
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def session(self) -> AiohttpSession:
+        """Сессия aiogram, отправляющая запросы в этот сервер"""
+        return self.session_for(self.base_url)
+
+    @staticmethod
+    def session_for(base_url: str) -> AiohttpSession:
+        """Сессия для сервера, запущенного в другом процессе"""
+        return AiohttpSession(api=TelegramAPIServer.from_base(base_url))
+
+    async def push_update(self, update: Dict[str, Any]):
+        """Положить апдейт в очередь getUpdates"""
+        async with self._new_updates:
+            self.updates.append(update)
+            self._new_updates.notify_all()
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        # Порт 0 — берем тот, что выдала система
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+        handler = getattr(self, f"_{method}", None)
+        try:
+            result = await handler(params) if handler else True
+        except TelegramError as e:
+            self.errors[e.code] = self.errors.get(e.code, 0) + 1
+            return web.json_response(e.payload, status=e.code)
+        return web.json_response({"ok": True, "result": result})
+
+    def is_blocked(self, chat_id: int) -> bool:
+        """Заблокировал ли чат бота (детерминированно по chat_id)"""
+        return zlib.crc32(str(chat_id).encode()) % 10000 < self.blocked * 10000
+
+    async def _getMe(self, params: dict):
+        return {"id": 123456, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+
+    async def _getUpdates(self, params: dict):
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+
+        def pending():
+            return [u for u in self.updates if u["update_id"] >= offset]
+
+        async with self._new_updates:
+            # Подтвержденные апдейты больше не нужны
+            self.updates = pending()
+            if not self.updates and timeout:
+                try:
+                    await asyncio.wait_for(self._new_updates.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return pending()
+
+    async def _sendMessage(self, params: dict):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        chat_id = int(params["chat_id"])
+        if self.rate_limited and self._random.random() < self.rate_limited:
+            raise TelegramError(429, f"Too Many Requests: retry after {self.retry_after}",
+                                retry_after=self.retry_after)
+        if self.blocked and self.is_blocked(chat_id):
+            raise TelegramError(403, "Forbidden: bot was blocked by the user")
+
+        self.sent.append((time.perf_counter(), params))
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": params.get("text", ""),
+        }
+
+    async def _setWebhook(self, params: dict):
+        return True
+
+    async def _deleteWebhook(self, params: dict):
+        return True
+
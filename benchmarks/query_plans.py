@@ -0,0 +1,79 @@
+"""Планы запросов, которые выполняют методы Database.
+
+Запросы не переписываются сюда руками: вызов метода выполняется с trace
+callback на всех соединениях пула, и каждый выполненный им SQL проверяется
+через EXPLAIN QUERY PLAN. Используется в bench_db (--plans) и в
+tests/test_query_plans.py.
+"""
+import re
+import sqlite3
+
+from bot.database.db import Database
+
+# Литералы в SQL из trace callback: запросы, отличающиеся только ими, — один запрос
+LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+VIRTUAL_TABLE_LOOKUP = re.compile(r"VIRTUAL TABLE INDEX \d+:\S")
+
+CONSTANT_ROWS = re.compile(r"SCAN (\d+ )?CONSTANT ROWS?$")
+
+PLANNED = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+# Префикс плана, который нельзя получить на другом соединении
+NO_PLAN = "нет плана"
+
+
+def plan_problems(plan: list) -> list:
+    """Найти в плане полные проходы и сортировки без индекса"""
+    # Результаты подзапросов и CTE: MATERIALIZE page, CO-ROUTINE found
+    subqueries = {detail.split(" ", 1)[1] for detail in plan
+                  if detail.startswith(("MATERIALIZE ", "CO-ROUTINE "))}
+    problems = []
+    for detail in plan:
+        # SCAN (subquery-N) и SCAN <имя CTE> — обход результата подзапроса,
+        # SCAN [N] CONSTANT ROW(S) — SELECT без FROM или VALUES,
+        # VIRTUAL TABLE INDEX N:<ограничения> — поиск в FTS5 (MATCH или
+        # rowid); это не проходы по таблице
+        if detail.startswith("SCAN") and "USING" not in detail \
+                and not detail.startswith("SCAN (subquery-") \
+                and detail[len("SCAN "):] not in subqueries \
+                and not CONSTANT_ROWS.match(detail) \
+                and not VIRTUAL_TABLE_LOOKUP.search(detail):
+            problems.append(detail)
+        elif "TEMP B-TREE" in detail:
+            problems.append(detail)
+    return problems
+
+
+async def explain(db: Database, sql: str, params: tuple = ()) -> list:
+    async with db.pool.read() as conn:
+        async with conn.execute("EXPLAIN QUERY PLAN " + sql, params) as cursor:
+            return [row[3] for row in await cursor.fetchall()]
+
+
+async def capture_plans(db: Database, call) -> tuple:
+    """Выполнить await call() и собрать планы его SQL: (результат, {запрос: план}).
+
+    Запрос — SQL без литералов. Временные таблицы и подключенный архив есть
+    только у соединения, которое их создало; для таких запросов план —
+    одна строка, начинающаяся с NO_PLAN.
+    """
+    statements = []
+    await db.pool.set_trace_callback(statements.append)
+    try:
+        result = await call()
+        # Запись из очереди отложенных записей — тоже часть метода
+        await db.writes.flush()
+    finally:
+        await db.pool.set_trace_callback(None)
+
+    plans = {}
+    for sql in statements:
+        shape = " ".join(LITERAL.sub("?", sql).split())
+        if shape in plans or shape.split(" ", 1)[0].upper() not in PLANNED:
+            continue
+        try:
+            plans[shape] = await explain(db, sql)
+        except sqlite3.OperationalError as e:
+            plans[shape] = [f"{NO_PLAN}: {e}"]
+    return result, plans
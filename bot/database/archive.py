@@ -0,0 +1,76 @@
+import os
+import re
+from contextlib import asynccontextmanager
+from typing import List
+
+import aiosqlite
+
+# Схема файла архива: те же messages и message_bodies, что в основной базе.
+# Тексты у каждого файла свои, body_id ссылается на message_bodies этого файла.
+ARCHIVE_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS archive.message_bodies (
+        id INTEGER PRIMARY KEY,
+        hash BLOB NOT NULL UNIQUE,
+        body TEXT NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS archive.messages (
+        id INTEGER PRIMARY KEY,
+        sender_id INTEGER,
+        recipient_id INTEGER,
+        body_id INTEGER,
+        created_at TIMESTAMP
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS archive.idx_messages_created_at ON messages(created_at)",
+    "CREATE INDEX IF NOT EXISTS archive.idx_messages_sender_recipient ON messages(sender_id, recipient_id)",
+    "CREATE INDEX IF NOT EXISTS archive.idx_messages_recipient_sender ON messages(recipient_id, sender_id)",
+    "CREATE INDEX IF NOT EXISTS archive.idx_messages_body ON messages(body_id)",
+)
+
+ARCHIVE_FILE = re.compile(r"^messages-(\d{4}-\d{2})\.db$")
+
+
+class MessageArchive:
+    """Архив истории сообщений: по файлу SQLite на месяц.
+
+    Файл <directory>/messages-ГГГГ-ММ.db подключается к соединению основной
+    базы (ATTACH ... AS archive) только на время запроса, поэтому число
+    месяцев не влияет ни на открытые файлы, ни на обычные запросы бота.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def path(self, month: str) -> str:
+        return os.path.join(self.directory, f"messages-{month}.db")
+
+    def months(self) -> List[str]:
+        """Месяцы, за которые есть архив ('ГГГГ-ММ'), от старых к новым"""
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(match.group(1) for match in map(ARCHIVE_FILE.match, os.listdir(self.directory))
+                      if match)
+
+    @asynccontextmanager
+    async def attach(self, db: aiosqlite.Connection, month: str, create: bool = False):
+        """Подключить архив месяца как схему archive (create — создать файл и таблицы).
+
+        ATTACH и DETACH нельзя выполнять внутри транзакции: вызывающий
+        должен завершить свою до входа и до выхода.
+        """
+        if create:
+            os.makedirs(self.directory, exist_ok=True)
+        await db.execute("ATTACH DATABASE ? AS archive", (self.path(month),))
+        try:
+            if create:
+                for statement in ARCHIVE_SCHEMA:
+                    await db.execute(statement)
+                await db.commit()
+            yield db
+        finally:
+            if db.in_transaction:
+                await db.rollback()
+            await db.execute("DETACH DATABASE archive")
@@ -1,71 +1,190 @@
-import aiosqlite
-from typing import List, Optional
+import asyncio
+import logging
+import os
+import time
+from typing import AsyncIterator, Callable, Dict, List, Optional, Set, Tuple
+
+from bot.database.archive import MessageArchive
+from bot.database.migrations import (
+    BROADCAST_CHUNK_SIZE, STATS_REBUILD_SQL, apply_migrations, body_hash,
+    insert_broadcast_chunks
+)
+from bot.database.pool import ConnectionPool
+from bot.database.search import MessageSearch
+from bot.database.segments import Segment
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд отдавать статистику из кэша
+STATS_CACHE_TTL = 5
+
+# Начало и конец найденного слова в snippet из search_messages
+SNIPPET_MARKS = ("\x02", "\x03")
+
+
+class WriteBehindQueue:
+    """Отложенная запись: копит вставки и обновления и пишет их пачкой.
+
+    Сброс происходит каждые max_rows записей или max_delay секунд, одной
+    транзакцией через executemany, чтобы fsync не стоял на пути каждой отправки.
+    Если запись не удалась, пачка возвращается в начало очереди и
+    повторяется через retry_delay секунд; после max_attempts неудачных
+    попыток подряд она выбрасывается с ошибкой в логе.
+    """
+
+    def __init__(self, pool: ConnectionPool, max_rows: int = 500, max_delay: float = 0.2,
+                 max_attempts: int = 5, retry_delay: float = 1.0):
+        self.pool = pool
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._pending: List[Tuple[str, tuple]] = []
+        self._failures = 0
+        self._has_data = asyncio.Event()
+        self._full = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def put(self, sql: str, params: tuple):
+        """Поставить запрос в очередь на запись"""
+        self._pending.append((sql, params))
+        self._has_data.set()
+        if len(self._pending) >= self.max_rows:
+            self._full.set()
+
+    async def flush(self):
+        """Записать все накопленное одной транзакцией.
+
+        Ошибка записи пробрасывается вызывающему: после возврата без
+        исключения все, что было в очереди до вызова, уже в базе.
+        """
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, []
+            self._has_data.clear()
+            self._full.clear()
+
+            # Соседние одинаковые запросы объединяем в executemany, порядок сохраняется
+            groups: List[Tuple[str, List[tuple]]] = []
+            for sql, params in pending:
+                if groups and groups[-1][0] == sql:
+                    groups[-1][1].append(params)
+                else:
+                    groups.append((sql, [params]))
+
+            try:
+                async with self.pool.write() as db:
+                    for sql, rows in groups:
+                        await db.executemany(sql, rows)
+                    await db.commit()
+            except Exception:
+                self._failures += 1
+                if self._failures >= self.max_attempts:
+                    logger.exception("Отложенные строки потеряны после %s попыток: %s",
+                                     self._failures, len(pending))
+                    self._failures = 0
+                else:
+                    logger.warning("Не удалось записать %s отложенных строк (попытка %s из %s)",
+                                   len(pending), self._failures, self.max_attempts,
+                                   exc_info=True)
+                    # Вперед того, что пришло во время записи, чтобы не нарушить порядок
+                    self._pending = pending + self._pending
+                    self._has_data.set()
+                raise
+            self._failures = 0
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановить фоновый сброс и дописать остаток (с повторами)"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        while self._pending:
+            try:
+                await self.flush()
+            except Exception:
+                await asyncio.sleep(self.retry_delay)
+
+    async def _run(self):
+        while True:
+            await self._has_data.wait()
+            try:
+                await asyncio.wait_for(self._full.wait(), self.max_delay)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception:
+                await asyncio.sleep(self.retry_delay)
 
 
 class Database:
-    def __init__(self, db_path: str = "data/bot.db"):
+    def __init__(self, db_path: str = "data/bot.db", pool_size: int = 4):
         self.db_path = db_path
+        self.pool = ConnectionPool(db_path, readers=pool_size)
+        self.writes = WriteBehindQueue(self.pool)
+        # Месячные файлы старой истории сообщений рядом с базой
+        self.archive = MessageArchive(os.path.join(os.path.dirname(db_path), "archive"))
+        self._admin_listeners: List[Callable[[int, bool], None]] = []
+        self._stats_cache: Optional[dict] = None
+        self._stats_cached_at = 0.0
+
+    def on_admins_changed(self, callback: Callable[[int, bool], None]):
+        """Подписаться на изменения списка админов: callback(user_id, is_admin)"""
+        if callback not in self._admin_listeners:
+            self._admin_listeners.append(callback)
+
+    def _notify_admins_changed(self, user_id: int, is_admin: bool):
+        for callback in self._admin_listeners:
+            callback(user_id, is_admin)
 
     async def init_db(self):
         """Инициализация базы данных"""
-        async with aiosqlite.connect(self.db_path) as db:
-            # Таблица всех пользователей бота (общедоступная)
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    first_name TEXT,
-                    last_name TEXT,
-                    is_active INTEGER DEFAULT 1,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        await self.pool.open()
+        await self.writes.start()
+        async with self.pool.write() as db:
+            await apply_migrations(db)
+            if not await self._incremental_vacuum_enabled(db):
+                logger.warning(
+                    "incremental vacuum выключен: место после архивации не вернется. "
+                    "Остановите бота и выполните python -m bot.maintenance vacuum"
                 )
-            """)
 
-            # История сообщений
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS messages (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    sender_id INTEGER NOT NULL,
-                    recipient_id INTEGER NOT NULL,
-                    message_text TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (sender_id) REFERENCES users(user_id),
-                    FOREIGN KEY (recipient_id) REFERENCES users(user_id)
-                )
-            """)
+    @staticmethod
+    async def _incremental_vacuum_enabled(db) -> bool:
+        async with db.execute("PRAGMA auto_vacuum") as cursor:
+            return (await cursor.fetchone())[0] == 2
 
-            # История рассылок
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS broadcasts (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    sender_id INTEGER NOT NULL,
-                    message_text TEXT NOT NULL,
-                    total_recipients INTEGER NOT NULL,
-                    successful_sends INTEGER DEFAULT 0,
-                    failed_sends INTEGER DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (sender_id) REFERENCES users(user_id)
-                )
-            """)
+    async def enable_incremental_vacuum(self) -> bool:
+        """Перевести существующую базу на auto_vacuum = INCREMENTAL (см. incremental_vacuum).
 
-            # Таблица админов
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS admins (
-                    user_id INTEGER PRIMARY KEY,
-                    added_by INTEGER NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id),
-                    FOREIGN KEY (added_by) REFERENCES users(user_id)
-                )
-            """)
+        Нужен один полный VACUUM: он переписывает весь файл и держит базу
+        заблокированной, поэтому выполняется отдельной командой
+        (python -m bot.maintenance vacuum) при остановленном боте.
+        Возвращает False, если режим уже включен.
+        """
+        async with self.pool.write() as db:
+            if await self._incremental_vacuum_enabled(db):
+                return False
+            await db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            await db.execute("VACUUM")
+            return True
 
-            await db.commit()
+    async def close(self):
+        """Дописать отложенные записи и закрыть соединения с базой данных"""
+        await self.writes.stop()
+        await self.pool.close()
 
     async def add_user(self, user_id: int, username: str = None,
                       first_name: str = None, last_name: str = None):
         """Добавить или обновить пользователя"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.write() as db:
             await db.execute("""
                 INSERT INTO users (user_id, username, first_name, last_name, last_activity)
                 VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
@@ -77,102 +196,465 @@ class Database:
             """, (user_id, username, first_name, last_name))
             await db.commit()
 
-    async def get_all_users(self, exclude_user_id: int = None) -> List[dict]:
-        """Получить список всех активных пользователей бота"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            if exclude_user_id:
-                async with db.execute("""
-                    SELECT * FROM users
-                    WHERE is_active = 1 AND user_id != ?
-                    ORDER BY last_activity DESC
-                """, (exclude_user_id,)) as cursor:
-                    rows = await cursor.fetchall()
-            else:
-                async with db.execute("""
-                    SELECT * FROM users
-                    WHERE is_active = 1
-                    ORDER BY last_activity DESC
-                """) as cursor:
-                    rows = await cursor.fetchall()
-            return [dict(row) for row in rows]
+    async def upsert_users(self, users: List[Tuple]):
+        """Добавить или обновить пачку пользователей одной транзакцией.
+
+        users — кортежи (user_id, username, first_name, last_name, last_activity)
+        """
+        if not users:
+            return
+        async with self.pool.write() as db:
+            await db.executemany("""
+                INSERT INTO users (user_id, username, first_name, last_name, last_activity)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    username = excluded.username,
+                    first_name = excluded.first_name,
+                    last_name = excluded.last_name,
+                    last_activity = excluded.last_activity
+            """, users)
+            await db.commit()
+
+    async def count_active_users(self, exclude_user_id: int = None) -> int:
+        """Число активных пользователей — из счетчика stats_counters, O(1).
+
+        exclude_user_id — не считать этого пользователя (если он активен).
+        """
+        async with self.pool.read() as db:
+            async with db.execute("""
+                SELECT (SELECT value FROM stats_counters WHERE name = 'total_users')
+                     - COALESCE((SELECT is_active = 1 FROM users WHERE user_id = ?), 0)
+            """, (exclude_user_id,)) as cursor:
+                return (await cursor.fetchone())[0] or 0
+
+    def iter_active_user_ids(self, chunk_size: int = 5000) -> AsyncIterator[int]:
+        """ID всех активных пользователей по возрастанию, без списка в памяти.
+
+        Использование: async for user_id in db.iter_active_user_ids(): ...
+        """
+        return self._iter_user_ids("1", [], chunk_size)
+
+    async def _iter_user_ids(self, where: str, params: list,
+                             chunk_size: int) -> AsyncIterator[int]:
+        # Keyset по user_id: в памяти не больше chunk_size ID, а соединение
+        # возвращается в пул между пачками (не держит читающую транзакцию
+        # и WAL-чекпоинт, пока потребитель медленно рассылает)
+        after_user_id = 0
+        while True:
+            async with self.pool.read() as db:
+                async with db.execute(f"""
+                    SELECT user_id FROM users
+                    WHERE is_active = 1 AND user_id > ? AND ({where})
+                    ORDER BY user_id
+                    LIMIT ?
+                """, (after_user_id, *params, chunk_size)) as cursor:
+                    rows = await cursor.fetchmany(chunk_size)
+            for (user_id,) in rows:
+                yield user_id
+            if len(rows) < chunk_size:
+                return
+            after_user_id = rows[-1][0]
+
+    async def get_users_page(self, limit: int = 10, after: tuple = None, before: tuple = None,
+                             exclude_user_id: int = None, query: str = None) -> dict:
+        """Страница активных пользователей по убыванию (last_activity, user_id).
+
+        Keyset-пагинация: курсор — пара (last_activity, user_id).
+        after — последняя строка предыдущей страницы (листаем вперед),
+        before — первая строка текущей страницы (листаем назад).
+        query — поиск по началу username или имени.
+        last_activity обновляет ActivityTracker, поэтому между страницами
+        порядок сдвигается: пользователь может пропасть или повториться.
+        """
+        source = "users u"
+        conditions = ["u.is_active = 1"]
+        params = []
+        if query:
+            # OR из двух LIKE планировщик без статистики (ANALYZE) ведет по
+            # idx_users_active_activity и проверяет каждого пользователя.
+            # Поэтому совпадения сначала собираются по NOCASE-индексам, и
+            # CROSS JOIN заставляет начинать с них; сортируются только они
+            pattern = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            source = """(
+                SELECT user_id FROM users WHERE username LIKE ? ESCAPE '\\'
+                UNION
+                SELECT user_id FROM users WHERE first_name LIKE ? ESCAPE '\\'
+            ) found CROSS JOIN users u ON u.user_id = found.user_id"""
+            params.extend([pattern, pattern])
+        if exclude_user_id:
+            conditions.append("u.user_id != ?")
+            params.append(exclude_user_id)
+        if after:
+            conditions.append("(u.last_activity, u.user_id) < (?, ?)")
+            params.extend(after)
+        elif before:
+            conditions.append("(u.last_activity, u.user_id) > (?, ?)")
+            params.extend(before)
+
+        order = "ASC" if before else "DESC"
+        async with self.pool.read() as db:
+            async with db.execute(f"""
+                SELECT u.user_id, u.username, u.first_name, u.last_name, u.last_activity
+                FROM {source}
+                WHERE {' AND '.join(conditions)}
+                ORDER BY u.last_activity {order}, u.user_id {order}
+                LIMIT ?
+            """, (*params, limit + 1)) as cursor:
+                rows = [dict(row) for row in await cursor.fetchall()]
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if before:
+            rows.reverse()
+            return {'users': rows, 'has_prev': has_more, 'has_next': True}
+        return {'users': rows, 'has_prev': bool(after), 'has_next': has_more}
 
     async def get_user_by_id(self, user_id: int) -> Optional[dict]:
         """Получить пользователя по ID"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.pool.read() as db:
             async with db.execute("""
                 SELECT * FROM users WHERE user_id = ?
             """, (user_id,)) as cursor:
                 row = await cursor.fetchone()
                 return dict(row) if row else None
 
+    async def get_users_by_ids(self, user_ids: List[int], batch: int = 500) -> Dict[int, dict]:
+        """Пользователи по списку ID: user_id -> строка (пачками по batch в IN)"""
+        users = {}
+        user_ids = list(user_ids)
+        async with self.pool.read() as db:
+            for start in range(0, len(user_ids), batch):
+                ids = user_ids[start:start + batch]
+                async with db.execute(f"""
+                    SELECT * FROM users WHERE user_id IN ({", ".join("?" * len(ids))})
+                """, ids) as cursor:
+                    for row in await cursor.fetchall():
+                        users[row['user_id']] = dict(row)
+        return users
+
+    @staticmethod
+    async def _store_body(db, text: str) -> int:
+        """ID текста в message_bodies (добавляется, если его еще нет)"""
+        key = body_hash(text)
+        await db.execute("""
+            INSERT OR IGNORE INTO message_bodies (hash, body) VALUES (?, ?)
+        """, (key, text))
+        async with db.execute("SELECT id FROM message_bodies WHERE hash = ?", (key,)) as cursor:
+            return (await cursor.fetchone())[0]
+
     async def add_message(self, sender_id: int, recipient_id: int, message_text: str):
         """Сохранить отправленное сообщение в историю"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.write() as db:
+            body_id = await self._store_body(db, message_text)
             cursor = await db.execute("""
-                INSERT INTO messages (sender_id, recipient_id, message_text)
+                INSERT INTO messages (sender_id, recipient_id, body_id)
                 VALUES (?, ?, ?)
-            """, (sender_id, recipient_id, message_text))
+            """, (sender_id, recipient_id, body_id))
             await db.commit()
             return cursor.lastrowid
 
+    def queue_message(self, sender_id: int, recipient_id: int, message_text: str):
+        """Сохранить сообщение в историю через отложенную запись.
+
+        Текст рассылки одинаков у всех получателей и хранится один раз:
+        каждая строка messages — только ссылка на него (см. message_log).
+        Поэтому message_text — шаблон, как его написал админ: подстановки
+        ({first_name} и т.п.) не раскрываются, иначе у каждого получателя
+        персональной рассылки был бы свой текст в message_bodies и в поиске.
+        """
+        self.writes.put("""
+            INSERT INTO message_log (sender_id, recipient_id, body_hash, message_text)
+            VALUES (?, ?, ?, ?)
+        """, (sender_id, recipient_id, body_hash(message_text), message_text))
+
     async def get_user_stats(self) -> dict:
-        """Получить общую статистику (для админа)"""
-        async with aiosqlite.connect(self.db_path) as db:
-            # Всего пользователей
-            async with db.execute("SELECT COUNT(*) FROM users WHERE is_active = 1") as cursor:
-                total_users = (await cursor.fetchone())[0]
-
-            # Всего сообщений
-            async with db.execute("SELECT COUNT(*) FROM messages") as cursor:
-                total_messages = (await cursor.fetchone())[0]
-
-            # Всего рассылок
-            async with db.execute("SELECT COUNT(*) FROM broadcasts") as cursor:
-                total_broadcasts = (await cursor.fetchone())[0]
-
-            return {
-                'total_users': total_users,
-                'total_messages': total_messages,
-                'total_broadcasts': total_broadcasts
-            }
+        """Получить общую статистику (для админа).
+
+        Счетчики поддерживаются триггерами в stats_counters, поэтому чтение — O(1).
+        """
+        now = time.monotonic()
+        if self._stats_cache is not None and now - self._stats_cached_at < STATS_CACHE_TTL:
+            return dict(self._stats_cache)
+
+        async with self.pool.read() as db:
+            async with db.execute("SELECT name, value FROM stats_counters") as cursor:
+                counters = {row[0]: row[1] for row in await cursor.fetchall()}
+
+        stats = {
+            'total_users': counters.get('total_users', 0),
+            # Триггеры считают только messages, архив — archive_messages()
+            'total_messages': counters.get('total_messages', 0)
+                              + counters.get('archived_messages', 0),
+            'total_broadcasts': counters.get('total_broadcasts', 0)
+        }
+        self._stats_cache = stats
+        self._stats_cached_at = now
+        return dict(stats)
+
+    async def rebuild_stats_counters(self) -> Tuple[dict, dict]:
+        """Пересчитать счетчики статистики с нуля. Возвращает (было, стало)"""
+        await self.writes.flush()
+        self._stats_cache = None
+        before = await self.get_user_stats()
+
+        async with self.pool.write() as db:
+            # Архив считается под той же блокировкой писателя, что и
+            # archive_messages, поэтому сообщения не посчитаются дважды
+            archived = 0
+            for month in self.archive.months():
+                async with self.archive.attach(db, month):
+                    async with db.execute("SELECT COUNT(*) FROM archive.messages") as cursor:
+                        archived += (await cursor.fetchone())[0]
+            await db.execute(STATS_REBUILD_SQL)
+            await db.execute("""
+                INSERT OR REPLACE INTO stats_counters (name, value)
+                VALUES ('archived_messages', ?)
+            """, (archived,))
+            await db.commit()
+
+        self._stats_cache = None
+        after = await self.get_user_stats()
+        return before, after
 
     async def get_recent_messages(self, limit: int = 50) -> List[dict]:
-        """Получить последние сообщения (для админа)"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute("""
+        """Получить последние сообщения (для админа).
+
+        Если в основной базе их меньше limit, остаток добирается из
+        архива, начиная с последнего месяца.
+        """
+        return (await self.get_messages_page(limit=limit))['messages'][:limit]
+
+    async def get_messages_page(self, limit: int = 20, after: tuple = None,
+                                before: tuple = None) -> dict:
+        """Страница сообщений по убыванию (created_at, id), вместе с архивом.
+
+        Курсоры after / before — как в get_users_page.
+        """
+        cursor = after or before
+        # Архив старше основной базы: вперед — основная, затем месяцы от
+        # новых к старым, назад — наоборот. Месяцы по другую сторону курсора
+        # пропускаются, в каждом источнике не больше limit + 1 строк по
+        # idx_messages_created_at
+        months = self.archive.months()
+        if before:
+            months = [month for month in months if month >= before[0][:7]]
+            sources = months + ["main"]
+        else:
+            if after:
+                months = [month for month in months if month <= after[0][:7]]
+            sources = ["main"] + months[::-1]
+
+        rows = []
+        async with self.pool.read() as db:
+            for source in sources:
+                if len(rows) > limit:
+                    break
+                if source == "main":
+                    rows += await self._select_messages(db, "main", limit + 1 - len(rows),
+                                                        cursor, bool(before))
+                    continue
+                async with self.archive.attach(db, source):
+                    rows += await self._select_messages(db, "archive", limit + 1 - len(rows),
+                                                        cursor, bool(before))
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if before:
+            rows.reverse()
+            return {'messages': rows, 'has_prev': has_more, 'has_next': True}
+        return {'messages': rows, 'has_prev': bool(after), 'has_next': has_more}
+
+    @staticmethod
+    async def _select_messages(db, schema: str, limit: int, key: tuple = None,
+                               ascending: bool = False) -> List[dict]:
+        """Сообщения схемы schema за ключом (created_at, id) в порядке страницы"""
+        where = ""
+        params = []
+        if key:
+            where = f"WHERE (m.created_at, m.id) {'>' if ascending else '<'} (?, ?)"
+            params.extend(key)
+        order = "ASC" if ascending else "DESC"
+        async with db.execute(f"""
+            SELECT
+                m.*,
+                b.body as message_text,
+                u1.username as sender_username,
+                u1.first_name as sender_first_name,
+                u2.username as recipient_username,
+                u2.first_name as recipient_first_name
+            FROM {schema}.messages m
+            JOIN {schema}.message_bodies b ON b.id = m.body_id
+            LEFT JOIN main.users u1 ON m.sender_id = u1.user_id
+            LEFT JOIN main.users u2 ON m.recipient_id = u2.user_id
+            {where}
+            ORDER BY m.created_at {order}, m.id {order}
+            LIMIT ?
+        """, (*params, limit)) as cursor:
+            rows = await cursor.fetchall()
+            return [dict(row) for row in rows]
+
+    async def search_messages(self, search: MessageSearch, limit: int = 10,
+                              offset: int = 0) -> List[dict]:
+        """Найти сообщения по словам и фильтрам, лучшие совпадения первыми (без архива).
+
+        В snippet найденные слова обрамлены SNIPPET_MARKS, текст не экранирован.
+        """
+        where, params = search.compile()
+        match = search.match()
+        async with self.pool.read() as db:
+            # Запрос всегда идет от совпадений в message_bodies_fts: у админа,
+            # который рассылает, — почти все сообщения, и обход его истории
+            # дороже. Фильтры проверяются по idx_messages_body_sender /
+            # idx_messages_body_recipient, и каждый текст дает не больше
+            # limit + offset своих последних сообщений: рассылка на 50 тысяч
+            # получателей не попадает в сортировку целиком
+            async with db.execute(f"""
+                WITH page AS MATERIALIZED (
+                    SELECT m.id, m.body_id, f.rank
+                    FROM message_bodies_fts f
+                    CROSS JOIN messages m ON m.id IN (
+                        SELECT m.id FROM messages m
+                        WHERE m.body_id = f.rowid AND {where}
+                        ORDER BY m.id DESC
+                        LIMIT ?
+                    )
+                    WHERE message_bodies_fts MATCH ?
+                    ORDER BY f.rank, m.id DESC
+                    LIMIT ? OFFSET ?
+                )
                 SELECT
-                    m.*,
+                    m.id, m.sender_id, m.recipient_id, m.created_at,
+                    snippet(message_bodies_fts, 0, ?, ?, '…', 16) as snippet,
                     u1.username as sender_username,
                     u1.first_name as sender_first_name,
                     u2.username as recipient_username,
                     u2.first_name as recipient_first_name
-                FROM messages m
+                FROM page
+                CROSS JOIN messages m ON m.id = page.id
+                CROSS JOIN message_bodies_fts ON message_bodies_fts.rowid = page.body_id
                 LEFT JOIN users u1 ON m.sender_id = u1.user_id
                 LEFT JOIN users u2 ON m.recipient_id = u2.user_id
-                ORDER BY m.created_at DESC
-                LIMIT ?
-            """, (limit,)) as cursor:
+                WHERE message_bodies_fts MATCH ?
+                ORDER BY page.rank, page.id DESC
+            """, [*params, limit + offset, match, limit, offset, *SNIPPET_MARKS, match]) as cursor:
                 rows = await cursor.fetchall()
                 return [dict(row) for row in rows]
 
+    async def archive_messages(self, older_than_days: int, batch: int = 2000) -> int:
+        """Перенести в архив до batch самых старых сообщений старше older_than_days дней.
+
+        Пачка берется из одного месяца и переносится двумя транзакциями:
+        копия в файл архива, затем удаление из основной базы вместе с
+        текстами, на которые больше никто не ссылается. Копия идемпотентна
+        (INSERT OR IGNORE по id), поэтому сбой между ними не теряет и не
+        дублирует сообщения. Возвращает число перенесенных (0 — переносить нечего).
+        """
+        async with self.pool.write() as db:
+            async with db.execute("""
+                SELECT MIN(created_at), datetime('now', ?) FROM messages
+                WHERE created_at < datetime('now', ?)
+            """, (f"-{older_than_days} days", f"-{older_than_days} days")) as cursor:
+                oldest, cutoff = await cursor.fetchone()
+            if oldest is None:
+                return 0
+            month = oldest[:7]
+            year, month_number = map(int, month.split("-"))
+            next_month = (f"{year + 1}-01-01" if month_number == 12
+                          else f"{year}-{month_number + 1:02d}-01")
+
+            async with self.archive.attach(db, month, create=True):
+                await db.execute("""
+                    CREATE TEMP TABLE IF NOT EXISTS archive_batch (
+                        id INTEGER PRIMARY KEY,
+                        body_id INTEGER
+                    )
+                """)
+                await db.execute("DELETE FROM temp.archive_batch")
+                await db.execute("""
+                    INSERT INTO temp.archive_batch (id, body_id)
+                    SELECT id, body_id FROM messages
+                    WHERE created_at < ?
+                    ORDER BY created_at
+                    LIMIT ?
+                """, (min(cutoff, next_month), batch))
+
+                await db.execute("""
+                    INSERT OR IGNORE INTO archive.message_bodies (hash, body)
+                    SELECT hash, body FROM main.message_bodies
+                    WHERE id IN (SELECT body_id FROM temp.archive_batch)
+                """)
+                await db.execute("""
+                    INSERT OR IGNORE INTO archive.messages
+                        (id, sender_id, recipient_id, body_id, created_at)
+                    SELECT m.id, m.sender_id, m.recipient_id, ab.id, m.created_at
+                    FROM temp.archive_batch t
+                    JOIN main.messages m ON m.id = t.id
+                    JOIN main.message_bodies b ON b.id = m.body_id
+                    JOIN archive.message_bodies ab ON ab.hash = b.hash
+                """)
+                await db.commit()
+
+                # Удаляются только сообщения, которые точно есть в архиве
+                cursor = await db.execute("""
+                    DELETE FROM main.messages WHERE id IN (
+                        SELECT t.id FROM temp.archive_batch t
+                        JOIN archive.messages a ON a.id = t.id
+                    )
+                """)
+                moved = cursor.rowcount
+                await db.execute("""
+                    DELETE FROM main.message_bodies
+                    WHERE id IN (SELECT body_id FROM temp.archive_batch)
+                      AND NOT EXISTS (SELECT 1 FROM main.messages WHERE body_id = message_bodies.id)
+                      AND NOT EXISTS (SELECT 1 FROM broadcasts WHERE body_id = message_bodies.id)
+                      AND NOT EXISTS (SELECT 1 FROM broadcast_jobs WHERE body_id = message_bodies.id)
+                """)
+                await self._add_archived_count(db, moved)
+                await db.commit()
+        return moved
+
+    @staticmethod
+    async def _add_archived_count(db, delta: int):
+        # total_messages уменьшает триггер удаления, а в статистике архивные
+        # сообщения должны остаться
+        await db.execute("""
+            INSERT INTO stats_counters (name, value) VALUES ('archived_messages', ?)
+            ON CONFLICT(name) DO UPDATE SET value = value + excluded.value
+        """, (delta,))
+
+    async def incremental_vacuum(self, pages: int = 256) -> int:
+        """Вернуть системе до pages свободных страниц файла базы.
+
+        Короткий шаг под блокировкой писателя: место после больших удалений
+        (архивации) возвращается понемногу, не останавливая запись.
+        Возвращает число освобожденных страниц (меньше pages — свободных не осталось).
+        """
+        async with self.pool.write() as db:
+            async with db.execute("PRAGMA freelist_count") as cursor:
+                before = (await cursor.fetchone())[0]
+            # execute() делает один шаг (одну страницу), executescript — все
+            await db.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+            async with db.execute("PRAGMA freelist_count") as cursor:
+                return before - (await cursor.fetchone())[0]
+
     async def add_broadcast(self, sender_id: int, message_text: str,
-                          total_recipients: int):
-        """Добавить запись о рассылке"""
-        async with aiosqlite.connect(self.db_path) as db:
+                          total_recipients: int, content_type: str = "text",
+                          file_id: str = None):
+        """Добавить запись о рассылке (для медиа message_text — подпись)"""
+        async with self.pool.write() as db:
+            body_id = await self._store_body(db, message_text)
             cursor = await db.execute("""
-                INSERT INTO broadcasts (sender_id, message_text, total_recipients)
-                VALUES (?, ?, ?)
-            """, (sender_id, message_text, total_recipients))
+                INSERT INTO broadcasts (sender_id, body_id, total_recipients,
+                                        content_type, file_id)
+                VALUES (?, ?, ?, ?, ?)
+            """, (sender_id, body_id, total_recipients, content_type, file_id))
             await db.commit()
             return cursor.lastrowid
 
     async def update_broadcast_stats(self, broadcast_id: int,
                                     successful: int, failed: int):
         """Обновить статистику рассылки"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.write() as db:
             await db.execute("""
                 UPDATE broadcasts
                 SET successful_sends = ?, failed_sends = ?
@@ -180,9 +662,249 @@ class Database:
             """, (successful, failed, broadcast_id))
             await db.commit()
 
+    async def create_broadcast_job(self, sender_id: int, message_text: str,
+                                   total_recipients: int, expires_at: int = None,
+                                   chunk_size: int = BROADCAST_CHUNK_SIZE,
+                                   segment: Segment = None) -> int:
+        """Создать фоновую рассылку и поставить ее куски в очередь.
+
+        Все в одной транзакции, чтобы воркер не увидел рассылку без части кусков.
+        segment — рассылка только пользователям сегмента (иначе всем активным).
+        """
+        async with self.pool.write() as db:
+            body_id = await self._store_body(db, message_text)
+            cursor = await db.execute("""
+                INSERT INTO broadcasts (sender_id, body_id, total_recipients)
+                VALUES (?, ?, ?)
+            """, (sender_id, body_id, total_recipients))
+            cursor = await db.execute("""
+                INSERT INTO broadcast_jobs (broadcast_id, sender_id, body_id, expires_at,
+                                            segment)
+                VALUES (?, ?, ?, ?, ?)
+            """, (cursor.lastrowid, sender_id, body_id, expires_at,
+                  segment.to_json() if segment else None))
+            job_id = cursor.lastrowid
+            if not await insert_broadcast_chunks(db, job_id, 0, chunk_size, segment):
+                # Получателей нет: отправлять нечего
+                await db.execute("UPDATE broadcast_jobs SET status = 'done' WHERE id = ?",
+                                 (job_id,))
+            await db.commit()
+            return job_id
+
+    async def get_broadcast_job(self, job_id: int) -> Optional[dict]:
+        """Получить фоновую рассылку по ID"""
+        async with self.pool.read() as db:
+            async with db.execute("""
+                SELECT j.*, b.body as message_text
+                FROM broadcast_jobs j
+                JOIN message_bodies b ON b.id = j.body_id
+                WHERE j.id = ?
+            """, (job_id,)) as cursor:
+                row = await cursor.fetchone()
+                return dict(row) if row else None
+
+    async def get_unfinished_broadcast_jobs(self) -> List[dict]:
+        """Получить незавершенные фоновые рассылки"""
+        async with self.pool.read() as db:
+            async with db.execute("""
+                SELECT j.*, b.body as message_text
+                FROM broadcast_jobs j
+                JOIN message_bodies b ON b.id = j.body_id
+                WHERE j.status = 'running'
+                ORDER BY j.id
+            """) as cursor:
+                rows = await cursor.fetchall()
+                return [dict(row) for row in rows]
+
+    async def get_active_user_ids_range(self, after_user_id: int, last_user_id: int,
+                                        segment: Segment = None) -> List[int]:
+        """ID активных пользователей (сегмента) в диапазоне (after_user_id, last_user_id]"""
+        where, params = segment.compile() if segment else ("1", [])
+        async with self.pool.read() as db:
+            async with db.execute(f"""
+                SELECT user_id FROM users
+                WHERE is_active = 1 AND user_id > ? AND user_id <= ? AND ({where})
+                ORDER BY user_id
+            """, (after_user_id, last_user_id, *params)) as cursor:
+                rows = await cursor.fetchall()
+                return [row[0] for row in rows]
+
+    async def claim_broadcast_chunk(self, worker_id: str, lease: float) -> Optional[dict]:
+        """Взять свободный кусок рассылки в аренду на lease секунд.
+
+        Свободен кусок, который еще не брали или чья аренда истекла (воркер
+        упал). Выбор и захват — один UPDATE, поэтому два процесса не получат
+        один и тот же кусок.
+        """
+        now = time.time()
+        async with self.pool.write() as db:
+            async with db.execute("""
+                UPDATE broadcast_chunks
+                SET worker_id = ?, lease_until = ?, attempts = attempts + 1,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = (
+                    SELECT id FROM broadcast_chunks
+                    WHERE status = 'queued' AND lease_until < ?
+                    ORDER BY lease_until, id
+                    LIMIT 1
+                )
+                RETURNING *
+            """, (worker_id, now + lease, now)) as cursor:
+                row = await cursor.fetchone()
+            await db.commit()
+            return dict(row) if row else None
+
+    async def extend_broadcast_chunk_lease(self, chunk_id: int, worker_id: str,
+                                           lease: float) -> bool:
+        """Продлить аренду куска (heartbeat). False — аренду уже забрали"""
+        async with self.pool.write() as db:
+            cursor = await db.execute("""
+                UPDATE broadcast_chunks
+                SET lease_until = ?
+                WHERE id = ? AND worker_id = ? AND status = 'queued'
+            """, (time.time() + lease, chunk_id, worker_id))
+            await db.commit()
+            return cursor.rowcount > 0
+
+    async def release_broadcast_chunk(self, chunk_id: int, worker_id: str):
+        """Вернуть кусок в очередь (воркер останавливается)"""
+        async with self.pool.write() as db:
+            await db.execute("""
+                UPDATE broadcast_chunks
+                SET lease_until = 0, worker_id = NULL
+                WHERE id = ? AND worker_id = ? AND status = 'queued'
+            """, (chunk_id, worker_id))
+            await db.commit()
+
+    async def complete_broadcast_chunk(self, chunk_id: int, worker_id: str, job_id: int,
+                                       successful: int, failed: int,
+                                       status: str = 'done') -> bool:
+        """Закрыть кусок и прибавить его счетчики к рассылке.
+
+        False — аренду успели забрать, счетчики не трогаем.
+        """
+        # Сначала история: если запись не удалась, flush() бросает исключение
+        # и кусок остается открытым
+        await self.writes.flush()
+        async with self.pool.write() as db:
+            cursor = await db.execute("""
+                UPDATE broadcast_chunks
+                SET status = ?, successful_sends = ?, failed_sends = ?,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND worker_id = ? AND status = 'queued'
+            """, (status, successful, failed, chunk_id, worker_id))
+            if cursor.rowcount == 0:
+                await db.rollback()
+                return False
+
+            await db.execute("""
+                UPDATE broadcast_jobs
+                SET successful_sends = successful_sends + ?,
+                    failed_sends = failed_sends + ?,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            """, (successful, failed, job_id))
+            await db.execute("""
+                UPDATE broadcasts
+                SET successful_sends = successful_sends + ?,
+                    failed_sends = failed_sends + ?
+                WHERE id = (SELECT broadcast_id FROM broadcast_jobs WHERE id = ?)
+            """, (successful, failed, job_id))
+            await db.commit()
+            return True
+
+    async def count_active_broadcast_workers(self) -> int:
+        """Сколько воркеров сейчас держат аренду кусков"""
+        async with self.pool.read() as db:
+            async with db.execute("""
+                SELECT COUNT(DISTINCT worker_id) FROM broadcast_chunks
+                WHERE status = 'queued' AND lease_until > ?
+            """, (time.time(),)) as cursor:
+                row = await cursor.fetchone()
+                return row[0]
+
+    async def finish_broadcast_job(self, job_id: int, status: str = 'done') -> bool:
+        """Завершить фоновую рассылку.
+
+        'done' ставится, только когда не осталось открытых кусков; при другом
+        статусе свободные куски отменяются (взятые в работу доотправляются).
+        True — рассылку завершил именно этот вызов.
+        """
+        await self.writes.flush()
+        async with self.pool.write() as db:
+            if status == 'done':
+                cursor = await db.execute("""
+                    UPDATE broadcast_jobs
+                    SET status = 'done', updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ? AND status = 'running' AND NOT EXISTS (
+                        SELECT 1 FROM broadcast_chunks
+                        WHERE job_id = ? AND status = 'queued'
+                    )
+                """, (job_id, job_id))
+            else:
+                cursor = await db.execute("""
+                    UPDATE broadcast_jobs
+                    SET status = ?, updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ? AND status = 'running'
+                """, (status, job_id))
+                await db.execute("""
+                    UPDATE broadcast_chunks
+                    SET status = 'cancelled', updated_at = CURRENT_TIMESTAMP
+                    WHERE job_id = ? AND status = 'queued' AND lease_until < ?
+                """, (job_id, time.time()))
+            await db.commit()
+            return cursor.rowcount > 0
+
+    async def count_segment_users(self, segment: Segment) -> int:
+        """Сколько активных пользователей в сегменте"""
+        where, params = segment.compile()
+        async with self.pool.read() as db:
+            async with db.execute(f"""
+                SELECT COUNT(*) FROM users WHERE is_active = 1 AND ({where})
+            """, params) as cursor:
+                return (await cursor.fetchone())[0]
+
+    async def save_segment(self, name: str, segment: Segment, created_by: int):
+        """Сохранить сегмент под именем (перезаписывает существующий)"""
+        async with self.pool.write() as db:
+            await db.execute("""
+                INSERT INTO segments (name, definition, created_by)
+                VALUES (?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET
+                    definition = excluded.definition,
+                    created_by = excluded.created_by,
+                    created_at = CURRENT_TIMESTAMP
+            """, (name, segment.to_json(), created_by))
+            await db.commit()
+
+    async def get_segment(self, name: str) -> Optional[Segment]:
+        """Получить сохраненный сегмент по имени"""
+        async with self.pool.read() as db:
+            async with db.execute("""
+                SELECT definition FROM segments WHERE name = ?
+            """, (name,)) as cursor:
+                row = await cursor.fetchone()
+                return Segment.from_json(row[0]) if row else None
+
+    async def get_all_segments(self) -> List[dict]:
+        """Получить все сохраненные сегменты"""
+        async with self.pool.read() as db:
+            async with db.execute("""
+                SELECT * FROM segments ORDER BY name
+            """) as cursor:
+                rows = await cursor.fetchall()
+                return [dict(row) for row in rows]
+
+    async def delete_segment(self, name: str) -> bool:
+        """Удалить сохраненный сегмент"""
+        async with self.pool.write() as db:
+            cursor = await db.execute("DELETE FROM segments WHERE name = ?", (name,))
+            await db.commit()
+            return cursor.rowcount > 0
+
     async def deactivate_user(self, user_id: int):
         """Деактивировать пользователя (soft delete)"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.write() as db:
             await db.execute("""
                 UPDATE users
                 SET is_active = 0
@@ -192,45 +914,98 @@ class Database:
 
     async def delete_user(self, user_id: int):
         """Полностью удалить пользователя (hard delete)"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.write() as db:
+            # Тексты сообщений и рассылок пользователя (см. ниже)
+            async with db.execute("""
+                SELECT body_id FROM messages WHERE sender_id = ? OR recipient_id = ?
+                UNION ALL SELECT body_id FROM broadcasts WHERE sender_id = ?
+                UNION ALL SELECT body_id FROM broadcast_jobs WHERE sender_id = ?
+            """, (user_id, user_id, user_id, user_id)) as cursor:
+                body_ids = {row[0] for row in await cursor.fetchall()}
             # Удаляем сообщения
             await db.execute("DELETE FROM messages WHERE sender_id = ? OR recipient_id = ?", (user_id, user_id))
             # Удаляем рассылки
+            await db.execute("""
+                DELETE FROM broadcast_chunks
+                WHERE job_id IN (SELECT id FROM broadcast_jobs WHERE sender_id = ?)
+            """, (user_id,))
+            await db.execute("DELETE FROM broadcast_jobs WHERE sender_id = ?", (user_id,))
             await db.execute("DELETE FROM broadcasts WHERE sender_id = ?", (user_id,))
             # Удаляем из админов (если есть)
             await db.execute("DELETE FROM admins WHERE user_id = ?", (user_id,))
             # Удаляем пользователя
             await db.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+            # Удаляем его тексты, на которые больше никто не ссылается
+            await db.executemany("""
+                DELETE FROM message_bodies
+                WHERE id = ?
+                  AND NOT EXISTS (SELECT 1 FROM messages WHERE body_id = message_bodies.id)
+                  AND NOT EXISTS (SELECT 1 FROM broadcasts WHERE body_id = message_bodies.id)
+                  AND NOT EXISTS (SELECT 1 FROM broadcast_jobs WHERE body_id = message_bodies.id)
+            """, [(body_id,) for body_id in body_ids])
             await db.commit()
+            # И из архива: по транзакции на месяц
+            for month in self.archive.months():
+                async with self.archive.attach(db, month):
+                    await self._delete_archived_messages(db, user_id)
+        self._notify_admins_changed(user_id, False)
+
+    async def _delete_archived_messages(self, db, user_id: int):
+        """Удалить сообщения пользователя из подключенного архива"""
+        async with db.execute("""
+            SELECT body_id FROM archive.messages WHERE sender_id = ? OR recipient_id = ?
+        """, (user_id, user_id)) as cursor:
+            body_ids = {row[0] for row in await cursor.fetchall()}
+        if not body_ids:
+            return
+        cursor = await db.execute("""
+            DELETE FROM archive.messages WHERE sender_id = ? OR recipient_id = ?
+        """, (user_id, user_id))
+        await self._add_archived_count(db, -cursor.rowcount)
+        await db.executemany("""
+            DELETE FROM archive.message_bodies
+            WHERE id = ? AND NOT EXISTS (
+                SELECT 1 FROM archive.messages WHERE body_id = message_bodies.id
+            )
+        """, [(body_id,) for body_id in body_ids])
+        await db.commit()
 
     async def add_admin(self, user_id: int, added_by: int):
         """Добавить пользователя в админы"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.write() as db:
             await db.execute("""
                 INSERT OR IGNORE INTO admins (user_id, added_by)
                 VALUES (?, ?)
             """, (user_id, added_by))
             await db.commit()
+        self._notify_admins_changed(user_id, True)
 
     async def remove_admin(self, user_id: int):
         """Удалить пользователя из админов"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.write() as db:
             await db.execute("DELETE FROM admins WHERE user_id = ?", (user_id,))
             await db.commit()
+        self._notify_admins_changed(user_id, False)
 
     async def is_admin(self, user_id: int) -> bool:
         """Проверить, является ли пользователь админом"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.read() as db:
             async with db.execute("""
                 SELECT 1 FROM admins WHERE user_id = ?
             """, (user_id,)) as cursor:
                 row = await cursor.fetchone()
                 return row is not None
 
+    async def get_admin_ids(self) -> Set[int]:
+        """Получить ID всех админов"""
+        async with self.pool.read() as db:
+            async with db.execute("SELECT user_id FROM admins") as cursor:
+                rows = await cursor.fetchall()
+                return {row[0] for row in rows}
+
     async def get_all_admins(self) -> List[dict]:
         """Получить список всех админов"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.pool.read() as db:
             async with db.execute("""
                 SELECT a.*, u.username, u.first_name, u.last_name
                 FROM admins a
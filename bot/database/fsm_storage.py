@@ -0,0 +1,226 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Mapping, Optional, Set
+
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from bot.database.db import Database
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+def _dumps(data: dict) -> str:
+    """Компактная сериализация данных FSM"""
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище в SQLite бота вместо MemoryStorage.
+
+    Состояния переживают штатный рестарт. Запись отложенная: изменения
+    копятся в памяти (повторные изменения одного ключа схлопываются) и
+    пишутся пачкой раз в flush_interval секунд, поэтому при падении процесса
+    теряются изменения последних flush_interval секунд. Чтение смотрит в
+    еще не записанные изменения, потом в кэш прочитанных из базы ключей
+    (до max_cached), и только потом в базу.
+
+    Хранилище рассчитано на один процесс бота: другой процесс увидит
+    изменения с задержкой до flush_interval, а его собственные записи
+    не попадут в кэш этого. Воркеры рассылок FSM не используют.
+    Состояния, не менявшиеся дольше ttl секунд, удаляются.
+    """
+
+    def __init__(self, db: Database, flush_interval: float = 0.5,
+                 ttl: float = 7 * 24 * 3600, cleanup_interval: float = 3600,
+                 max_cached: int = 10000):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self.cleanup_interval = cleanup_interval
+        self.max_cached = max_cached
+        # key -> {'state': ..., 'data': ...} (только измененные поля)
+        self._dirty: Dict[str, Dict[str, Any]] = {}
+        # key -> {'state': ..., 'data': ...}: записанное в базе, LRU
+        self._cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        # Ключи, которые сейчас читаются из базы, и измененные за это время
+        self._reading: Dict[str, int] = {}
+        self._changed: Set[str] = set()
+        # Изменения, которые сейчас пишутся в базу
+        self._flushing: Dict[str, Dict[str, Any]] = {}
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._cleaned_at = 0.0
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return (f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:"
+                f"{key.business_connection_id or ''}:{key.destiny}")
+
+    def _mark(self, key: StorageKey, field: str, value: Any):
+        key = self._key(key)
+        self._dirty.setdefault(key, {})[field] = value
+        # После записи в базу значение там будет таким же
+        if key in self._cache:
+            self._cache[key][field] = value
+        if key in self._reading:
+            self._changed.add(key)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def _pending(self, key: str, field: str) -> Any:
+        for pending in (self._dirty, self._flushing):
+            value = pending.get(key, {}).get(field, _MISSING)
+            if value is not _MISSING:
+                return value
+        return _MISSING
+
+    async def _get(self, key: StorageKey, field: str) -> Any:
+        """Значение поля: из незаписанных изменений, из кэша или из базы"""
+        key = self._key(key)
+        while True:
+            value = self._pending(key, field)
+            if value is not _MISSING:
+                return value
+            record = self._cache.get(key)
+            if record is not None:
+                self._cache.move_to_end(key)
+                return record[field]
+
+            self._reading[key] = self._reading.get(key, 0) + 1
+            try:
+                async with self.db.pool.read() as db:
+                    async with db.execute("""
+                        SELECT state, data FROM fsm_states WHERE key = ?
+                    """, (key,)) as cursor:
+                        row = await cursor.fetchone()
+            finally:
+                self._reading[key] -= 1
+                changed = key in self._changed
+                if not self._reading[key]:
+                    del self._reading[key]
+                    self._changed.discard(key)
+            # Ключ изменили (и, возможно, уже записали), пока шло чтение:
+            # прочитанное могло устареть, смотрим заново
+            if not changed:
+                break
+
+        record = {'state': row[0], 'data': row[1]} if row else {'state': None, 'data': None}
+        self._cache[key] = record
+        if len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
+        return record[field]
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        self._mark(key, 'state', state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return await self._get(key, 'state')
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            msg = f"Data must be a dict or dict-like object, got {type(data).__name__}"
+            raise DataNotDictLikeError(msg)
+        # Сериализуем сразу: так сохраняется снимок, а не ссылка на изменяемый dict
+        self._mark(key, 'data', _dumps(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        data = await self._get(key, 'data')
+        return json.loads(data) if data else {}
+
+    async def flush(self):
+        """Записать накопленные изменения одной транзакцией"""
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, {}
+            self._flushing = dirty
+            now = int(time.time())
+
+            full, states, datas, deleted = [], [], [], []
+            for key, record in dirty.items():
+                state = record.get('state', _MISSING)
+                data = record.get('data', _MISSING)
+                if state is None and data == '{}':
+                    # state.clear(): хранить нечего
+                    deleted.append((key,))
+                elif state is not _MISSING and data is not _MISSING:
+                    full.append((key, state, data, now))
+                elif state is not _MISSING:
+                    states.append((key, state, now))
+                else:
+                    datas.append((key, data, now))
+
+            try:
+                async with self.db.pool.write() as db:
+                    if full:
+                        await db.executemany("""
+                            INSERT INTO fsm_states (key, state, data, updated_at)
+                            VALUES (?, ?, ?, ?)
+                            ON CONFLICT(key) DO UPDATE SET
+                                state = excluded.state,
+                                data = excluded.data,
+                                updated_at = excluded.updated_at
+                        """, full)
+                    if states:
+                        await db.executemany("""
+                            INSERT INTO fsm_states (key, state, updated_at)
+                            VALUES (?, ?, ?)
+                            ON CONFLICT(key) DO UPDATE SET
+                                state = excluded.state,
+                                updated_at = excluded.updated_at
+                        """, states)
+                    if datas:
+                        await db.executemany("""
+                            INSERT INTO fsm_states (key, data, updated_at)
+                            VALUES (?, ?, ?)
+                            ON CONFLICT(key) DO UPDATE SET
+                                data = excluded.data,
+                                updated_at = excluded.updated_at
+                        """, datas)
+                    if deleted:
+                        await db.executemany("DELETE FROM fsm_states WHERE key = ?", deleted)
+                    await db.commit()
+            except Exception:
+                logger.exception("Не удалось записать %s FSM-состояний", len(dirty))
+                # Возвращаем изменения, не затирая более свежие
+                for key, record in dirty.items():
+                    self._dirty[key] = {**record, **self._dirty.get(key, {})}
+            finally:
+                self._flushing = {}
+
+    async def cleanup(self):
+        """Удалить состояния, которые не менялись дольше ttl"""
+        async with self.db.pool.write() as db:
+            cursor = await db.execute("""
+                DELETE FROM fsm_states WHERE updated_at < ?
+            """, (int(time.time() - self.ttl),))
+            await db.commit()
+            if cursor.rowcount:
+                logger.info("Удалено устаревших FSM-состояний: %s", cursor.rowcount)
+                # Удаленные ключи могли остаться в кэше
+                self._cache.clear()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            if time.monotonic() - self._cleaned_at > self.cleanup_interval:
+                self._cleaned_at = time.monotonic()
+                try:
+                    await self.cleanup()
+                except Exception:
+                    logger.exception("Не удалось очистить устаревшие FSM-состояния")
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
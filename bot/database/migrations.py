@@ -0,0 +1,477 @@
+import hashlib
+import logging
+from functools import lru_cache
+
+import aiosqlite
+
+from bot.database.segments import Segment
+
+logger = logging.getLogger(__name__)
+
+# Пересчет счетчиков статистики с нуля (миграция 5 и /rebuild_stats).
+# Архив в отдельных файлах, archived_messages считает rebuild_stats_counters
+STATS_REBUILD_SQL = """
+    INSERT OR REPLACE INTO stats_counters (name, value) VALUES
+        ('total_users', (SELECT COUNT(*) FROM users WHERE is_active = 1)),
+        ('total_messages', (SELECT COUNT(*) FROM messages)),
+        ('total_broadcasts', (SELECT COUNT(*) FROM broadcasts))
+"""
+
+
+@lru_cache(maxsize=128)
+def body_hash(text: str) -> bytes:
+    """Ключ текста в message_bodies: sha256 от UTF-8"""
+    return hashlib.sha256(text.encode()).digest()
+
+
+# Сколько получателей в одном куске рассылки (единица работы воркера)
+BROADCAST_CHUNK_SIZE = 200
+
+
+async def insert_broadcast_chunks(db: aiosqlite.Connection, job_id: int,
+                                  after_user_id: int = 0,
+                                  chunk_size: int = BROADCAST_CHUNK_SIZE,
+                                  segment: Segment = None) -> int:
+    """Нарезать активных пользователей после after_user_id на куски рассылки.
+
+    Кусок — диапазон (after_user_id, last_user_id] по user_id; получатели
+    выбираются воркером в момент отправки. Если задан segment, в куски
+    попадают только его пользователи. Вызывается внутри транзакции.
+    """
+    if segment is None:
+        bounds = await _chunk_bounds_walk(db, after_user_id, chunk_size)
+    else:
+        bounds = await _chunk_bounds_segment(db, after_user_id, chunk_size, segment)
+
+    chunks = []
+    for last_user_id in bounds:
+        chunks.append((job_id, after_user_id, last_user_id))
+        after_user_id = last_user_id
+
+    await db.executemany("""
+        INSERT INTO broadcast_chunks (job_id, after_user_id, last_user_id)
+        VALUES (?, ?, ?)
+    """, chunks)
+    return len(chunks)
+
+
+async def _chunk_bounds_walk(db: aiosqlite.Connection, after_user_id: int,
+                             chunk_size: int) -> list:
+    """Границы кусков по всем активным: шаг по индексу через OFFSET"""
+    bounds = []
+    while True:
+        async with db.execute("""
+            SELECT user_id FROM users
+            WHERE is_active = 1 AND user_id > ?
+            ORDER BY user_id
+            LIMIT 1 OFFSET ?
+        """, (after_user_id, chunk_size - 1)) as cursor:
+            row = await cursor.fetchone()
+        if row is None:
+            # Хвост меньше целого куска
+            async with db.execute("""
+                SELECT MAX(user_id) FROM users WHERE is_active = 1 AND user_id > ?
+            """, (after_user_id,)) as cursor:
+                row = await cursor.fetchone()
+            if row[0] is not None:
+                bounds.append(row[0])
+            return bounds
+        bounds.append(row[0])
+        after_user_id = row[0]
+
+
+async def _chunk_bounds_segment(db: aiosqlite.Connection, after_user_id: int,
+                                chunk_size: int, segment: Segment) -> list:
+    """Границы кусков сегмента одним проходом.
+
+    Шаг через OFFSET вычислял бы условие сегмента (с подзапросами по
+    messages) заново на каждый кусок, поэтому номер строки берется оконной
+    функцией: каждый chunk_size-й пользователь сегмента и хвост.
+    """
+    where, params = segment.compile()
+    async with db.execute(f"""
+        SELECT user_id FROM (
+            SELECT user_id, ROW_NUMBER() OVER (ORDER BY user_id) AS n
+            FROM users
+            WHERE is_active = 1 AND user_id > ? AND ({where})
+        )
+        WHERE n % ? = 0
+    """, (after_user_id, *params, chunk_size)) as cursor:
+        bounds = sorted(row[0] for row in await cursor.fetchall())
+    async with db.execute(f"""
+        SELECT MAX(user_id) FROM users
+        WHERE is_active = 1 AND user_id > ? AND ({where})
+    """, (bounds[-1] if bounds else after_user_id, *params)) as cursor:
+        row = await cursor.fetchone()
+    if row[0] is not None:
+        bounds.append(row[0])
+    return bounds
+
+
+async def _chunk_running_jobs(db: aiosqlite.Connection):
+    """Перевести незавершенные рассылки на очередь кусков с их курсора"""
+    async with db.execute("""
+        SELECT id, last_user_id FROM broadcast_jobs WHERE status = 'running'
+    """) as cursor:
+        jobs = await cursor.fetchall()
+    for job_id, last_user_id in jobs:
+        await insert_broadcast_chunks(db, job_id, last_user_id)
+
+
+async def _move_texts_to_bodies(db: aiosqlite.Connection):
+    """Перенести message_text из messages, broadcasts и broadcast_jobs в message_bodies"""
+    await db.create_function("sha256", 1, body_hash, deterministic=True)
+    for table in ("messages", "broadcasts", "broadcast_jobs"):
+        await db.execute(f"""
+            INSERT OR IGNORE INTO message_bodies (hash, body)
+            SELECT sha256(message_text), message_text FROM {table}
+        """)
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN body_id INTEGER REFERENCES message_bodies(id)")
+        await db.execute(f"""
+            UPDATE {table}
+            SET body_id = (SELECT id FROM message_bodies WHERE hash = sha256(message_text))
+        """)
+        await db.execute(f"ALTER TABLE {table} DROP COLUMN message_text")
+
+
+# Версионированные миграции схемы: (версия, описание, шаги).
+# Шаг — SQL-строка или async-функция, принимающая соединение.
+# Уже выпущенные миграции не меняем, только добавляем новые в конец.
+MIGRATIONS = [
+    (1, "Начальная схема", [
+        # Таблица всех пользователей бота (общедоступная)
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            is_active INTEGER DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        # История сообщений
+        """
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender_id INTEGER NOT NULL,
+            recipient_id INTEGER NOT NULL,
+            message_text TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (sender_id) REFERENCES users(user_id),
+            FOREIGN KEY (recipient_id) REFERENCES users(user_id)
+        )
+        """,
+        # История рассылок
+        """
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender_id INTEGER NOT NULL,
+            message_text TEXT NOT NULL,
+            total_recipients INTEGER NOT NULL,
+            successful_sends INTEGER DEFAULT 0,
+            failed_sends INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (sender_id) REFERENCES users(user_id)
+        )
+        """,
+        # Таблица админов
+        """
+        CREATE TABLE IF NOT EXISTS admins (
+            user_id INTEGER PRIMARY KEY,
+            added_by INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id),
+            FOREIGN KEY (added_by) REFERENCES users(user_id)
+        )
+        """,
+    ]),
+    (2, "Фоновые рассылки", [
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            broadcast_id INTEGER NOT NULL,
+            sender_id INTEGER NOT NULL,
+            message_text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            successful_sends INTEGER DEFAULT 0,
+            failed_sends INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (broadcast_id) REFERENCES broadcasts(id),
+            FOREIGN KEY (sender_id) REFERENCES users(user_id)
+        )
+        """,
+    ]),
+    (3, "Индексы для частых запросов", [
+        # get_users_page: WHERE is_active = 1 ORDER BY last_activity DESC
+        "CREATE INDEX IF NOT EXISTS idx_users_active_activity ON users(is_active, last_activity)",
+        # insert_broadcast_chunks, get_active_user_ids_range, iter_active_user_ids:
+        # покрывающий индекс для обхода по user_id
+        "CREATE INDEX IF NOT EXISTS idx_users_active_id ON users(is_active, user_id)",
+        # get_recent_messages: ORDER BY created_at DESC
+        "CREATE INDEX IF NOT EXISTS idx_messages_created_at ON messages(created_at)",
+        # delete_user: sender_id = ? OR recipient_id = ?
+        "CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages(sender_id)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_recipient ON messages(recipient_id)",
+        "CREATE INDEX IF NOT EXISTS idx_broadcasts_sender ON broadcasts(sender_id)",
+        "CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON broadcast_jobs(status)",
+    ]),
+    (4, "Поиск пользователей по началу имени", [
+        # LIKE 'abc%' использует индекс только с NOCASE-коллацией
+        "CREATE INDEX IF NOT EXISTS idx_users_username_nocase ON users(username COLLATE NOCASE)",
+        "CREATE INDEX IF NOT EXISTS idx_users_first_name_nocase ON users(first_name COLLATE NOCASE)",
+    ]),
+    (5, "Счетчики статистики, обновляемые триггерами", [
+        """
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        STATS_REBUILD_SQL,
+        # Активные пользователи
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_users_insert_stats AFTER INSERT ON users
+        WHEN NEW.is_active = 1
+        BEGIN
+            UPDATE stats_counters SET value = value + 1 WHERE name = 'total_users';
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_users_delete_stats AFTER DELETE ON users
+        WHEN OLD.is_active = 1
+        BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'total_users';
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_users_active_stats AFTER UPDATE OF is_active ON users
+        WHEN (OLD.is_active = 1) != (NEW.is_active = 1)
+        BEGIN
+            UPDATE stats_counters
+            SET value = value + CASE WHEN NEW.is_active = 1 THEN 1 ELSE -1 END
+            WHERE name = 'total_users';
+        END
+        """,
+        # Сообщения
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_messages_insert_stats AFTER INSERT ON messages
+        BEGIN
+            UPDATE stats_counters SET value = value + 1 WHERE name = 'total_messages';
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_messages_delete_stats AFTER DELETE ON messages
+        BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'total_messages';
+        END
+        """,
+        # Рассылки
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_broadcasts_insert_stats AFTER INSERT ON broadcasts
+        BEGIN
+            UPDATE stats_counters SET value = value + 1 WHERE name = 'total_broadcasts';
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_broadcasts_delete_stats AFTER DELETE ON broadcasts
+        BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'total_broadcasts';
+        END
+        """,
+    ]),
+    (6, "Хранилище FSM", [
+        """
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            updated_at INTEGER NOT NULL
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_fsm_states_updated ON fsm_states(updated_at)",
+    ]),
+    (7, "Очередь кусков рассылки для воркеров", [
+        # Абсолютный дедлайн рассылки (unix time), переживает рестарты
+        "ALTER TABLE broadcast_jobs ADD COLUMN expires_at INTEGER",
+        # status: queued -> done | failed | cancelled.
+        # Кусок в очереди свободен, если lease_until в прошлом (0 — еще не брали).
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_chunks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id INTEGER NOT NULL,
+            after_user_id INTEGER NOT NULL,
+            last_user_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            worker_id TEXT,
+            lease_until REAL NOT NULL DEFAULT 0,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            successful_sends INTEGER DEFAULT 0,
+            failed_sends INTEGER DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (job_id) REFERENCES broadcast_jobs(id)
+        )
+        """,
+        # claim_broadcast_chunk: status = 'queued' AND lease_until < ?
+        "CREATE INDEX IF NOT EXISTS idx_broadcast_chunks_claim ON broadcast_chunks(status, lease_until)",
+        # finish_broadcast_job: открытые куски рассылки
+        "CREATE INDEX IF NOT EXISTS idx_broadcast_chunks_job ON broadcast_chunks(job_id, status)",
+        _chunk_running_jobs,
+    ]),
+    (8, "Медиа в рассылках", [
+        # content_type: text | photo | video | document | animation | audio | voice;
+        # для медиа message_text — подпись, file_id — файл в Telegram
+        "ALTER TABLE broadcasts ADD COLUMN content_type TEXT NOT NULL DEFAULT 'text'",
+        "ALTER TABLE broadcasts ADD COLUMN file_id TEXT",
+    ]),
+    (9, "Сегменты аудитории", [
+        # definition — фильтры Segment в JSON
+        """
+        CREATE TABLE IF NOT EXISTS segments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,
+            definition TEXT NOT NULL,
+            created_by INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        # Сегмент рассылки: воркер отбирает получателей куска по нему же
+        "ALTER TABLE broadcast_jobs ADD COLUMN segment TEXT",
+        # Segment: joined_after / joined_before
+        "CREATE INDEX IF NOT EXISTS idx_users_active_created ON users(is_active, created_at)",
+        # Segment: contact — покрывающие индексы для обеих сторон переписки;
+        # одиночные индексы по sender_id и recipient_id становятся их префиксами
+        "CREATE INDEX IF NOT EXISTS idx_messages_sender_recipient ON messages(sender_id, recipient_id)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_recipient_sender ON messages(recipient_id, sender_id)",
+        "DROP INDEX IF EXISTS idx_messages_sender",
+        "DROP INDEX IF EXISTS idx_messages_recipient",
+    ]),
+    (10, "Тексты сообщений без дублей", [
+        # Один текст хранится один раз, messages / broadcasts / broadcast_jobs
+        # ссылаются на него по body_id; hash — body_hash() текста
+        """
+        CREATE TABLE IF NOT EXISTS message_bodies (
+            id INTEGER PRIMARY KEY,
+            hash BLOB NOT NULL UNIQUE,
+            body TEXT NOT NULL
+        )
+        """,
+        _move_texts_to_bodies,
+        # Поиск ссылок при удалении осиротевших текстов
+        "CREATE INDEX IF NOT EXISTS idx_messages_body ON messages(body_id)",
+        "CREATE INDEX IF NOT EXISTS idx_broadcasts_body ON broadcasts(body_id)",
+        "CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_body ON broadcast_jobs(body_id)",
+        # История с текстом. Вставка в представление кладет текст в
+        # message_bodies (если его там еще нет) и сообщение со ссылкой на него —
+        # одной командой, которую отложенная запись склеивает в executemany
+        """
+        CREATE VIEW IF NOT EXISTS message_log AS
+        SELECT m.id, m.sender_id, m.recipient_id, m.body_id, b.hash AS body_hash,
+               b.body AS message_text, m.created_at
+        FROM messages m
+        JOIN message_bodies b ON b.id = m.body_id
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_message_log_insert INSTEAD OF INSERT ON message_log
+        BEGIN
+            INSERT OR IGNORE INTO message_bodies (hash, body) VALUES (NEW.body_hash, NEW.message_text);
+            INSERT INTO messages (sender_id, recipient_id, body_id, created_at)
+            VALUES (NEW.sender_id, NEW.recipient_id,
+                    (SELECT id FROM message_bodies WHERE hash = NEW.body_hash),
+                    COALESCE(NEW.created_at, CURRENT_TIMESTAMP));
+        END
+        """,
+    ]),
+    (11, "Полнотекстовый поиск по сообщениям", [
+        # Индекс по текстам, а не по сообщениям: текст рассылки на 50 тысяч
+        # получателей индексируется один раз. Тексты не меняются, поэтому
+        # синхронизация — только вставка и удаление
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS message_bodies_fts USING fts5(
+            body,
+            content = 'message_bodies',
+            content_rowid = 'id',
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+        """,
+        "INSERT INTO message_bodies_fts (message_bodies_fts) VALUES ('rebuild')",
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_message_bodies_fts_insert AFTER INSERT ON message_bodies
+        BEGIN
+            INSERT INTO message_bodies_fts (rowid, body) VALUES (NEW.id, NEW.body);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_message_bodies_fts_delete AFTER DELETE ON message_bodies
+        BEGIN
+            INSERT INTO message_bodies_fts (message_bodies_fts, rowid, body)
+            VALUES ('delete', OLD.id, OLD.body);
+        END
+        """,
+    ]),
+    (12, "Индекс заданий рассылки по отправителю", [
+        # delete_user: задания и их куски удаляемого пользователя
+        "CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_sender ON broadcast_jobs(sender_id)",
+    ]),
+    (13, "Индексы поиска по тексту с фильтром по отправителю и получателю", [
+        # search_messages: последние сообщения найденного текста от отправителя
+        # (кому получателю) без сортировки; idx_messages_body — их префикс
+        "CREATE INDEX IF NOT EXISTS idx_messages_body_sender ON messages(body_id, sender_id)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_body_recipient ON messages(body_id, recipient_id)",
+        "DROP INDEX IF EXISTS idx_messages_body",
+    ]),
+]
+
+
+async def get_schema_version(db: aiosqlite.Connection) -> int:
+    """Текущая версия схемы (0 для новой базы)"""
+    async with db.execute("SELECT MAX(version) FROM schema_version") as cursor:
+        row = await cursor.fetchone()
+        return row[0] or 0
+
+
+async def apply_migrations(db: aiosqlite.Connection) -> int:
+    """Применить недостающие миграции, каждую в своей транзакции"""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    await db.commit()
+
+    current = await get_schema_version(db)
+    for version, description, steps in MIGRATIONS:
+        if version <= current:
+            continue
+
+        try:
+            # DDL в sqlite3 не открывает транзакцию сам, открываем явно.
+            # IMMEDIATE сразу берет блокировку записи: бот и воркеры могут
+            # стартовать одновременно, и миграцию применит только один из них.
+            await db.execute("BEGIN IMMEDIATE")
+            if await get_schema_version(db) >= version:
+                await db.rollback()
+                current = version
+                continue
+            logger.info("Миграция схемы %s: %s", version, description)
+            for step in steps:
+                if callable(step):
+                    await step(db)
+                else:
+                    await db.execute(step)
+            await db.execute(
+                "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                (version, description)
+            )
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+        current = version
+
+    return current
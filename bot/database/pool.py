@@ -0,0 +1,103 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Callable, List, Optional
+
+import aiosqlite
+
+
+# Настройки SQLite для долгоживущих соединений
+PRAGMAS = (
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA synchronous = NORMAL",     # В WAL-режиме fsync только на чекпоинтах
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",      # ~16 МБ кэша страниц на соединение
+    "PRAGMA mmap_size = 134217728",    # 128 МБ memory-mapped I/O
+    "PRAGMA foreign_keys = OFF",
+)
+
+
+class ConnectionPool:
+    """Пул соединений с SQLite: один писатель и несколько читателей.
+
+    Соединения открываются один раз при старте и живут до остановки бота,
+    поэтому запрос не платит за запуск потока и открытие файла.
+    """
+
+    def __init__(self, db_path: str, readers: int = 4):
+        self.db_path = db_path
+        self.readers_count = max(1, readers)
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+        self._readers: List[aiosqlite.Connection] = []
+        self._idle: Optional[asyncio.Queue] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self._writer is not None
+
+    async def _connect(self) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.db_path)
+        conn.row_factory = aiosqlite.Row
+        for pragma in PRAGMAS:
+            async with conn.execute(pragma):
+                pass
+        return conn
+
+    async def open(self):
+        """Открыть писателя и пул читателей"""
+        if self.is_open:
+            return
+
+        self._writer = await self._connect()
+        # Новый файл создается с incremental vacuum (до WAL, который пишет
+        # заголовок базы); у существующей режим так не меняется, ее переводит
+        # Database.enable_incremental_vacuum
+        async with self._writer.execute("PRAGMA auto_vacuum = INCREMENTAL"):
+            pass
+        # WAL позволяет читателям работать параллельно с писателем
+        async with self._writer.execute("PRAGMA journal_mode = WAL"):
+            pass
+
+        self._idle = asyncio.Queue()
+        for _ in range(self.readers_count):
+            conn = await self._connect()
+            self._readers.append(conn)
+            self._idle.put_nowait(conn)
+
+    async def close(self):
+        """Закрыть все соединения"""
+        for conn in self._readers:
+            await conn.close()
+        self._readers.clear()
+        self._idle = None
+
+        if self._writer is not None:
+            await self._writer.close()
+            self._writer = None
+
+    async def set_trace_callback(self, callback: Optional[Callable[[str], None]]):
+        """Передавать callback каждый выполняемый SQL (None — выключить)"""
+        for conn in [self._writer, *self._readers]:
+            await conn.set_trace_callback(callback)
+
+    @asynccontextmanager
+    async def read(self):
+        """Взять соединение для чтения из пула"""
+        conn = await self._idle.get()
+        try:
+            yield conn
+        finally:
+            self._idle.put_nowait(conn)
+
+    @asynccontextmanager
+    async def write(self):
+        """Эксклюзивный доступ к соединению-писателю.
+
+        Коммит остается за вызывающим кодом; при исключении транзакция откатывается.
+        """
+        async with self._write_lock:
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
@@ -0,0 +1,105 @@
+from typing import List, Tuple
+
+from bot.database.segments import parse_date
+
+# Фильтры в тексте команды: ключ=значение среди слов запроса
+SEARCH_HELP = (
+    "from=ID — отправитель\n"
+    "to=ID — получатель\n"
+    "after=ГГГГ-ММ-ДД — отправлено с этой даты\n"
+    "before=ГГГГ-ММ-ДД — отправлено до этой даты\n"
+    "слово* — слова, начинающиеся так"
+)
+
+FILTER_KEYS = {"from": "sender", "to": "recipient", "after": "after", "before": "before"}
+
+
+class MessageSearch:
+    """Поиск по истории сообщений: слова (все обязательны) и фильтры.
+
+    match() — запрос FTS5 по message_bodies_fts, compile() — условие WHERE
+    по messages m. Каждое слово берется в кавычки, поэтому операторы FTS5
+    в тексте админа не ломают запрос.
+    """
+
+    def __init__(self, words: List[str], sender: int = None, recipient: int = None,
+                 after: str = None, before: str = None):
+        words = [word for word in words if word.strip('"*')]
+        if not words:
+            raise ValueError("Нужно хотя бы одно слово для поиска")
+        self.words = words
+        self.sender = sender
+        self.recipient = recipient
+        self.after = parse_date(after) if after else None
+        self.before = parse_date(before) if before else None
+
+    @classmethod
+    def parse(cls, text: str) -> "MessageSearch":
+        """Поиск из строки вида 'оплата счет* from=123 after=2025-01-01'"""
+        words = []
+        kwargs = {}
+        for item in text.split():
+            key, sep, value = item.partition("=")
+            if not sep or key not in FILTER_KEYS:
+                words.append(item)
+            elif key in ("from", "to"):
+                try:
+                    kwargs[FILTER_KEYS[key]] = int(value)
+                except ValueError:
+                    raise ValueError(f"{key} должен быть числом: {value}")
+            else:
+                kwargs[FILTER_KEYS[key]] = value
+        return cls(words, **kwargs)
+
+    def to_dict(self) -> dict:
+        return {key: value for key, value in (
+            ('words', self.words),
+            ('sender', self.sender),
+            ('recipient', self.recipient),
+            ('after', self.after),
+            ('before', self.before),
+        ) if value is not None}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "MessageSearch":
+        return cls(**data)
+
+    def describe(self) -> str:
+        """Описание запроса для админа"""
+        parts = [" ".join(self.words)]
+        if self.sender is not None:
+            parts.append(f"от {self.sender}")
+        if self.recipient is not None:
+            parts.append(f"кому {self.recipient}")
+        if self.after:
+            parts.append(f"с {self.after}")
+        if self.before:
+            parts.append(f"до {self.before}")
+        return ", ".join(parts)
+
+    def match(self) -> str:
+        """Запрос FTS5: слова в кавычках через пробел (И), слово* — по началу"""
+        terms = []
+        for word in self.words:
+            prefix = word.endswith("*")
+            term = '"' + word.strip('"*').replace('"', '""') + '"'
+            terms.append(term + "*" if prefix else term)
+        return " ".join(terms)
+
+    def compile(self) -> Tuple[str, List]:
+        """Условие WHERE по messages m и его параметры"""
+        conditions = []
+        params = []
+        if self.sender is not None:
+            conditions.append("m.sender_id = ?")
+            params.append(self.sender)
+        if self.recipient is not None:
+            conditions.append("m.recipient_id = ?")
+            params.append(self.recipient)
+        if self.after:
+            conditions.append("m.created_at >= ?")
+            params.append(self.after)
+        if self.before:
+            conditions.append("m.created_at < ?")
+            params.append(self.before)
+        return " AND ".join(conditions) or "1", params
@@ -0,0 +1,131 @@
+import json
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+# Фильтры в тексте команды: ключ=значение через пробел
+FILTER_HELP = (
+    "active=N — был активен за последние N дней\n"
+    "joined_after=ГГГГ-ММ-ДД — пришел в бота с этой даты\n"
+    "joined_before=ГГГГ-ММ-ДД — пришел в бота до этой даты\n"
+    "contact=ID — переписывался с админом ID (в любую сторону)\n"
+    "role=admin|user — админы или обычные пользователи"
+)
+
+
+def parse_date(value: str) -> str:
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").strftime("%Y-%m-%d")
+    except ValueError:
+        raise ValueError(f"Дата должна быть в формате ГГГГ-ММ-ДД: {value}")
+
+
+class Segment:
+    """Аудитория рассылки: фильтры по активным пользователям.
+
+    compile() превращает фильтры в одно условие WHERE по таблице users,
+    которое подставляется в запросы выборки, подсчета и нарезки рассылки на
+    куски, — отбор всегда идет в базе, а не в Python.
+    """
+
+    def __init__(self, active_days: int = None, joined_after: str = None,
+                 joined_before: str = None, contact: int = None, role: str = None):
+        if active_days is not None and active_days <= 0:
+            raise ValueError("active должен быть больше нуля")
+        if role not in (None, "admin", "user"):
+            raise ValueError("role может быть admin или user")
+        self.active_days = active_days
+        self.joined_after = parse_date(joined_after) if joined_after else None
+        self.joined_before = parse_date(joined_before) if joined_before else None
+        self.contact = contact
+        self.role = role
+
+    @classmethod
+    def parse(cls, text: str) -> "Segment":
+        """Сегмент из строки вида 'active=7 role=user'"""
+        kwargs = {}
+        for item in text.split():
+            key, sep, value = item.partition("=")
+            if not sep or not value:
+                raise ValueError(f"Ожидается ключ=значение: {item}")
+            if key == "active":
+                kwargs['active_days'] = cls._int(key, value)
+            elif key == "contact":
+                kwargs['contact'] = cls._int(key, value)
+            elif key in ("joined_after", "joined_before", "role"):
+                kwargs[key] = value
+            else:
+                raise ValueError(f"Неизвестный фильтр: {key}")
+        if not kwargs:
+            raise ValueError("Нужен хотя бы один фильтр")
+        return cls(**kwargs)
+
+    @staticmethod
+    def _int(key: str, value: str) -> int:
+        try:
+            return int(value)
+        except ValueError:
+            raise ValueError(f"{key} должен быть числом: {value}")
+
+    def to_dict(self) -> dict:
+        return {key: value for key, value in (
+            ('active_days', self.active_days),
+            ('joined_after', self.joined_after),
+            ('joined_before', self.joined_before),
+            ('contact', self.contact),
+            ('role', self.role),
+        ) if value is not None}
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), sort_keys=True)
+
+    @classmethod
+    def from_json(cls, data: Optional[str]) -> Optional["Segment"]:
+        return cls(**json.loads(data)) if data else None
+
+    def describe(self) -> str:
+        """Описание фильтров для админа"""
+        parts = []
+        if self.active_days is not None:
+            parts.append(f"активны за {self.active_days} дн.")
+        if self.joined_after:
+            parts.append(f"пришли с {self.joined_after}")
+        if self.joined_before:
+            parts.append(f"пришли до {self.joined_before}")
+        if self.contact is not None:
+            parts.append(f"переписывались с {self.contact}")
+        if self.role:
+            parts.append("админы" if self.role == "admin" else "не админы")
+        return ", ".join(parts) or "все активные"
+
+    def compile(self) -> Tuple[str, List]:
+        """Условие WHERE по users (без is_active = 1) и его параметры.
+
+        Даты в users хранятся как 'ГГГГ-ММ-ДД ЧЧ:ММ:СС' (UTC), поэтому
+        сравниваются строками и попадают в индексы (is_active, last_activity)
+        и (is_active, created_at). Подзапросы по messages и admins не
+        коррелированы: SQLite вычисляет их один раз, а не на каждую строку
+        (IN сам убирает дубли, поэтому UNION ALL без сортировки).
+        """
+        conditions = []
+        params = []
+        if self.active_days is not None:
+            conditions.append("last_activity >= datetime('now', ?)")
+            params.append(f"-{self.active_days} days")
+        if self.joined_after:
+            conditions.append("created_at >= ?")
+            params.append(self.joined_after)
+        if self.joined_before:
+            conditions.append("created_at < ?")
+            params.append(self.joined_before)
+        if self.contact is not None:
+            conditions.append("""user_id IN (
+                SELECT recipient_id FROM messages WHERE sender_id = ?
+                UNION ALL
+                SELECT sender_id FROM messages WHERE recipient_id = ?
+            )""")
+            params.extend([self.contact, self.contact])
+        if self.role == "admin":
+            conditions.append("user_id IN (SELECT user_id FROM admins)")
+        elif self.role == "user":
+            conditions.append("user_id NOT IN (SELECT user_id FROM admins)")
+        return " AND ".join(conditions) or "1", params
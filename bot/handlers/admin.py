@@ -1,16 +1,28 @@
+import html
+import re
+
 from aiogram import Router, F
 from aiogram.filters import Command
 from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
-from bot.database.db import Database
+from bot.database.db import SNIPPET_MARKS, Database
+from bot.database.search import SEARCH_HELP, MessageSearch
+from bot.database.segments import FILTER_HELP, Segment
 from bot.utils.permissions import is_super_admin
+from bot.services.jobs import BroadcastJobRunner
 
-router = Router()
+router = Router(name="admin")
 
 SUPER_ADMIN_ID = 803817300  # Твой ID
 
+# Результатов поиска на странице
+SEARCH_PAGE_SIZE = 10
+# Строк на странице списков пользователей и сообщений
+USERS_PAGE_SIZE = 25
+MESSAGES_PAGE_SIZE = 20
+
 
 class AdminStates(StatesGroup):
     deleting_user = State()
@@ -107,84 +119,295 @@ async def admin_stats_callback(callback: CallbackQuery, db: Database):
         await callback.answer("✅ Данные актуальны")
 
 
-@router.callback_query(F.data == "admin_users")
-async def admin_users_list(callback: CallbackQuery, db: Database):
-    """Показать список всех пользователей"""
-    if not is_super_admin(callback.from_user.id):
-        await callback.answer("❌ Доступ запрещен", show_alert=True)
+@router.message(Command("rebuild_stats"))
+async def rebuild_stats_command(message: Message, db: Database):
+    """Пересчитать счетчики статистики с нуля (только для супер админа)"""
+    if not is_super_admin(message.from_user.id):
+        await message.answer("❌ У вас нет доступа к этой команде.")
         return
 
-    users = await db.get_all_users()
+    await message.answer("⏳ Пересчитываю статистику...")
+    before, after = await db.rebuild_stats_counters()
+
+    labels = {
+        'total_users': "👥 Пользователей",
+        'total_messages': "💬 Сообщений",
+        'total_broadcasts': "📤 Рассылок"
+    }
+    text = "✅ <b>Счетчики пересчитаны</b>\n\n"
+    for key, label in labels.items():
+        mark = "" if before[key] == after[key] else f" (было {before[key]})"
+        text += f"{label}: {after[key]}{mark}\n"
+
+    if before == after:
+        text += "\n<i>Расхождений не найдено.</i>"
+
+    await message.answer(text, parse_mode="HTML")
+
+
+async def render_users_page(db: Database, state: FSMContext, **cursor):
+    """Текст и клавиатура страницы списка пользователей, курсоры — в FSM.
+
+    cursor — after/before для get_users_page. None, если страница пуста.
+    Порядок по last_activity сдвигается между страницами (см. render_users_list).
+    """
+    page = await db.get_users_page(limit=USERS_PAGE_SIZE, **cursor)
+    users = page['users']
+    if not users:
+        return None
+
+    data = await state.get_data()
+    start = 1
+    if cursor.get('after'):
+        start = data.get('admin_users_start', 1) + USERS_PAGE_SIZE
+    elif cursor.get('before'):
+        start = max(data.get('admin_users_start', 1) - len(users), 1)
+    await state.update_data(
+        admin_users_first=[users[0]['last_activity'], users[0]['user_id']],
+        admin_users_last=[users[-1]['last_activity'], users[-1]['user_id']],
+        admin_users_start=start
+    )
+    total = await db.count_active_users()
 
     text = "👥 <b>Все пользователи бота:</b>\n\n"
 
-    for i, user in enumerate(users[:50], 1):  # Показываем первых 50
+    for i, user in enumerate(users, start):
         display_name = user.get('username') and f"@{user['username']}" or \
-                      f"{user.get('first_name', '')} {user.get('last_name', '')}".strip() or \
+                      html.escape(f"{user.get('first_name') or ''} {user.get('last_name') or ''}".strip()) or \
                       f"Без имени"
 
         text += f"{i}. {display_name} (ID: {user['user_id']})\n"
         text += f"   └ Последняя активность: {user.get('last_activity', 'неизвестно')}\n\n"
 
-    if len(users) > 50:
-        text += f"\n<i>...и еще {len(users) - 50} пользователей</i>"
+    text += f"\n<b>Всего:</b> {total}"
 
-    text += f"\n\n<b>Всего:</b> {len(users)}"
+    buttons = []
+    navigation = []
+    if page['has_prev']:
+        navigation.append(InlineKeyboardButton(text="◀️ Назад", callback_data="admin_users_prev"))
+    if page['has_next']:
+        navigation.append(InlineKeyboardButton(text="Вперед ▶️", callback_data="admin_users_next"))
+    if navigation:
+        buttons.append(navigation)
+    buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="admin_stats")])
+    return text, InlineKeyboardMarkup(inline_keyboard=buttons)
 
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(text="🔙 Назад", callback_data="admin_stats")
-            ]
-        ]
-    )
 
+@router.callback_query(F.data == "admin_users")
+async def admin_users_list(callback: CallbackQuery, db: Database, state: FSMContext):
+    """Показать список всех пользователей"""
+    if not is_super_admin(callback.from_user.id):
+        await callback.answer("❌ Доступ запрещен", show_alert=True)
+        return
+
+    rendered = await render_users_page(db, state)
+    if rendered is None:
+        await callback.answer("Пользователей пока нет", show_alert=True)
+        return
+
+    text, keyboard = rendered
     await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
     await callback.answer()
 
 
-@router.callback_query(F.data == "admin_messages")
-async def admin_messages_list(callback: CallbackQuery, db: Database):
-    """Показать последние сообщения"""
+@router.callback_query(F.data.in_({"admin_users_next", "admin_users_prev"}))
+async def turn_users_page(callback: CallbackQuery, db: Database, state: FSMContext):
+    """Перейти на следующую/предыдущую страницу списка пользователей"""
     if not is_super_admin(callback.from_user.id):
         await callback.answer("❌ Доступ запрещен", show_alert=True)
         return
 
-    messages = await db.get_recent_messages(limit=20)
+    data = await state.get_data()
+    if callback.data == "admin_users_next":
+        cursor = {'after': data.get('admin_users_last')}
+    else:
+        cursor = {'before': data.get('admin_users_first')}
+    if not any(cursor.values()):
+        await callback.answer("Список устарел, откройте его заново", show_alert=True)
+        return
+
+    rendered = await render_users_page(db, state, **cursor)
+    if rendered is None:
+        await callback.answer("Больше пользователей нет")
+        return
+
+    text, keyboard = rendered
+    await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
+    await callback.answer()
+
+
+async def render_messages_page(db: Database, state: FSMContext, **cursor):
+    """Текст и клавиатура страницы истории сообщений, курсоры — в FSM.
+
+    cursor — after/before для get_messages_page.
+    """
+    page = await db.get_messages_page(limit=MESSAGES_PAGE_SIZE, **cursor)
+    messages = page['messages']
 
     if not messages:
-        text = "📭 Сообщений пока нет."
+        text = "📭 Сообщений пока нет.\n\n"
     else:
-        text = "💬 <b>Последние 20 сообщений:</b>\n\n"
+        await state.update_data(
+            admin_messages_first=[messages[0]['created_at'], messages[0]['id']],
+            admin_messages_last=[messages[-1]['created_at'], messages[-1]['id']]
+        )
+        text = "💬 <b>Сообщения, от новых к старым:</b>\n\n"
 
-        for i, msg in enumerate(messages, 1):
+        for msg in messages:
             sender = msg.get('sender_username') and f"@{msg['sender_username']}" or \
-                    msg.get('sender_first_name', 'Неизвестно')
+                    html.escape(msg.get('sender_first_name') or 'Неизвестно')
             recipient = msg.get('recipient_username') and f"@{msg['recipient_username']}" or \
-                       msg.get('recipient_first_name', 'Неизвестно')
+                       html.escape(msg.get('recipient_first_name') or 'Неизвестно')
 
-            message_preview = msg.get('message_text', '')[:50]
-            if len(msg.get('message_text', '')) > 50:
+            message_text = msg.get('message_text') or ''
+            message_preview = html.escape(message_text[:50])
+            if len(message_text) > 50:
                 message_preview += "..."
 
-            text += f"{i}. {sender} → {recipient}\n"
+            text += f"{sender} → {recipient}\n"
             text += f"   📝 {message_preview}\n"
             text += f"   🕐 {msg.get('created_at', 'неизвестно')}\n\n"
 
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(text="🔙 Назад", callback_data="admin_stats")
-            ]
-        ]
-    )
+    text += "🔎 Поиск по истории: <code>/search слова</code>"
+
+    buttons = []
+    navigation = []
+    if messages and page['has_prev']:
+        navigation.append(InlineKeyboardButton(text="◀️ Новее", callback_data="admin_messages_prev"))
+    if messages and page['has_next']:
+        navigation.append(InlineKeyboardButton(text="Старше ▶️", callback_data="admin_messages_next"))
+    if navigation:
+        buttons.append(navigation)
+    buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="admin_stats")])
+    return text, InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+@router.callback_query(F.data == "admin_messages")
+async def admin_messages_list(callback: CallbackQuery, db: Database, state: FSMContext):
+    """Показать последние сообщения"""
+    if not is_super_admin(callback.from_user.id):
+        await callback.answer("❌ Доступ запрещен", show_alert=True)
+        return
+
+    text, keyboard = await render_messages_page(db, state)
+    await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
+    await callback.answer()
+
+
+@router.callback_query(F.data.in_({"admin_messages_next", "admin_messages_prev"}))
+async def turn_messages_page(callback: CallbackQuery, db: Database, state: FSMContext):
+    """Перейти к более старым/новым сообщениям"""
+    if not is_super_admin(callback.from_user.id):
+        await callback.answer("❌ Доступ запрещен", show_alert=True)
+        return
+
+    data = await state.get_data()
+    if callback.data == "admin_messages_next":
+        cursor = {'after': data.get('admin_messages_last')}
+    else:
+        cursor = {'before': data.get('admin_messages_first')}
+    if not any(cursor.values()):
+        await callback.answer("Список устарел, откройте его заново", show_alert=True)
+        return
+
+    text, keyboard = await render_messages_page(db, state, **cursor)
+    await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
+    await callback.answer()
+
+
+def format_snippet(snippet: str) -> str:
+    """Фрагмент текста из поиска: экранированный, найденные слова жирным"""
+    start, end = SNIPPET_MARKS
+    return html.escape(snippet).replace(start, "<b>").replace(end, "</b>")
+
+
+async def render_search_page(db: Database, search: MessageSearch, page: int):
+    """Текст и клавиатура страницы результатов поиска (page с нуля)"""
+    # Лишняя строка — признак следующей страницы
+    found = await db.search_messages(search, limit=SEARCH_PAGE_SIZE + 1,
+                                     offset=page * SEARCH_PAGE_SIZE)
+    has_next = len(found) > SEARCH_PAGE_SIZE
+    found = found[:SEARCH_PAGE_SIZE]
+
+    query = html.escape(search.describe())
+    if not found:
+        return f"🔎 По запросу «{query}» ничего не найдено.", None
+
+    text = f"🔎 <b>Поиск:</b> {query}\nСтраница {page + 1}\n\n"
+    for i, msg in enumerate(found, page * SEARCH_PAGE_SIZE + 1):
+        sender = msg.get('sender_username') and f"@{msg['sender_username']}" or \
+                 html.escape(msg.get('sender_first_name') or str(msg['sender_id']))
+        recipient = msg.get('recipient_username') and f"@{msg['recipient_username']}" or \
+                    html.escape(msg.get('recipient_first_name') or str(msg['recipient_id']))
+        text += f"{i}. {sender} → {recipient}\n"
+        text += f"   📝 {format_snippet(msg['snippet'])}\n"
+        text += f"   🕐 {msg['created_at']}\n\n"
+
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton(text="◀️ Назад", callback_data="search_prev"))
+    if has_next:
+        navigation.append(InlineKeyboardButton(text="Вперед ▶️", callback_data="search_next"))
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[navigation]) if navigation else None
+    return text, keyboard
+
+
+@router.message(Command("search"))
+async def search_command(message: Message, db: Database, state: FSMContext):
+    """Поиск по истории сообщений (только для супер админа)"""
+    if not is_super_admin(message.from_user.id):
+        await message.answer("❌ У вас нет доступа к этой команде.")
+        return
+
+    args = message.text.split(maxsplit=1)
+
+    if len(args) < 2:
+        await message.answer(
+            "🔎 <b>Поиск по истории сообщений</b>\n\n"
+            "Используйте команду:\n"
+            "<code>/search слова фильтр=значение ...</code>\n\n"
+            "Например: <code>/search оплата счет* from=123 after=2025-01-01</code>\n\n"
+            f"<b>Фильтры:</b>\n{SEARCH_HELP}",
+            parse_mode="HTML"
+        )
+        return
+
+    try:
+        search = MessageSearch.parse(args[1])
+    except ValueError as e:
+        await message.answer(f"❌ {html.escape(str(e))}")
+        return
+
+    # Запрос хранится в FSM, кнопки листают его по номеру страницы
+    await state.update_data(search=search.to_dict(), search_page=0)
+    text, keyboard = await render_search_page(db, search, 0)
+    await message.answer(text, reply_markup=keyboard, parse_mode="HTML")
+
+
+@router.callback_query(F.data.in_({"search_next", "search_prev"}))
+async def turn_search_page(callback: CallbackQuery, db: Database, state: FSMContext):
+    """Перейти на следующую/предыдущую страницу результатов поиска"""
+    if not is_super_admin(callback.from_user.id):
+        await callback.answer("❌ Доступ запрещен", show_alert=True)
+        return
+
+    data = await state.get_data()
+    if not data.get('search'):
+        await callback.answer("Поиск устарел, повторите /search", show_alert=True)
+        return
+
+    page = data.get('search_page', 0) + (1 if callback.data == "search_next" else -1)
+    page = max(page, 0)
+    search = MessageSearch.from_dict(data['search'])
+    text, keyboard = await render_search_page(db, search, page)
+    await state.update_data(search_page=page)
 
     await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
     await callback.answer()
 
 
 @router.message(Command("broadcast_all"))
-async def admin_broadcast(message: Message, db: Database):
+async def admin_broadcast(message: Message, db: Database, jobs: BroadcastJobRunner):
     """Рассылка всем пользователям (только для супер админа)"""
     if not is_super_admin(message.from_user.id):
         await message.answer("❌ У вас нет доступа к этой команде.")
@@ -197,19 +420,150 @@ async def admin_broadcast(message: Message, db: Database):
         await message.answer(
             "📢 <b>Рассылка всем пользователям</b>\n\n"
             "Используйте команду:\n"
-            "<code>/broadcast_all текст сообщения</code>",
+            "<code>/broadcast_all текст сообщения</code>\n\n"
+            "Подстановки: {first_name}, {last_name}, {full_name}, {username}",
             parse_mode="HTML"
         )
         return
 
-    users = await db.get_all_users()
+    # Получателей выбирает воркер по кускам, здесь нужно только их число
+    total = await db.count_active_users()
+
+    # Рассылка идет в фоне и переживает рестарт бота
+    job_id = await jobs.start(message.from_user.id, text, total)
+
+    await message.answer(
+        f"⏳ Рассылка #{job_id} запущена для {total} пользователей.\n\n"
+        f"Отчет придет по завершении."
+    )
+
+
+# Имя сегмента: буквы, цифры, _ и -
+SEGMENT_NAME = re.compile(r"^[\w-]{1,32}$")
+
+
+@router.message(Command("segment_save"))
+async def segment_save_command(message: Message, db: Database):
+    """Сохранить сегмент аудитории (только для супер админа)"""
+    if not is_super_admin(message.from_user.id):
+        await message.answer("❌ У вас нет доступа к этой команде.")
+        return
+
+    args = message.text.split(maxsplit=2)
+
+    if len(args) < 3 or not SEGMENT_NAME.match(args[1]):
+        await message.answer(
+            "🎯 <b>Сохранение сегмента</b>\n\n"
+            "Используйте команду:\n"
+            "<code>/segment_save ИМЯ фильтр=значение ...</code>\n\n"
+            "Например: <code>/segment_save new_active active=7 joined_after=2025-01-01</code>\n\n"
+            f"<b>Фильтры:</b>\n{FILTER_HELP}",
+            parse_mode="HTML"
+        )
+        return
+
+    try:
+        segment = Segment.parse(args[2])
+    except ValueError as e:
+        await message.answer(f"❌ {html.escape(str(e))}")
+        return
+
+    await db.save_segment(args[1], segment, message.from_user.id)
+    count = await db.count_segment_users(segment)
+
+    await message.answer(
+        f"✅ Сегмент <b>{args[1]}</b> сохранен: {segment.describe()}.\n\n"
+        f"👥 Сейчас в нем {count} пользователей.",
+        parse_mode="HTML"
+    )
+
+
+@router.message(Command("segments"))
+async def segments_command(message: Message, db: Database):
+    """Список сохраненных сегментов (только для супер админа)"""
+    if not is_super_admin(message.from_user.id):
+        await message.answer("❌ У вас нет доступа к этой команде.")
+        return
+
+    segments = await db.get_all_segments()
+
+    if not segments:
+        await message.answer(
+            "🎯 Сегментов пока нет.\n\n"
+            "Создайте: <code>/segment_save ИМЯ фильтр=значение ...</code>",
+            parse_mode="HTML"
+        )
+        return
+
+    text = "🎯 <b>Сегменты:</b>\n\n"
+    for row in segments:
+        segment = Segment.from_json(row['definition'])
+        count = await db.count_segment_users(segment)
+        text += f"• <b>{row['name']}</b> — {segment.describe()} ({count} польз.)\n"
+    text += "\nРассылка: <code>/broadcast_segment ИМЯ текст</code>"
+
+    await message.answer(text, parse_mode="HTML")
+
+
+@router.message(Command("segment_delete"))
+async def segment_delete_command(message: Message, db: Database):
+    """Удалить сохраненный сегмент (только для супер админа)"""
+    if not is_super_admin(message.from_user.id):
+        await message.answer("❌ У вас нет доступа к этой команде.")
+        return
+
+    args = message.text.split()
+
+    if len(args) < 2:
+        await message.answer(
+            "Используйте команду: <code>/segment_delete ИМЯ</code>",
+            parse_mode="HTML"
+        )
+        return
+
+    name = html.escape(args[1])
+    if await db.delete_segment(args[1]):
+        await message.answer(f"✅ Сегмент {name} удален.")
+    else:
+        await message.answer(f"❌ Сегмент {name} не найден.")
+
+
+@router.message(Command("broadcast_segment"))
+async def broadcast_segment_command(message: Message, db: Database, jobs: BroadcastJobRunner):
+    """Рассылка пользователям сегмента (только для супер админа)"""
+    if not is_super_admin(message.from_user.id):
+        await message.answer("❌ У вас нет доступа к этой команде.")
+        return
+
+    args = message.text.split(maxsplit=2)
+
+    if len(args) < 3:
+        await message.answer(
+            "🎯 <b>Рассылка сегменту</b>\n\n"
+            "Используйте команду:\n"
+            "<code>/broadcast_segment ИМЯ текст сообщения</code>\n\n"
+            "Список сегментов: /segments",
+            parse_mode="HTML"
+        )
+        return
+
+    name = html.escape(args[1])
+    segment = await db.get_segment(args[1])
+    if segment is None:
+        await message.answer(f"❌ Сегмент {name} не найден. Список: /segments")
+        return
+
+    count = await db.count_segment_users(segment)
+    if not count:
+        await message.answer(f"❌ В сегменте {name} сейчас нет пользователей.")
+        return
 
-    await message.answer(f"⏳ Отправляю рассылку {len(users)} пользователям...")
+    # Получатели отбираются в базе по условию сегмента, кусками
+    job_id = await jobs.start(message.from_user.id, args[2], count, segment=segment)
 
-    # TODO: Реализовать рассылку
     await message.answer(
-        f"✅ Функция в разработке.\n"
-        f"Планируется отправить сообщение {len(users)} пользователям."
+        f"⏳ Рассылка #{job_id} запущена для сегмента {name} ({count} пользователей).\n\n"
+        f"Отчет придет по завершении."
     )
 
 
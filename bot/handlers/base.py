@@ -7,18 +7,13 @@ from bot.keyboards.main_kb import get_main_keyboard
 from bot.database.db import Database
 from bot.utils.permissions import can_send_messages, get_user_role
 
-router = Router()
+router = Router(name="base")
 
 
 @router.message(CommandStart())
 async def cmd_start(message: Message, db: Database):
     """Обработчик команды /start"""
-    await db.add_user(
-        user_id=message.from_user.id,
-        username=message.from_user.username,
-        first_name=message.from_user.first_name,
-        last_name=message.from_user.last_name
-    )
+    # Пользователя записывает в базу ActivityTracker (по любому апдейту)
 
     # Проверяем роль пользователя для отображения правильного меню
     user_can_send = await can_send_messages(message.from_user.id, db)
@@ -82,6 +77,7 @@ async def cmd_help(message: Message, db: Database):
 /remove_admin USER_ID - Удалить админа
 /delete_user USER_ID - Удалить пользователя
 /broadcast_all - Рассылка всем
+/rebuild_stats - Пересчитать статистику
 /start - Начать работу
 /help - Показать помощь
 /stats - Статистика
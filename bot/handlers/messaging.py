@@ -1,14 +1,27 @@
-import asyncio
+import time
+from typing import Optional
+
 from aiogram import Router, F, Bot
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
-from bot.keyboards.main_kb import get_user_list_keyboard, get_cancel_keyboard, get_confirm_keyboard
+from bot.keyboards.main_kb import (
+    get_user_picker_keyboard, get_display_name, get_cancel_keyboard, get_confirm_keyboard
+)
 from bot.database.db import Database
 from bot.utils.permissions import can_send_messages
+from bot.services.broadcaster import Broadcaster
+from bot.services.content import CAPTION_LIMIT, extract_content, send_content
+from bot.services.templates import MessageTemplate
+
+router = Router(name="messaging")
+
+# Сколько секунд рассылка может повторять неудачные отправки
+SEND_DEADLINE = 600
 
-router = Router()
+# Сколько пользователей показывать на одной странице выбора
+PICKER_PAGE_SIZE = 10
 
 
 class MessageStates(StatesGroup):
@@ -32,6 +45,56 @@ def get_reply_keyboard(sender_id: int) -> InlineKeyboardMarkup:
     return keyboard
 
 
+def outgoing_template(sender_name: str, message_text: str) -> MessageTemplate:
+    """Сообщение (или подпись к медиа) в том виде, в каком его получат.
+
+    Подстановки ищутся только в тексте админа, не в шапке.
+    """
+    return MessageTemplate(
+        message_text,
+        prefix=f"━━━━━━━━━━━━━━━━\n📨 <b>Сообщение от {sender_name}</b>\n\n",
+        suffix="\n\n━━━━━━━━━━━━━━━━\n"
+    )
+
+
+def render_picker(data: dict) -> InlineKeyboardMarkup:
+    """Клавиатура выбора получателей из снимка страницы в FSM (без запросов к БД)"""
+    return get_user_picker_keyboard(
+        data.get('picker_page', []),
+        data.get('selected_users', []),
+        has_prev=data.get('picker_has_prev', False),
+        has_next=data.get('picker_has_next', False),
+        query=data.get('picker_query')
+    )
+
+
+async def load_picker_page(state: FSMContext, db: Database, user_id: int,
+                           **cursor) -> Optional[InlineKeyboardMarkup]:
+    """Загрузить страницу выбора получателей и сохранить ее снимок в FSM.
+
+    Порядок по last_activity сдвигается между страницами (см. render_users_list).
+    """
+    data = await state.get_data()
+    page = await db.get_users_page(
+        limit=PICKER_PAGE_SIZE,
+        exclude_user_id=user_id,
+        query=data.get('picker_query'),
+        **cursor
+    )
+    users = page['users']
+    if not users:
+        return None
+
+    data = await state.update_data(
+        picker_page=[[user['user_id'], get_display_name(user)] for user in users],
+        picker_first=[users[0]['last_activity'], users[0]['user_id']],
+        picker_last=[users[-1]['last_activity'], users[-1]['user_id']],
+        picker_has_prev=page['has_prev'],
+        picker_has_next=page['has_next']
+    )
+    return render_picker(data)
+
+
 @router.message(F.text == "📤 Отправить сообщение")
 async def start_messaging(message: Message, state: FSMContext, db: Database):
     """Начать процесс отправки сообщения"""
@@ -43,31 +106,32 @@ async def start_messaging(message: Message, state: FSMContext, db: Database):
         )
         return
 
-    users = await db.get_all_users(exclude_user_id=message.from_user.id)
+    # Инициализируем данные
+    await state.set_data({'selected_users': [], 'picker_query': None})
+    keyboard = await load_picker_page(state, db, message.from_user.id)
 
-    if not users:
+    if keyboard is None:
+        await state.clear()
         await message.answer(
             "❌ В боте пока нет других пользователей.\n\n"
             "Пригласите друзей написать боту /start!"
         )
         return
 
-    # Инициализируем данные
-    await state.update_data(selected_users=[])
-
     await message.answer(
         "📤 <b>Отправка сообщения</b>\n\n"
         "1️⃣ Выберите получателей из списка.\n"
-        "Нажмите на пользователя для выбора/отмены.\n\n"
+        "Нажмите на пользователя для выбора/отмены.\n"
+        "🔎 Для поиска отправьте начало username или имени.\n\n"
         "После выбора нажмите '✅ Готово'",
-        reply_markup=get_user_list_keyboard(users),
+        reply_markup=keyboard,
         parse_mode="HTML"
     )
     await state.set_state(MessageStates.selecting_recipients)
 
 
 @router.callback_query(MessageStates.selecting_recipients, F.data.startswith("toggle_user_"))
-async def toggle_user(callback: CallbackQuery, state: FSMContext, db: Database):
+async def toggle_user(callback: CallbackQuery, state: FSMContext):
     """Переключить выбор пользователя"""
     user_id = int(callback.data.split("_")[2])
     data = await state.get_data()
@@ -80,36 +144,60 @@ async def toggle_user(callback: CallbackQuery, state: FSMContext, db: Database):
         selected.append(user_id)
         action = "добавлен в"
 
-    await state.update_data(selected_users=selected)
+    data = await state.update_data(selected_users=selected)
 
-    # Обновляем клавиатуру
-    users = await db.get_all_users(exclude_user_id=callback.from_user.id)
-    buttons = []
-
-    for user in users:
-        display_name = user.get('username') and f"@{user['username']}" or \
-                      f"{user.get('first_name', '')} {user.get('last_name', '')}".strip() or \
-                      f"ID: {user['user_id']}"
+    # Перерисовываем текущую страницу из снимка, без запросов к БД
+    await callback.message.edit_reply_markup(reply_markup=render_picker(data))
+    await callback.answer(f"Пользователь {action} список")
 
-        checkbox = "☑" if user['user_id'] in selected else "☐"
-        buttons.append([
-            InlineKeyboardButton(
-                text=f"{checkbox} {display_name}",
-                callback_data=f"toggle_user_{user['user_id']}"
-            )
-        ])
 
-    buttons.append([
-        InlineKeyboardButton(text=f"✅ Готово ({len(selected)} выбрано)", callback_data="done_selecting_users")
-    ])
-    buttons.append([
-        InlineKeyboardButton(text="❌ Отменить", callback_data="cancel")
-    ])
+@router.callback_query(MessageStates.selecting_recipients, F.data.in_({"picker_next", "picker_prev"}))
+async def turn_picker_page(callback: CallbackQuery, state: FSMContext, db: Database):
+    """Перейти на следующую/предыдущую страницу списка"""
+    data = await state.get_data()
+    if callback.data == "picker_next":
+        cursor = {'after': data.get('picker_last')}
+    else:
+        cursor = {'before': data.get('picker_first')}
 
-    keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
+    keyboard = await load_picker_page(state, db, callback.from_user.id, **cursor)
+    if keyboard is None:
+        await callback.answer("Больше пользователей нет")
+        return
 
     await callback.message.edit_reply_markup(reply_markup=keyboard)
-    await callback.answer(f"Пользователь {action} список")
+    await callback.answer()
+
+
+@router.message(MessageStates.selecting_recipients, F.text)
+async def search_recipients(message: Message, state: FSMContext, db: Database):
+    """Поиск получателей по началу username или имени"""
+    data = await state.get_data()
+    query = message.text.strip().lstrip("@")[:32]
+
+    await state.update_data(picker_query=query or None)
+    keyboard = await load_picker_page(state, db, message.from_user.id)
+
+    if keyboard is None:
+        await state.update_data(picker_query=data.get('picker_query'))
+        await message.answer(f"🔎 По запросу «{query}» никого не найдено.")
+        return
+
+    await message.answer(
+        f"🔎 Результаты поиска «{query}»:",
+        reply_markup=keyboard
+    )
+
+
+@router.callback_query(MessageStates.selecting_recipients, F.data == "picker_reset")
+async def reset_recipients_search(callback: CallbackQuery, state: FSMContext, db: Database):
+    """Сбросить поиск и вернуться к полному списку"""
+    await state.update_data(picker_query=None)
+    keyboard = await load_picker_page(state, db, callback.from_user.id)
+
+    if keyboard is not None:
+        await callback.message.edit_reply_markup(reply_markup=keyboard)
+    await callback.answer()
 
 
 @router.callback_query(MessageStates.selecting_recipients, F.data == "done_selecting_users")
@@ -128,7 +216,9 @@ async def done_selecting_users(callback: CallbackQuery, state: FSMContext):
         "💡 Поддерживается:\n"
         "• Форматирование текста\n"
         "• Ссылки\n"
-        "• Эмодзи",
+        "• Эмодзи\n"
+        "• Фото, видео, документы, GIF, аудио и голосовые (с подписью)\n"
+        "• Подстановки: {first_name}, {last_name}, {full_name}, {username}",
         reply_markup=get_cancel_keyboard(),
         parse_mode="HTML"
     )
@@ -136,46 +226,93 @@ async def done_selecting_users(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@router.message(MessageStates.entering_message, F.text)
-async def enter_message_text(message: Message, state: FSMContext, db: Database):
-    """Получить текст сообщения"""
-    message_text = message.text
+@router.message(MessageStates.entering_message,
+                F.text | F.photo | F.video | F.document | F.animation | F.audio | F.voice)
+async def enter_message_text(message: Message, state: FSMContext, bot: Bot):
+    """Получить текст сообщения или медиа с подписью"""
+    content = extract_content(message)
+    message_text = content['text']
 
-    # Сохраняем текст
-    await state.update_data(message_text=message_text)
+    # Получаем имя отправителя для предпросмотра
+    sender_name = message.from_user.username and f"@{message.from_user.username}" or message.from_user.first_name
+    # Подстановки в предпросмотре — данными самого админа
+    me = {
+        'user_id': message.from_user.id,
+        'username': message.from_user.username,
+        'first_name': message.from_user.first_name,
+        'last_name': message.from_user.last_name
+    }
+    template = outgoing_template(sender_name, message_text)
+
+    # Подпись должна влезть в лимит у любого получателя, а не только с
+    # данными админа: подстановки считаются наибольшей длины
+    if content['content_type'] != "text" and template.max_length() > CAPTION_LIMIT:
+        hint = (f"С подстановками она может занять до {template.max_length()} "
+                f"символов из {CAPTION_LIMIT}.\n\n" if template.is_personal else "")
+        await message.answer(
+            "❌ Подпись слишком длинная для медиа.\n\n" + hint +
+            "Сократите ее и отправьте файл еще раз."
+        )
+        return
 
-    data = await state.get_data()
+    # Сохраняем текст и ссылку на файл (сам файл уже лежит в Telegram)
+    data = await state.update_data(
+        message_text=message_text,
+        content_type=content['content_type'],
+        file_id=content['file_id']
+    )
     selected_count = len(data.get('selected_users', []))
 
-    # Получаем имя отправителя для предпросмотра
-    sender_name = message.from_user.username and f"@{message.from_user.username}" or message.from_user.first_name
+    question = (f"\n\n📊 Будет отправлено <b>{selected_count}</b> получателям.\n\n"
+                "❓ Отправить?")
+    if template.is_personal:
+        question = "\n\n<i>Подстановки показаны с вашими данными.</i>" + question
 
-    preview = f"""
+    if content['content_type'] == "text":
+        preview = f"""
 ━━━━━━━━━━━━━━━━
 📨 <b>Сообщение от {sender_name}</b>
 
-{message_text}
+{MessageTemplate(message_text).render(me)}
 
 ━━━━━━━━━━━━━━━━
 <i>Отправлено через бота</i>
     """
+        await message.answer(
+            "📝 <b>Предпросмотр сообщения:</b>\n\n" + preview + question,
+            reply_markup=get_confirm_keyboard(),
+            parse_mode="HTML"
+        )
+    else:
+        # Предпросмотр медиа — то же сообщение, которое получат пользователи
+        await send_content(bot, message.chat.id, content['content_type'], content['file_id'],
+                           template.render(me))
+        await message.answer(
+            "📝 <b>Предпросмотр сообщения выше.</b>" + question,
+            reply_markup=get_confirm_keyboard(),
+            parse_mode="HTML"
+        )
+    await state.set_state(MessageStates.confirming)
 
+
+@router.message(MessageStates.entering_message)
+async def enter_unsupported_message(message: Message):
+    """Стикеры, кружки и т.п. разослать нельзя"""
     await message.answer(
-        "📝 <b>Предпросмотр сообщения:</b>\n\n" + preview +
-        f"\n\n📊 Будет отправлено <b>{selected_count}</b> получателям.\n\n"
-        "❓ Отправить?",
-        reply_markup=get_confirm_keyboard(),
-        parse_mode="HTML"
+        "❌ Такой тип сообщения не поддерживается.\n\n"
+        "Отправьте текст, фото, видео, документ, GIF, аудио или голосовое."
     )
-    await state.set_state(MessageStates.confirming)
 
 
 @router.callback_query(MessageStates.confirming, F.data == "confirm_yes")
-async def confirm_send(callback: CallbackQuery, state: FSMContext, db: Database, bot: Bot):
+async def confirm_send(callback: CallbackQuery, state: FSMContext, db: Database, bot: Bot,
+                       broadcaster: Broadcaster):
     """Подтвердить и отправить сообщения"""
     data = await state.get_data()
     selected_users = data.get('selected_users', [])
     message_text = data.get('message_text')
+    content_type = data.get('content_type', "text")
+    file_id = data.get('file_id')
 
     await callback.message.edit_text(
         "⏳ Отправляю сообщения...\n"
@@ -187,48 +324,42 @@ async def confirm_send(callback: CallbackQuery, state: FSMContext, db: Database,
     sender = await db.get_user_by_id(callback.from_user.id)
     sender_name = sender.get('username') and f"@{sender['username']}" or sender.get('first_name')
 
-    # Форматируем сообщение
-    formatted_message = f"""━━━━━━━━━━━━━━━━
-📨 <b>Сообщение от {sender_name}</b>
-
-{message_text}
-
-━━━━━━━━━━━━━━━━
-"""
+    # Шаблон разбирается один раз; если в нем есть подстановки, данные всех
+    # получателей берутся одной выборкой, а тексты собираются до отправки
+    template = outgoing_template(sender_name, message_text)
+    users = await db.get_users_by_ids(selected_users) if template.is_personal else {}
+    texts = template.render_many(selected_users, users)
 
     # Создаем запись о рассылке
     broadcast_id = await db.add_broadcast(
         sender_id=callback.from_user.id,
         message_text=message_text,
-        total_recipients=len(selected_users)
+        total_recipients=len(selected_users),
+        content_type=content_type,
+        file_id=file_id
     )
 
+    # Клавиатура одинаковая для всех получателей
+    reply_markup = get_reply_keyboard(callback.from_user.id)
+
+    async def send(user_id: int):
+        # Отправляем с кнопкой "Ответить"; медиа — по file_id, без повторной загрузки
+        await send_content(bot, user_id, content_type, file_id, texts[user_id],
+                           reply_markup=reply_markup)
+        # Сохраняем в историю шаблон, а не texts[user_id] (см. queue_message)
+        db.queue_message(callback.from_user.id, user_id, message_text)
+
     # Отправляем сообщения
-    successful = 0
-    failed = 0
-    failed_users = []
+    result = await broadcaster.run(selected_users, send, deadline=time.monotonic() + SEND_DEADLINE)
+    successful = len(result.successful)
+    failed = len(result.failed)
 
-    for user_id in selected_users:
-        try:
-            # Отправляем с кнопкой "Ответить"
-            await bot.send_message(
-                chat_id=user_id,
-                text=formatted_message,
-                reply_markup=get_reply_keyboard(callback.from_user.id),
-                parse_mode="HTML"
-            )
-            # Сохраняем в историю
-            await db.add_message(callback.from_user.id, user_id, message_text)
-            successful += 1
-            # Задержка между сообщениями
-            await asyncio.sleep(0.5)
-        except Exception as e:
-            failed += 1
-            user = await db.get_user_by_id(user_id)
-            if user:
-                display_name = user.get('username') and f"@{user['username']}" or \
-                              user.get('first_name') or f"ID: {user_id}"
-                failed_users.append(display_name)
+    failed_users = []
+    for user_id in result.failed[:5]:
+        user = users.get(user_id) or await db.get_user_by_id(user_id)
+        display_name = user and (user.get('username') and f"@{user['username']}" or
+                                 user.get('first_name')) or f"ID: {user_id}"
+        failed_users.append(display_name)
 
     # Обновляем статистику
     await db.update_broadcast_stats(broadcast_id, successful, failed)
@@ -244,10 +375,10 @@ async def confirm_send(callback: CallbackQuery, state: FSMContext, db: Database,
 
     if failed_users:
         report += f"\n\n❌ <b>Не удалось отправить:</b>\n"
-        for user in failed_users[:5]:
+        for user in failed_users:
             report += f"• {user}\n"
-        if len(failed_users) > 5:
-            report += f"... и еще {len(failed_users) - 5}"
+        if failed > 5:
+            report += f"... и еще {failed - 5}"
 
     await callback.message.edit_text(report, parse_mode="HTML")
     await state.clear()
@@ -1,57 +1,96 @@
+import html
+
 from aiogram import Router, F
-from aiogram.types import Message, CallbackQuery
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
 
-from bot.keyboards.main_kb import get_user_list_keyboard
 from bot.database.db import Database
 
-router = Router()
+router = Router(name="users")
 
+# Пользователей на странице списка
+USERS_PAGE_SIZE = 20
 
-@router.message(F.text == "👥 Список пользователей")
-async def show_users_list(message: Message, db: Database):
-    """Показать список всех пользователей бота"""
-    # Получаем всех пользователей кроме текущего
-    users = await db.get_all_users(exclude_user_id=message.from_user.id)
 
+async def render_users_list(db: Database, state: FSMContext, user_id: int, **cursor):
+    """Текст и клавиатура страницы списка пользователей, курсоры — в FSM.
+
+    cursor — after/before для get_users_page. None, если страница пуста.
+    Список упорядочен по last_activity, которая меняется, пока его листают:
+    пользователь, написавший боту между страницами, уходит в начало списка и
+    может пропасть из следующих страниц или повториться при листании назад.
+    """
+    page = await db.get_users_page(limit=USERS_PAGE_SIZE, exclude_user_id=user_id, **cursor)
+    users = page['users']
     if not users:
-        await message.answer(
-            "📭 В боте пока нет других пользователей.\n\n"
-            "Пригласите друзей написать боту /start!"
-        )
-        return
+        return None
+
+    data = await state.get_data()
+    start = 1
+    if cursor.get('after'):
+        start = data.get('users_list_start', 1) + USERS_PAGE_SIZE
+    elif cursor.get('before'):
+        start = max(data.get('users_list_start', 1) - len(users), 1)
+    await state.update_data(
+        users_list_first=[users[0]['last_activity'], users[0]['user_id']],
+        users_list_last=[users[-1]['last_activity'], users[-1]['user_id']],
+        users_list_start=start
+    )
+    total = await db.count_active_users(exclude_user_id=user_id)
 
     text = "👥 <b>Пользователи бота:</b>\n\n"
-    for i, user in enumerate(users[:20], 1):  # Показываем первых 20
+    for i, user in enumerate(users, start):
         display_name = user.get('username') and f"@{user['username']}" or \
-                      f"{user.get('first_name', '')} {user.get('last_name', '')}".strip() or \
+                      html.escape(f"{user.get('first_name') or ''} {user.get('last_name') or ''}".strip()) or \
                       f"ID: {user['user_id']}"
 
         text += f"{i}. {display_name}\n"
 
-    if len(users) > 20:
-        text += f"\n<i>...и еще {len(users) - 20} пользователей</i>"
+    text += f"\n<b>Всего:</b> {total} пользователей"
+
+    navigation = []
+    if page['has_prev']:
+        navigation.append(InlineKeyboardButton(text="◀️ Назад", callback_data="users_list_prev"))
+    if page['has_next']:
+        navigation.append(InlineKeyboardButton(text="Вперед ▶️", callback_data="users_list_next"))
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[navigation]) if navigation else None
+    return text, keyboard
 
-    text += f"\n\n<b>Всего:</b> {len(users)} пользователей"
 
-    await message.answer(text, parse_mode="HTML")
+@router.message(F.text == "👥 Список пользователей")
+async def show_users_list(message: Message, db: Database, state: FSMContext):
+    """Показать список всех пользователей бота"""
+    rendered = await render_users_list(db, state, message.from_user.id)
+
+    if rendered is None:
+        await message.answer(
+            "📭 В боте пока нет других пользователей.\n\n"
+            "Пригласите друзей написать боту /start!"
+        )
+        return
 
+    text, keyboard = rendered
+    await message.answer(text, reply_markup=keyboard, parse_mode="HTML")
 
-@router.callback_query(F.data == "show_users")
-async def callback_show_users(callback: CallbackQuery, db: Database):
-    """Показать список пользователей через callback"""
-    users = await db.get_all_users(exclude_user_id=callback.from_user.id)
 
-    if not users:
-        await callback.answer("В боте пока нет других пользователей", show_alert=True)
+@router.callback_query(F.data.in_({"users_list_next", "users_list_prev"}))
+async def turn_users_list(callback: CallbackQuery, db: Database, state: FSMContext):
+    """Перейти на следующую/предыдущую страницу списка пользователей"""
+    data = await state.get_data()
+    if callback.data == "users_list_next":
+        cursor = {'after': data.get('users_list_last')}
+    else:
+        cursor = {'before': data.get('users_list_first')}
+    if not any(cursor.values()):
+        await callback.answer("Список устарел, откройте его заново", show_alert=True)
         return
 
-    text = "👥 <b>Выберите получателей:</b>\n\n"
-    text += f"Всего пользователей: {len(users)}"
+    rendered = await render_users_list(db, state, callback.from_user.id, **cursor)
+    if rendered is None:
+        await callback.answer("Больше пользователей нет")
+        return
 
-    await callback.message.edit_text(
-        text,
-        reply_markup=get_user_list_keyboard(users),
-        parse_mode="HTML"
-    )
+    text, keyboard = rendered
+    await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
     await callback.answer()
+
@@ -79,24 +79,45 @@ def get_contacts_keyboard() -> InlineKeyboardMarkup:
     return keyboard
 
 
-def get_user_list_keyboard(users: list) -> InlineKeyboardMarkup:
-    """Клавиатура со списком пользователей для выбора"""
-    buttons = []
+def get_display_name(user: dict) -> str:
+    """Имя пользователя для списков"""
+    return user.get('username') and f"@{user['username']}" or \
+        f"{user.get('first_name') or ''} {user.get('last_name') or ''}".strip() or \
+        f"ID: {user['user_id']}"
+
 
-    for user in users:
-        display_name = user.get('username') and f"@{user['username']}" or \
-                      f"{user.get('first_name', '')} {user.get('last_name', '')}".strip() or \
-                      f"ID: {user['user_id']}"
+def get_user_picker_keyboard(page: list, selected: list, has_prev: bool = False,
+                             has_next: bool = False, query: str = None) -> InlineKeyboardMarkup:
+    """Страница списка пользователей для выбора получателей.
+
+    page — список пар (user_id, имя), см. get_display_name.
+    """
+    buttons = []
 
+    for user_id, display_name in page:
+        checkbox = "☑" if user_id in selected else "☐"
         buttons.append([
             InlineKeyboardButton(
-                text=f"☐ {display_name}",
-                callback_data=f"toggle_user_{user['user_id']}"
+                text=f"{checkbox} {display_name}",
+                callback_data=f"toggle_user_{user_id}"
             )
         ])
 
+    navigation = []
+    if has_prev:
+        navigation.append(InlineKeyboardButton(text="◀️ Назад", callback_data="picker_prev"))
+    if has_next:
+        navigation.append(InlineKeyboardButton(text="Вперед ▶️", callback_data="picker_next"))
+    if navigation:
+        buttons.append(navigation)
+
+    if query:
+        buttons.append([
+            InlineKeyboardButton(text=f"🔎 Сбросить поиск «{query}»", callback_data="picker_reset")
+        ])
+
     buttons.append([
-        InlineKeyboardButton(text="✅ Готово", callback_data="done_selecting_users")
+        InlineKeyboardButton(text=f"✅ Готово ({len(selected)} выбрано)", callback_data="done_selecting_users")
     ])
     buttons.append([
         InlineKeyboardButton(text="❌ Отменить", callback_data="cancel")
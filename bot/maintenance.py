@@ -0,0 +1,51 @@
+"""Разовые операции обслуживания базы, при остановленном боте и воркерах.
+
+Запуск: python -m bot.maintenance vacuum
+
+vacuum — перевести базу, созданную до incremental vacuum, на
+auto_vacuum = INCREMENTAL. Выполняет полный VACUUM: файл переписывается
+целиком, на время которого база заблокирована, и нужно свободное место
+размером с базу.
+"""
+import argparse
+import asyncio
+import logging
+
+from dotenv import load_dotenv
+
+from bot.database.db import Database
+
+load_dotenv()
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+
+async def vacuum():
+    db = Database()
+    await db.init_db()
+    try:
+        logger.info("Полный VACUUM, может занять несколько минут...")
+        if await db.enable_incremental_vacuum():
+            logger.info("База переведена на incremental vacuum")
+        else:
+            logger.info("incremental vacuum уже включен")
+    finally:
+        await db.close()
+
+
+COMMANDS = {"vacuum": vacuum}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=sorted(COMMANDS))
+    args = parser.parse_args()
+    asyncio.run(COMMANDS[args.command]())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+"""Метрики в текстовом формате Prometheus и эндпоинт /metrics.
+
+Счетчики и гистограммы живут в памяти процесса; значения, которые дешевле
+посчитать запросом в базу (очередь рассылок, состояния FSM), собираются
+в момент запроса /metrics.
+"""
+import bisect
+import functools
+import inspect
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError,
+    TelegramRetryAfter, TelegramServerError
+)
+
+logger = logging.getLogger(__name__)
+
+# Границы гистограмм задержек, секунды
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_value(value: float) -> str:
+    # :g теряет точность на больших счетчиках
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    """Базовая метрика: имя, описание и значения по наборам меток"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values: Dict[Tuple, Any] = {}
+
+    def clear(self):
+        """Забыть все наборы меток (для метрик, пересчитываемых целиком)"""
+        self._values.clear()
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        return [(self.name, _format_labels(self.labels, key), value)
+                for key, value in self._values.items()]
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} {self.kind}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{labels} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, value: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + value
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, *labels):
+        self._values[labels] = value
+
+    def inc(self, *labels, value: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels):
+        # [счетчики по корзинам (не накопительные), сумма, количество]
+        state = self._values.get(labels)
+        if state is None:
+            state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        samples = []
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                samples.append((f"{self.name}_bucket",
+                                _format_labels(self.labels, key, f'le="{le}"'), cumulative))
+            samples.append((f"{self.name}_sum", _format_labels(self.labels, key), total))
+            samples.append((f"{self.name}_count", _format_labels(self.labels, key), count))
+        return samples
+
+
+class Registry:
+    """Набор метрик процесса и функций, обновляющих их перед выдачей"""
+
+    def __init__(self):
+        self.metrics: List[Metric] = []
+        self.collectors: List[Callable[[], Awaitable[None]]] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector: Callable[[], Awaitable[None]]):
+        """collector() вызывается при каждом запросе /metrics"""
+        self.collectors.append(collector)
+
+    async def render(self) -> str:
+        for collector in self.collectors:
+            try:
+                await collector()
+            except Exception:
+                logger.exception("Не удалось собрать метрики")
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+API_REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "bot_api_request_seconds", "Telegram Bot API call latency", ("method", "outcome")))
+DB_QUERY_SECONDS = REGISTRY.register(Histogram(
+    "bot_db_query_seconds", "Database method latency", ("method",)))
+HANDLER_SECONDS = REGISTRY.register(Histogram(
+    "bot_handler_seconds", "Update handler latency", ("router", "event", "outcome")))
+BROADCAST_MESSAGES = REGISTRY.register(Counter(
+    "bot_broadcast_messages_total", "Broadcast recipients processed", ("outcome",)))
+BROADCAST_RETRIES = REGISTRY.register(Counter(
+    "bot_broadcast_retries_total", "Broadcast sends scheduled for retry"))
+BROADCAST_PENDING = REGISTRY.register(Gauge(
+    "bot_broadcast_pending", "Recipients waiting in in-process broadcasts"))
+BROADCAST_CHUNKS = REGISTRY.register(Gauge(
+    "bot_broadcast_chunks", "Broadcast chunks in the shared queue", ("state",)))
+BROADCAST_JOB_SENDS = REGISTRY.register(Gauge(
+    "bot_broadcast_job_sends", "Progress of running broadcast jobs", ("job", "outcome")))
+FSM_STATES = REGISTRY.register(Gauge(
+    "bot_fsm_states", "Users in each FSM state", ("state",)))
+
+
+def api_outcome(error: BaseException = None) -> str:
+    """Метка исхода запроса к Bot API"""
+    if error is None:
+        return "ok"
+    if isinstance(error, TelegramRetryAfter):
+        return "retry_after"
+    if isinstance(error, TelegramForbiddenError):
+        return "forbidden"
+    if isinstance(error, TelegramBadRequest):
+        return "bad_request"
+    if isinstance(error, TelegramServerError):
+        return "server_error"
+    if isinstance(error, TelegramNetworkError):
+        return "network_error"
+    return "error"
+
+
+class APIMetricsMiddleware(BaseRequestMiddleware):
+    """Задержка запросов к Bot API по методу и исходу"""
+
+    async def __call__(self, make_request, bot: Bot, method):
+        started = time.perf_counter()
+        try:
+            response = await make_request(bot, method)
+        except Exception as e:
+            API_REQUEST_SECONDS.observe(time.perf_counter() - started,
+                                        method.__api_method__, api_outcome(e))
+            raise
+        API_REQUEST_SECONDS.observe(time.perf_counter() - started,
+                                    method.__api_method__, "ok")
+        return response
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Задержка хэндлеров по роутеру, который обработал событие"""
+
+    def __init__(self, event: str):
+        self.event = event
+
+    async def __call__(self, handler, event, data: Dict[str, Any]):
+        router = data['event_router'].name
+        started = time.perf_counter()
+        try:
+            result = await handler(event, data)
+        except Exception:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, router, self.event, "error")
+            raise
+        HANDLER_SECONDS.observe(time.perf_counter() - started, router, self.event, "ok")
+        return result
+
+
+def _timed(name: str, method: Callable[..., Awaitable]) -> Callable[..., Awaitable]:
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await method(*args, **kwargs)
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - started, name)
+    return wrapper
+
+
+def instrument_database(db) -> None:
+    """Обернуть async-методы экземпляра Database замером времени"""
+    for name, method in inspect.getmembers(db, inspect.iscoroutinefunction):
+        if not name.startswith("_"):
+            setattr(db, name, _timed(name, method))
+
+
+def instrument_bot(bot: Bot, dp: Dispatcher = None) -> None:
+    """Подключить метрики запросов к API и (если передан dp) хэндлеров.
+
+    Внутренние middleware диспетчера наследуются всеми роутерами, а
+    event_router в данных — роутер, чей хэндлер сработал.
+    """
+    bot.session.middleware(APIMetricsMiddleware())
+    if dp is not None:
+        for event, observer in dp.observers.items():
+            if event not in ("update", "error"):
+                observer.middleware(HandlerMetricsMiddleware(event))
+
+
+def add_database_collectors(db) -> None:
+    """Метрики, которые считаются запросом в базу при каждом /metrics"""
+
+    async def collect():
+        async with db.pool.read() as conn:
+            async with conn.execute("""
+                SELECT CASE WHEN lease_until > ? THEN 'leased' ELSE 'waiting' END, COUNT(*)
+                FROM broadcast_chunks
+                WHERE status = 'queued'
+                GROUP BY 1
+            """, (time.time(),)) as cursor:
+                chunks = dict(await cursor.fetchall())
+            async with conn.execute("""
+                SELECT id, successful_sends, failed_sends FROM broadcast_jobs
+                WHERE status = 'running'
+            """) as cursor:
+                jobs = await cursor.fetchall()
+            async with conn.execute("""
+                SELECT COALESCE(state, 'none'), COUNT(*) FROM fsm_states GROUP BY 1
+            """) as cursor:
+                states = await cursor.fetchall()
+
+        for state in ("waiting", "leased"):
+            BROADCAST_CHUNKS.set(chunks.get(state, 0), state)
+        BROADCAST_JOB_SENDS.clear()
+        for job_id, successful, failed in jobs:
+            BROADCAST_JOB_SENDS.set(successful, job_id, "ok")
+            BROADCAST_JOB_SENDS.set(failed, job_id, "failed")
+        FSM_STATES.clear()
+        for state, count in states:
+            FSM_STATES.set(count, state)
+
+    REGISTRY.add_collector(collect)
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(body=(await REGISTRY.render()).encode(),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+async def start_metrics_server(host: str = "0.0.0.0", port: int = 9100) -> web.AppRunner:
+    """Поднять HTTP-сервер с /metrics; остановка — runner.cleanup()"""
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Метрики доступны на %s:%s/metrics", host, port)
+    return runner
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import time
+from typing import Any, Dict, Optional, Set, Tuple
+
+from aiogram import BaseMiddleware
+
+from bot.database.db import Database
+
+logger = logging.getLogger(__name__)
+
+# Как часто записывать накопленную активность, секунды
+ACTIVITY_FLUSH_INTERVAL = 5.0
+# Сколько user_id помнить как уже записанные в базу
+MAX_KNOWN_USERS = 100_000
+
+
+class ActivityTracker(BaseMiddleware):
+    """Профиль и время последней активности пользователей по каждому апдейту.
+
+    Вешается outer middleware на dp.update. Пользователь, которого процесс
+    еще не видел, записывается сразу, до хэндлеров: они могут прочитать
+    его из базы (например, отправитель в confirm_send). Дальше на пути
+    апдейта в базу ничего не пишется: изменения копятся в памяти (по одной
+    записи на пользователя, последняя побеждает) и раз в interval секунд
+    уходят одним upsert.
+    """
+
+    def __init__(self, db: Database, interval: float = ACTIVITY_FLUSH_INTERVAL,
+                 max_known: int = MAX_KNOWN_USERS):
+        self.db = db
+        self.interval = interval
+        self.max_known = max_known
+        # user_id -> (user_id, username, first_name, last_name, last_activity)
+        self._dirty: Dict[int, Tuple] = {}
+        # user_id, которые точно есть в таблице users
+        self._known: Set[int] = set()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    async def __call__(self, handler, event, data: Dict[str, Any]):
+        user = data.get('event_from_user')
+        if user is not None and not user.is_bot:
+            if user.id in self._known:
+                self.touch(user.id, user.username, user.first_name, user.last_name)
+            else:
+                await self.register(user.id, user.username, user.first_name, user.last_name)
+        return await handler(event, data)
+
+    async def register(self, user_id: int, username: str = None,
+                       first_name: str = None, last_name: str = None):
+        """Сразу записать пользователя в базу (профиль и активность)"""
+        try:
+            await self.db.add_user(user_id, username, first_name, last_name)
+        except Exception:
+            logger.exception("Не удалось записать пользователя %s", user_id)
+            self.touch(user_id, username, first_name, last_name)
+            return
+        self._remember([user_id])
+
+    def _remember(self, user_ids):
+        if len(self._known) >= self.max_known:
+            # Забытые просто запишутся еще раз при следующем апдейте
+            self._known.clear()
+        self._known.update(user_ids)
+
+    def touch(self, user_id: int, username: str = None,
+              first_name: str = None, last_name: str = None):
+        """Отметить активность пользователя (в формате CURRENT_TIMESTAMP)"""
+        now = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+        self._dirty[user_id] = (user_id, username, first_name, last_name, now)
+
+    async def flush(self):
+        """Записать накопленную активность одной транзакцией"""
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, {}
+            try:
+                await self.db.upsert_users(list(dirty.values()))
+                self._remember(dirty)
+            except Exception:
+                logger.exception("Не удалось записать активность %s пользователей", len(dirty))
+                # Вернуть в очередь, не затирая то, что пришло во время записи
+                for user_id, row in dirty.items():
+                    self._dirty.setdefault(user_id, row)
+
+    def start(self):
+        """Запустить периодическую запись фоновой задачей"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановить фоновую запись и дописать остаток"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
@@ -0,0 +1,225 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+
+from bot.metrics import BROADCAST_MESSAGES, BROADCAST_PENDING, BROADCAST_RETRIES
+from bot.services.retry import RetryPolicy
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram Bot API
+GLOBAL_RATE = 30          # сообщений в секунду на бота
+# Часть GLOBAL_RATE, отведенная обычным рассылкам из бота; остальное — воркерам
+INTERACTIVE_RATE = 5
+PER_CHAT_INTERVAL = 1.0   # не чаще одного сообщения в секунду в один чат
+
+
+class TokenBucket:
+    """Глобальный лимит отправки (token bucket)"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def set_rate(self, rate: float):
+        """Сменить лимит на лету (например, при делении между воркерами).
+
+        Запас токенов остается тем же в секундах: capacity / rate.
+        """
+        burst = self.capacity / self.rate
+        self.rate = rate
+        self.capacity = max(1.0, rate * burst)
+        self._tokens = min(self._tokens, self.capacity)
+
+    def pause(self, seconds: float):
+        """Приостановить отправку (например, по flood control)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        """Дождаться свободного токена"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    # За время паузы токены не накапливаются
+                    self._updated = time.monotonic()
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class ChatLimiter:
+    """Лимит отправки в один чат"""
+
+    def __init__(self, interval: float = PER_CHAT_INTERVAL, max_size: int = 10000):
+        self.interval = interval
+        self.max_size = max_size
+        self._next: Dict[int, float] = {}
+
+    async def acquire(self, chat_id: int):
+        """Дождаться, пока в чат снова можно писать"""
+        now = time.monotonic()
+        if len(self._next) > self.max_size:
+            # Забываем чаты, лимит которых уже истек
+            self._next = {k: v for k, v in self._next.items() if v > now}
+
+        ready_at = max(now, self._next.get(chat_id, 0.0))
+        self._next[chat_id] = ready_at + self.interval
+        if ready_at > now:
+            await asyncio.sleep(ready_at - now)
+
+    def pause(self, chat_id: int, seconds: float):
+        """Не писать в чат ближайшие seconds секунд"""
+        self._next[chat_id] = max(self._next.get(chat_id, 0.0), time.monotonic() + seconds)
+
+
+class BroadcastResult:
+    """Итог рассылки"""
+
+    def __init__(self):
+        self.successful: List[int] = []
+        self.failed: List[int] = []
+        self.retries = 0
+
+    @property
+    def total(self) -> int:
+        return len(self.successful) + len(self.failed)
+
+
+class Broadcaster:
+    """Движок рассылок: пул воркеров с глобальным и per-chat лимитами.
+
+    Один экземпляр на бота, чтобы параллельные рассылки делили общий лимит.
+    Временные ошибки повторяются по RetryPolicy: повтор ставится обратно в
+    очередь с задержкой и не занимает воркер на время ожидания.
+    """
+
+    def __init__(self, rate: float = GLOBAL_RATE, workers: int = 10,
+                 per_chat_interval: float = PER_CHAT_INTERVAL,
+                 retry: RetryPolicy = None):
+        self.workers = workers
+        self.bucket = TokenBucket(rate)
+        self.chats = ChatLimiter(per_chat_interval)
+        self.retry = retry or RetryPolicy()
+
+    async def run(self, recipients: Iterable[int], send: Callable[[int], Awaitable],
+                  deadline: Optional[float] = None,
+                  bucket: TokenBucket = None) -> BroadcastResult:
+        """Отправить сообщение каждому получателю через send(chat_id).
+
+        deadline — момент time.monotonic(), после которого повторы не
+        планируются, а неотправленные получатели считаются неудачными.
+        Без него повторы одного получателя ограничены
+        RetryPolicy.max_total_wait.
+        bucket — лимит этой рассылки вместо лимита экземпляра (доля
+        воркера), чтобы рассылки воркеров и обычные не делили одни токены.
+        """
+        result = BroadcastResult()
+        limit = bucket or self.bucket
+        queue: asyncio.Queue = asyncio.Queue()
+        for chat_id in recipients:
+            # (получатель, попыток с ошибкой, секунд уже прождано в повторах)
+            queue.put_nowait((chat_id, 0, 0.0))
+
+        remaining = queue.qsize()
+        if not remaining:
+            return result
+        finished = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        retry_handles = []
+        BROADCAST_PENDING.inc(value=remaining)
+
+        def complete(chat_id: int, ok: bool):
+            nonlocal remaining
+            (result.successful if ok else result.failed).append(chat_id)
+            BROADCAST_MESSAGES.inc("ok" if ok else "failed")
+            BROADCAST_PENDING.inc(value=-1)
+            remaining -= 1
+            if remaining == 0:
+                finished.set()
+
+        def expired(delay: float = 0.0) -> bool:
+            return deadline is not None and time.monotonic() + delay > deadline
+
+        async def acquire(chat_id: int):
+            await self.chats.acquire(chat_id)
+            await limit.acquire()
+
+        async def worker():
+            while True:
+                chat_id, attempt, waited = await queue.get()
+                if expired():
+                    complete(chat_id, False)
+                    continue
+
+                if deadline is None:
+                    await acquire(chat_id)
+                else:
+                    # Пауза flood control из-за другого получателя может
+                    # продлиться дольше дедлайна: не отправляем после него
+                    try:
+                        await asyncio.wait_for(acquire(chat_id), deadline - time.monotonic())
+                    except asyncio.TimeoutError:
+                        complete(chat_id, False)
+                        continue
+                try:
+                    await send(chat_id)
+                    complete(chat_id, True)
+                    continue
+                except Exception as e:
+                    error = e
+
+                retry_after = self.retry.retry_after(error)
+                if retry_after is not None:
+                    # Flood control: ставим на паузу и чат, и общий лимит бота
+                    self.chats.pause(chat_id, retry_after)
+                    self.bucket.pause(retry_after)
+                    limit.pause(retry_after)
+                    delay = retry_after
+                elif self.retry.is_transient(error) and attempt + 1 < self.retry.max_attempts:
+                    delay = self.retry.backoff(attempt)
+                    attempt += 1
+                else:
+                    logger.warning("Не удалось отправить сообщение %s: %s", chat_id, error)
+                    complete(chat_id, False)
+                    continue
+
+                if expired(delay):
+                    logger.warning("Дедлайн рассылки истек, %s не получит сообщение: %s",
+                                   chat_id, error)
+                    complete(chat_id, False)
+                    continue
+                if waited + delay > self.retry.max_total_wait:
+                    logger.warning("Повторы для %s ждали бы дольше %s с, не отправлено: %s",
+                                   chat_id, self.retry.max_total_wait, error)
+                    complete(chat_id, False)
+                    continue
+
+                result.retries += 1
+                BROADCAST_RETRIES.inc()
+                retry_handles.append(
+                    loop.call_later(delay, queue.put_nowait, (chat_id, attempt, waited + delay))
+                )
+
+        tasks = [asyncio.create_task(worker()) for _ in range(min(self.workers, remaining))]
+        try:
+            await finished.wait()
+        finally:
+            # Прерванная рассылка не должна оставлять хвост в метрике
+            BROADCAST_PENDING.inc(value=-remaining)
+            for handle in retry_handles:
+                handle.cancel()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return result
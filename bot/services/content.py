@@ -0,0 +1,43 @@
+from typing import Optional
+
+from aiogram import Bot
+from aiogram.types import InlineKeyboardMarkup, Message
+
+# Типы медиа, которые можно разослать: у всех есть подпись, а метод
+# отправки — bot.send_<тип>(chat_id, <тип>=file_id, caption=...)
+MEDIA_TYPES = ("photo", "video", "document", "animation", "audio", "voice")
+
+# Лимит Telegram на длину подписи к медиа
+CAPTION_LIMIT = 1024
+
+
+def extract_content(message: Message) -> Optional[dict]:
+    """Содержимое сообщения для рассылки: content_type, file_id и текст/подпись.
+
+    Файл уже загружен в Telegram вместе с сообщением админа, поэтому дальше
+    он отправляется по file_id без повторной загрузки. None — тип не поддерживается.
+    """
+    if message.text is not None:
+        return {'content_type': "text", 'file_id': None, 'text': message.text}
+    for content_type in MEDIA_TYPES:
+        media = getattr(message, content_type)
+        if media:
+            # У фото список размеров, последний — самый большой
+            file_id = media[-1].file_id if content_type == "photo" else media.file_id
+            return {'content_type': content_type, 'file_id': file_id,
+                    'text': message.caption or ""}
+    return None
+
+
+async def send_content(bot: Bot, chat_id: int, content_type: str, file_id: Optional[str],
+                       text: str, reply_markup: InlineKeyboardMarkup = None,
+                       parse_mode: str = "HTML") -> Message:
+    """Отправить текст или медиа по file_id (text становится подписью)"""
+    if content_type == "text":
+        return await bot.send_message(chat_id=chat_id, text=text,
+                                      reply_markup=reply_markup, parse_mode=parse_mode)
+    if content_type not in MEDIA_TYPES:
+        raise ValueError(f"Неподдерживаемый тип сообщения: {content_type}")
+    method = getattr(bot, f"send_{content_type}")
+    return await method(chat_id, file_id, caption=text,
+                        reply_markup=reply_markup, parse_mode=parse_mode)
@@ -0,0 +1,297 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Optional
+
+from aiogram import Bot
+
+from bot.database.db import Database
+from bot.database.migrations import BROADCAST_CHUNK_SIZE
+from bot.database.segments import Segment
+from bot.services.broadcaster import GLOBAL_RATE, INTERACTIVE_RATE, Broadcaster, TokenBucket
+from bot.services.templates import MessageTemplate
+
+logger = logging.getLogger(__name__)
+
+# Как часто воркер пересчитывает свою долю лимита, секунды
+SHARE_INTERVAL = 0.25
+# Сколько раз воркер пытается завершить рассылку при ошибках БД
+FINISH_ATTEMPTS = 5
+# Потолок паузы между попытками закрыть отправленный кусок, секунды
+MAX_RETRY_DELAY = 30
+
+
+class BroadcastJobRunner:
+    """Постановка фоновых рассылок всем пользователям в очередь.
+
+    Рассылка режется на куски по user_id (таблица broadcast_chunks), а
+    отправляют их воркеры: BroadcastWorker в процессе бота и/или отдельные
+    процессы `python -m bot.worker`.
+
+    deadline — сколько секунд рассылка может идти с момента создания; по его
+    истечении она завершается со статусом 'expired'.
+    """
+
+    def __init__(self, db: Database, chunk_size: int = BROADCAST_CHUNK_SIZE,
+                 deadline: float = None, worker: "BroadcastWorker" = None):
+        self.db = db
+        self.chunk_size = chunk_size
+        self.deadline = deadline
+        self.worker = worker
+
+    async def start(self, sender_id: int, message_text: str, total_recipients: int,
+                    segment: Segment = None) -> int:
+        """Создать рассылку (всем активным или сегменту) и поставить ее куски в очередь"""
+        expires_at = int(time.time() + self.deadline) if self.deadline else None
+        job_id = await self.db.create_broadcast_job(
+            sender_id, message_text, total_recipients,
+            expires_at=expires_at, chunk_size=self.chunk_size, segment=segment
+        )
+        if self.worker is not None:
+            self.worker.wake()
+        return job_id
+
+
+class BroadcastWorker:
+    """Воркер рассылок: берет куски из очереди в SQLite и отправляет их.
+
+    Кусок берется в аренду на lease секунд и продлевается heartbeat'ом, пока
+    идет отправка. Если процесс упал, аренда истекает и кусок забирает другой
+    воркер: повторно может уйти не больше одного куска.
+
+    rate — лимит всех воркеров вместе: лимит бота без INTERACTIVE_RATE,
+    отведенного обычным рассылкам из бота (broadcaster.bucket процесса
+    бота). Он делится поровну между воркерами, которые сейчас держат
+    аренду, поэтому процессы вместе с обычными рассылками не превышают
+    лимит Telegram. Доля пересчитывается раз в share_interval секунд.
+
+    Кусок, который брали больше max_attempts раз, не отправляется, а
+    закрывается как 'failed': каждая выдача могла отправить его заново.
+    """
+
+    def __init__(self, db: Database, bot: Bot, broadcaster: Broadcaster,
+                 rate: float = GLOBAL_RATE - INTERACTIVE_RATE, lease: float = 60, poll_interval: float = 1.0,
+                 worker_id: str = None, share_interval: float = SHARE_INTERVAL,
+                 max_attempts: int = 3, retry_delay: float = 1.0):
+        self.db = db
+        self.bot = bot
+        self.broadcaster = broadcaster
+        self.rate = rate
+        # Без запаса токенов: доли воркеров в сумме дают rate и на старте
+        self.bucket = TokenBucket(rate, capacity=1)
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.share_interval = share_interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._wakeup = asyncio.Event()
+        self._chunk: Optional[dict] = None
+        self._chunk_task: Optional[asyncio.Task] = None
+        # Сообщения текущего куска уже отправлены, а сам кусок еще не закрыт
+        self._chunk_sent = False
+        self._task: Optional[asyncio.Task] = None
+
+    def wake(self):
+        """Проверить очередь сейчас, не дожидаясь poll_interval"""
+        self._wakeup.set()
+
+    def start(self):
+        """Запустить воркер фоновой задачей"""
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Остановить воркер; недоотправленный кусок возвращается в очередь"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def run(self):
+        """Брать куски из очереди, пока задачу не отменят"""
+        logger.info("Воркер рассылок %s запущен", self.worker_id)
+        heartbeat = asyncio.create_task(self._heartbeat())
+        sharing = asyncio.create_task(self._share_loop())
+        try:
+            while True:
+                try:
+                    chunk = await self.db.claim_broadcast_chunk(self.worker_id, self.lease)
+                    if chunk is not None:
+                        await self._share_rate()
+                except Exception:
+                    logger.exception("Не удалось взять кусок рассылки")
+                    chunk = None
+
+                if chunk is None:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                await self._run_chunk(chunk)
+        finally:
+            heartbeat.cancel()
+            sharing.cancel()
+            await asyncio.gather(heartbeat, sharing, return_exceptions=True)
+
+    async def _run_chunk(self, chunk: dict):
+        self._chunk = chunk
+        self._chunk_sent = False
+        task = self._chunk_task = asyncio.create_task(self._process(chunk))
+        try:
+            # wait, а не await: отмена run() не должна молча отменять кусок
+            await asyncio.wait([task])
+        finally:
+            if not task.done():
+                if self._chunk_sent:
+                    # Возврат в очередь отправил бы кусок заново: ждем, пока
+                    # он закроется (heartbeat продолжает держать аренду)
+                    logger.warning("Кусок #%s отправлен, ждем его закрытия", chunk['id'])
+                    await asyncio.wait([task])
+                else:
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+                    await self.db.release_broadcast_chunk(chunk['id'], self.worker_id)
+            self._chunk, self._chunk_task = None, None
+
+        if task.cancelled():
+            logger.warning("Аренда куска #%s потеряна, его доотправит другой воркер", chunk['id'])
+        elif task.exception() is not None:
+            logger.error("Кусок #%s не обработан: %r", chunk['id'], task.exception())
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                chunk, task = self._chunk, self._chunk_task
+                if chunk is not None and not await self.db.extend_broadcast_chunk_lease(
+                        chunk['id'], self.worker_id, self.lease):
+                    task.cancel()
+            except Exception:
+                logger.exception("Heartbeat воркера %s не прошел", self.worker_id)
+
+    async def _share_loop(self):
+        # Воркеры приходят и уходят между heartbeat'ами: без частого
+        # пересчета новый воркер долго работал бы сверх лимита, а
+        # оставшиеся — на старой, меньшей доле
+        while True:
+            await asyncio.sleep(self.share_interval)
+            if self._chunk is None:
+                continue
+            try:
+                await self._share_rate()
+            except Exception:
+                logger.exception("Не удалось пересчитать долю лимита воркера %s", self.worker_id)
+
+    async def _share_rate(self):
+        workers = await self.db.count_active_broadcast_workers()
+        self.bucket.set_rate(self.rate / max(1, workers))
+
+    async def _process(self, chunk: dict):
+        job_id = chunk['job_id']
+        if chunk['attempts'] > self.max_attempts:
+            logger.error("Кусок #%s рассылки #%s брали %s раз, пропускаем его",
+                         chunk['id'], job_id, chunk['attempts'] - 1)
+            await self.db.complete_broadcast_chunk(chunk['id'], self.worker_id, job_id,
+                                                   0, 0, status='failed')
+            await self._finish(job_id, 'done')
+            return
+
+        job = await self.db.get_broadcast_job(job_id)
+        if job is None or job['status'] != 'running':
+            await self.db.complete_broadcast_chunk(chunk['id'], self.worker_id, job_id,
+                                                   0, 0, status='cancelled')
+            return
+
+        sender_id = job['sender_id']
+        text = job['message_text']
+        template = MessageTemplate(text)
+        segment = Segment.from_json(job['segment'])
+        expires_at = job['expires_at']
+        # Дедлайн хранится в unix time, Broadcaster ждет time.monotonic()
+        deadline = time.monotonic() + (expires_at - time.time()) if expires_at else None
+
+        if deadline is not None and time.monotonic() > deadline:
+            await self.db.complete_broadcast_chunk(chunk['id'], self.worker_id, job_id,
+                                                   0, 0, status='cancelled')
+            await self._finish(job_id, 'expired')
+            return
+
+        try:
+            recipients = await self.db.get_active_user_ids_range(
+                chunk['after_user_id'], chunk['last_user_id'], segment
+            )
+            # Тексты всего куска — по одной выборке пользователей
+            users = await self.db.get_users_by_ids(recipients) if template.is_personal else {}
+            texts = template.render_many(recipients, users)
+        except Exception:
+            # Еще ничего не отправлено: кусок можно сразу отдать другому воркеру
+            logger.exception("Кусок #%s рассылки #%s не подготовлен, возвращаем в очередь",
+                             chunk['id'], job_id)
+            await self.db.release_broadcast_chunk(chunk['id'], self.worker_id)
+            return
+
+        async def send(user_id: int):
+            await self.bot.send_message(chat_id=user_id, text=texts[user_id], parse_mode="HTML")
+            # В историю — шаблон, а не texts[user_id] (см. queue_message)
+            self.db.queue_message(sender_id, user_id, text)
+
+        result = await self.broadcaster.run(recipients, send, deadline=deadline,
+                                            bucket=self.bucket)
+        self._chunk_sent = True
+        # Сообщения уже ушли: при ошибке БД кусок закрывается повторно с теми же
+        # счетчиками (история ждет в очереди записи), пока не получится, и
+        # никогда не возвращается в очередь — иначе его отправили бы заново
+        closed = await self._retry(lambda: self.db.complete_broadcast_chunk(
+            chunk['id'], self.worker_id, job_id,
+            len(result.successful), len(result.failed)))
+        self._chunk_sent = False
+        if not closed:
+            logger.warning("Кусок #%s уже закрыт другим воркером", chunk['id'])
+            return
+
+        expired = deadline is not None and time.monotonic() > deadline
+        await self._retry(lambda: self._finish(job_id, 'expired' if expired else 'done'),
+                          attempts=FINISH_ATTEMPTS)
+
+    async def _retry(self, call, attempts: int = None):
+        """Выполнить call, повторяя при ошибках (без attempts — пока не получится)"""
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return await call()
+            except Exception as e:
+                if attempts is not None and attempt >= attempts:
+                    raise
+                logger.warning("Попытка %s не удалась: %r", attempt, e)
+                await asyncio.sleep(min(MAX_RETRY_DELAY, self.retry_delay * 2 ** min(attempt - 1, 10)))
+
+    async def _finish(self, job_id: int, status: str):
+        """Завершить рассылку и, если это сделал этот воркер, отправить отчет"""
+        if not await self.db.finish_broadcast_job(job_id, status=status):
+            return
+
+        job = await self.db.get_broadcast_job(job_id)
+        successful = job['successful_sends']
+        failed = job['failed_sends']
+        logger.info("Рассылка #%s завершена (%s): %s успешно, %s ошибок",
+                    job_id, status, successful, failed)
+        title = "завершена!" if status == 'done' else "остановлена по дедлайну"
+        try:
+            await self.bot.send_message(
+                chat_id=job['sender_id'],
+                text=f"✅ <b>Рассылка #{job_id} {title}</b>\n\n"
+                     f"✅ Успешно: {successful}\n"
+                     f"❌ Не удалось: {failed}\n"
+                     f"📈 Всего: {successful + failed}",
+                parse_mode="HTML"
+            )
+        except Exception as e:
+            logger.warning("Не удалось отправить отчет о рассылке #%s: %s", job_id, e)
@@ -0,0 +1,81 @@
+import asyncio
+import logging
+from typing import Optional, Tuple
+
+from bot.database.db import Database
+
+logger = logging.getLogger(__name__)
+
+# Сообщения старше стольких дней уходят из основной базы в архив
+MESSAGE_RETENTION_DAYS = 90
+# Как часто проверять, есть ли что архивировать, секунды
+RETENTION_INTERVAL = 3600.0
+# Сообщений за один шаг архивации
+ARCHIVE_BATCH = 2000
+# Страниц за один шаг incremental vacuum (~1 МБ при странице 4 КБ)
+VACUUM_PAGES = 256
+# Пауза между шагами, чтобы запись бота не ждала всю архивацию
+STEP_PAUSE = 0.2
+
+
+class RetentionWorker:
+    """Архивация старой истории сообщений и возврат места в файле базы.
+
+    Раз в interval секунд переносит сообщения старше days дней в месячные
+    файлы архива, затем отдает освободившиеся страницы incremental vacuum.
+    Каждый шаг — короткая транзакция под блокировкой писателя, между
+    шагами пауза pause.
+    """
+
+    def __init__(self, db: Database, days: int = MESSAGE_RETENTION_DAYS,
+                 interval: float = RETENTION_INTERVAL, batch: int = ARCHIVE_BATCH,
+                 pages: int = VACUUM_PAGES, pause: float = STEP_PAUSE):
+        self.db = db
+        self.days = days
+        self.interval = interval
+        self.batch = batch
+        self.pages = pages
+        self.pause = pause
+        self._task: Optional[asyncio.Task] = None
+
+    async def run_once(self) -> Tuple[int, int]:
+        """Один полный проход. Возвращает (перенесено сообщений, освобождено страниц)"""
+        archived = 0
+        while True:
+            moved = await self.db.archive_messages(self.days, self.batch)
+            if not moved:
+                break
+            archived += moved
+            await asyncio.sleep(self.pause)
+
+        freed = 0
+        while True:
+            step = await self.db.incremental_vacuum(self.pages)
+            freed += step
+            if step < self.pages:
+                break
+            await asyncio.sleep(self.pause)
+
+        if archived or freed:
+            logger.info("Архивировано сообщений: %s, освобождено страниц: %s", archived, freed)
+        return archived, freed
+
+    def start(self):
+        """Запустить периодическую архивацию фоновой задачей"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановить архивацию (текущий шаг откатится или уже записан)"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("Ошибка архивации сообщений")
+            await asyncio.sleep(self.interval)
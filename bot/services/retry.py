@@ -0,0 +1,39 @@
+import random
+
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+
+
+class RetryPolicy:
+    """Политика повторов для исходящих запросов к Telegram.
+
+    - TelegramRetryAfter: ждем ровно retry_after, попытка не засчитывается
+    - сетевые ошибки и 5xx: экспоненциальная задержка с джиттером
+    - остальное (403, 400, ...) — постоянная ошибка, без повторов
+
+    max_total_wait — сколько секунд один получатель может суммарно ждать
+    повторов. Без него рассылка без дедлайна ждала бы flood control сколько
+    угодно: retry_after не ограничен, и 429 не тратит попытки.
+    """
+
+    def __init__(self, max_attempts: int = 5, base_delay: float = 1.0,
+                 max_delay: float = 60.0, max_total_wait: float = 300.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_total_wait = max_total_wait
+
+    @staticmethod
+    def is_transient(error: Exception) -> bool:
+        """Временная ли ошибка (сеть, сервер Telegram)"""
+        return isinstance(error, (TelegramNetworkError, TelegramServerError))
+
+    @staticmethod
+    def retry_after(error: Exception):
+        """Сколько ждать по flood control (None, если это не 429)"""
+        if isinstance(error, TelegramRetryAfter):
+            return float(error.retry_after)
+        return None
+
+    def backoff(self, attempt: int) -> float:
+        """Задержка перед повтором номер attempt (full jitter)"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
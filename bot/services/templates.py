@@ -0,0 +1,75 @@
+import html
+import re
+from typing import Callable, Dict, Iterable, List, Optional
+
+# Подстановки: {first_name}, {last_name}, {full_name}, {username}, {user_id}.
+# Остальные фигурные скобки в тексте остаются как есть.
+PLACEHOLDER = re.compile(r"\{(first_name|last_name|full_name|username|user_id)\}")
+
+
+def _full_name(user: dict) -> str:
+    return " ".join(part for part in (user.get('first_name'), user.get('last_name')) if part)
+
+
+# Значение подстановки по строке users (без экранирования)
+FIELDS: Dict[str, Callable[[dict], str]] = {
+    'first_name': lambda user: user.get('first_name') or "",
+    'last_name': lambda user: user.get('last_name') or "",
+    'full_name': _full_name,
+    # Без username — имя, чтобы обращение не оставалось пустым
+    'username': lambda user: f"@{user['username']}" if user.get('username')
+    else user.get('first_name') or "",
+    'user_id': lambda user: str(user.get('user_id') or ""),
+}
+
+# Наибольшая длина значения подстановки по ограничениям Telegram: имя и
+# фамилия до 64 символов, username до 32 (а без него подставляется имя)
+FIELD_MAX_LENGTH: Dict[str, int] = {
+    'first_name': 64,
+    'last_name': 64,
+    'full_name': 64 + 1 + 64,
+    'username': 64,
+    'user_id': 20,
+}
+
+
+class MessageTemplate:
+    """Текст сообщения с подстановками данных получателя.
+
+    Текст разбирается один раз при создании: render() только склеивает
+    готовые куски с экранированными (parse_mode HTML) значениями полей.
+    prefix и suffix добавляются как есть, без поиска подстановок.
+    """
+
+    def __init__(self, text: str, prefix: str = "", suffix: str = ""):
+        parts = PLACEHOLDER.split(text)
+        # Четные элементы — текст между подстановками, нечетные — имена полей
+        self._literals: List[str] = parts[0::2]
+        self._literals[0] = prefix + self._literals[0]
+        self._literals[-1] += suffix
+        self.fields: List[str] = parts[1::2]
+        self._getters = [FIELDS[field] for field in self.fields]
+
+    @property
+    def is_personal(self) -> bool:
+        """Нужны ли данные получателя (иначе текст у всех одинаковый)"""
+        return bool(self.fields)
+
+    def max_length(self) -> int:
+        """Длина текста, если все подстановки наибольшей возможной длины"""
+        return sum(map(len, self._literals)) + sum(FIELD_MAX_LENGTH[field] for field in self.fields)
+
+    def render(self, user: Optional[dict] = None) -> str:
+        """Текст для одного получателя; user — строка users или None"""
+        if not self.fields:
+            return self._literals[0]
+        user = user or {}
+        out = [self._literals[0]]
+        for getter, literal in zip(self._getters, self._literals[1:]):
+            out.append(html.escape(getter(user), quote=False))
+            out.append(literal)
+        return "".join(out)
+
+    def render_many(self, user_ids: Iterable[int], users: Dict[int, dict]) -> Dict[int, str]:
+        """Тексты для пачки получателей по заранее загруженным строкам users"""
+        return {user_id: self.render(users.get(user_id)) for user_id in user_ids}
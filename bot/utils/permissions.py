@@ -1,8 +1,72 @@
+import asyncio
+import time
+from typing import Dict, Optional, Set
+
 from bot.database.db import Database
 
 SUPER_ADMIN_ID = 803817300
 
 
+class RoleCache:
+    """Кэш списка админов в памяти.
+
+    Загружается один раз при старте и обновляется сразу при add_admin,
+    remove_admin и delete_user. Полная перезагрузка раз в ttl секунд —
+    страховка на случай изменений в обход Database (другой процесс, ручной SQL).
+    Уведомление, пришедшее во время перезагрузки, могло не попасть в
+    прочитанный снимок, поэтому такие изменения применяются к нему поверх.
+    """
+
+    def __init__(self, ttl: float = 300):
+        self.ttl = ttl
+        self._admins: Optional[Set[int]] = None
+        self._loaded_at = 0.0
+        self._lock = asyncio.Lock()
+        # Изменения за время чтения из базы: user_id -> is_admin
+        self._changes: Optional[Dict[int, bool]] = None
+
+    def _stale(self) -> bool:
+        return self._admins is None or time.monotonic() - self._loaded_at > self.ttl
+
+    async def load(self, db: Database):
+        """Загрузить админов из базы (если кэш устарел) и подписаться на изменения"""
+        db.on_admins_changed(self._on_admins_changed)
+        async with self._lock:
+            # Пока ждали блокировку, кэш мог обновить другой вызов
+            if not self._stale():
+                return
+            self._changes = {}
+            try:
+                admins = await db.get_admin_ids()
+                for user_id, is_admin in self._changes.items():
+                    self._apply(admins, user_id, is_admin)
+            finally:
+                self._changes = None
+            self._admins = admins
+            self._loaded_at = time.monotonic()
+
+    async def is_admin(self, user_id: int, db: Database) -> bool:
+        if self._stale():
+            await self.load(db)
+        return user_id in self._admins
+
+    def _on_admins_changed(self, user_id: int, is_admin: bool):
+        if self._changes is not None:
+            self._changes[user_id] = is_admin
+        if self._admins is not None:
+            self._apply(self._admins, user_id, is_admin)
+
+    @staticmethod
+    def _apply(admins: Set[int], user_id: int, is_admin: bool):
+        if is_admin:
+            admins.add(user_id)
+        else:
+            admins.discard(user_id)
+
+
+role_cache = RoleCache()
+
+
 def is_super_admin(user_id: int) -> bool:
     """Проверить, является ли пользователь супер админом"""
     return user_id == SUPER_ADMIN_ID
@@ -10,7 +74,7 @@ def is_super_admin(user_id: int) -> bool:
 
 async def is_admin(user_id: int, db: Database) -> bool:
     """Проверить, является ли пользователь обычным админом"""
-    return await db.is_admin(user_id)
+    return await role_cache.is_admin(user_id, db)
 
 
 async def can_send_messages(user_id: int, db: Database) -> bool:
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+from typing import Any, Dict, Set
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.methods import TelegramMethod
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд при остановке ждать апдейты, которые еще обрабатываются
+SHUTDOWN_TIMEOUT = 30.0
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """Обработчик вебхука с ограничением числа апдейтов в обработке.
+
+    Апдейты обрабатываются параллельно в фоне (handle_in_background), но не
+    больше max_concurrency одновременно. Когда все слоты заняты, новый
+    запрос ждет ответа, и Telegram сам придерживает доставку (не больше
+    max_connections запросов). При остановке close() дожидается апдейтов в
+    обработке, не дольше shutdown_timeout секунд.
+
+    Без секрета вебхук принял бы апдейт от кого угодно, поэтому secret_token
+    обязателен.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret_token: str,
+                 max_concurrency: int = 100, shutdown_timeout: float = SHUTDOWN_TIMEOUT,
+                 **data: Any):
+        if not secret_token:
+            raise ValueError("Для вебхука нужен secret_token (WEBHOOK_SECRET)")
+        super().__init__(dispatcher, bot, handle_in_background=True,
+                         secret_token=secret_token, **data)
+        self.shutdown_timeout = shutdown_timeout
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        bot = await self.resolve_bot(request)
+        if not self.verify_secret(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), bot):
+            return web.Response(body="Unauthorized", status=401)
+
+        await self._slots.acquire()
+        try:
+            update = await request.json(loads=bot.session.json_loads)
+        except Exception:
+            self._slots.release()
+            raise
+
+        task = asyncio.create_task(self._process(bot, update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    __call__ = handle
+
+    async def _process(self, bot: Bot, update: Dict[str, Any]):
+        try:
+            result = await self.dispatcher.feed_raw_update(bot, update, **self.data)
+            if isinstance(result, TelegramMethod):
+                await self.dispatcher.silent_call_request(bot, result)
+        except Exception:
+            logger.exception("Ошибка обработки апдейта из вебхука")
+        finally:
+            self._slots.release()
+
+    async def close(self):
+        """Дождаться апдейтов в обработке и закрыть сессию бота"""
+        if self._tasks:
+            logger.info("Ждем завершения апдейтов в обработке: %s", len(self._tasks))
+            _, pending = await asyncio.wait(set(self._tasks), timeout=self.shutdown_timeout)
+            for task in pending:
+                task.cancel()
+            if pending:
+                logger.warning("Прервано апдейтов при остановке: %s", len(pending))
+                await asyncio.gather(*pending, return_exceptions=True)
+        await super().close()
+
+
+def build_webhook_app(dp: Dispatcher, bot: Bot, path: str = "/webhook",
+                      secret_token: str = None, max_concurrency: int = 100,
+                      **data: Any) -> web.Application:
+    """Собрать aiohttp-приложение, принимающее апдейты на path"""
+    app = web.Application()
+    # Обработчик регистрируется первым: при остановке сначала дожидаемся
+    # апдейтов, потом останавливаем диспетчер
+    BoundedRequestHandler(
+        dp, bot,
+        secret_token=secret_token,
+        max_concurrency=max_concurrency,
+    ).register(app, path=path)
+    # Запуск и остановка диспетчера (startup/shutdown, закрытие FSM-хранилища)
+    setup_application(app, dp, bot=bot, **data)
+    return app
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, url: str, path: str = "/webhook",
+                      secret_token: str = None, host: str = "0.0.0.0", port: int = 8080,
+                      max_concurrency: int = 100):
+    """Зарегистрировать вебхук в Telegram и принимать апдейты до остановки"""
+    app = build_webhook_app(dp, bot, path, secret_token, max_concurrency)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+
+    await bot.set_webhook(
+        url.rstrip("/") + path,
+        secret_token=secret_token,
+        allowed_updates=dp.resolve_used_update_types(),
+        max_connections=min(max_concurrency, 100)
+    )
+    logger.info("Вебхук слушает %s:%s%s", host, port, path)
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
@@ -0,0 +1,92 @@
+"""Отдельный процесс-воркер фоновых рассылок.
+
+Запуск: python -m bot.worker
+
+Берет куски рассылок из общей базы SQLite и отправляет их. Можно запустить
+несколько процессов: лимит BROADCAST_RATE без BROADCAST_INTERACTIVE_RATE
+(доли обычных рассылок из бота) делится между ними. Процесс бота при этом
+только ставит рассылки в очередь (BROADCAST_LOCAL_WORKER=0).
+"""
+import asyncio
+import logging
+import os
+import signal
+
+from dotenv import load_dotenv
+
+from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+from aiogram.enums import ParseMode
+
+from bot import metrics
+from bot.database.db import Database
+from bot.services.broadcaster import Broadcaster
+from bot.services.jobs import BroadcastWorker
+
+load_dotenv()
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+
+async def main():
+    bot_token = os.getenv("BOT_TOKEN")
+    if not bot_token:
+        logger.error("BOT_TOKEN не найден в переменных окружения!")
+        return
+
+    db = Database()
+    await db.init_db()
+
+    bot = Bot(
+        token=bot_token,
+        default=DefaultBotProperties(parse_mode=ParseMode.HTML)
+    )
+    # Те же переменные, что у процесса бота: воркеры делят лимит без доли
+    # обычных рассылок
+    rate = float(os.getenv("BROADCAST_RATE", "30"))
+    interactive_rate = float(os.getenv("BROADCAST_INTERACTIVE_RATE", "5"))
+    if not 0 < interactive_rate < rate:
+        logger.error("BROADCAST_INTERACTIVE_RATE должен быть больше 0 и меньше BROADCAST_RATE!")
+        return
+    broadcaster = Broadcaster(
+        rate=rate - interactive_rate,
+        workers=int(os.getenv("BROADCAST_WORKERS", "10"))
+    )
+    worker = BroadcastWorker(db, bot, broadcaster, rate=rate - interactive_rate,
+                             lease=float(os.getenv("BROADCAST_LEASE", "60")))
+
+    # SIGTERM (docker stop) и Ctrl+C: вернуть текущий кусок в очередь и выйти
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopped.set)
+
+    # Метрики воркера (отправки, запросы к API и базе), если задан METRICS_PORT
+    metrics_runner = None
+    metrics_port = os.getenv("METRICS_PORT")
+    if metrics_port:
+        metrics.instrument_database(db)
+        metrics.instrument_bot(bot)
+        metrics.add_database_collectors(db)
+        metrics_runner = await metrics.start_metrics_server(
+            os.getenv("METRICS_HOST", "0.0.0.0"), int(metrics_port)
+        )
+
+    worker.start()
+    try:
+        await stopped.wait()
+    finally:
+        await worker.stop()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await bot.session.close()
+        await db.close()
+    logger.info("Воркер рассылок остановлен")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -4,12 +4,19 @@ import os
 from dotenv import load_dotenv
 
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 
 from bot.database.db import Database
+from bot.database.fsm_storage import SQLiteStorage
+from bot.services.activity import ActivityTracker
+from bot.services.broadcaster import Broadcaster
+from bot.services.jobs import BroadcastJobRunner, BroadcastWorker
+from bot.services.retention import RetentionWorker
 from bot.handlers import base, users, messaging, admin
+from bot.webhook import run_webhook
+from bot import metrics
+from bot.utils.permissions import role_cache
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -30,17 +37,52 @@ async def main():
         logger.error("BOT_TOKEN не найден в переменных окружения!")
         return
 
+    # Без секрета вебхук принимал бы поддельные апдейты от кого угодно
+    webhook_url = os.getenv("WEBHOOK_URL")
+    webhook_secret = os.getenv("WEBHOOK_SECRET")
+    if webhook_url and not webhook_secret:
+        logger.error("Для режима вебхука задайте WEBHOOK_SECRET!")
+        return
+
     # Инициализируем базу данных
     db = Database()
     await db.init_db()
     logger.info("База данных инициализирована")
 
+    # Загружаем админов в кэш ролей
+    await role_cache.load(db)
+
     # Создаем бота и диспетчер
     bot = Bot(
         token=bot_token,
         default=DefaultBotProperties(parse_mode=ParseMode.HTML)
     )
-    dp = Dispatcher(storage=MemoryStorage())
+    # FSM-состояния храним в SQLite, чтобы они переживали рестарт
+    dp = Dispatcher(storage=SQLiteStorage(db))
+
+    # Общий лимит отправки на бота: BROADCAST_INTERACTIVE_RATE из него —
+    # обычным рассылкам из бота, остальное делят воркеры фоновых рассылок
+    rate = float(os.getenv("BROADCAST_RATE", "30"))
+    interactive_rate = float(os.getenv("BROADCAST_INTERACTIVE_RATE", "5"))
+    if not 0 < interactive_rate < rate:
+        logger.error("BROADCAST_INTERACTIVE_RATE должен быть больше 0 и меньше BROADCAST_RATE!")
+        return
+    broadcaster = Broadcaster(
+        rate=interactive_rate,
+        workers=int(os.getenv("BROADCAST_WORKERS", "10"))
+    )
+
+    # Фоновые рассылки отправляет воркер в этом процессе; если запущены
+    # отдельные воркеры (python -m bot.worker), его можно выключить
+    worker = None
+    if os.getenv("BROADCAST_LOCAL_WORKER", "1") != "0":
+        worker = BroadcastWorker(db, bot, broadcaster, rate=rate - interactive_rate,
+                                 lease=float(os.getenv("BROADCAST_LEASE", "60")))
+    job_deadline = os.getenv("BROADCAST_JOB_DEADLINE")
+    jobs = BroadcastJobRunner(db,
+                              chunk_size=int(os.getenv("BROADCAST_CHUNK_SIZE", "200")),
+                              deadline=float(job_deadline) if job_deadline else None,
+                              worker=worker)
 
     # Регистрируем роутеры
     dp.include_router(admin.router)  # Админ первым (приоритет)
@@ -48,18 +90,69 @@ async def main():
     dp.include_router(users.router)
     dp.include_router(messaging.router)
 
+    # Профиль и последняя активность пользователя по каждому апдейту,
+    # пишутся в базу пачкой раз в ACTIVITY_FLUSH_INTERVAL секунд
+    activity = ActivityTracker(db, interval=float(os.getenv("ACTIVITY_FLUSH_INTERVAL", "5")))
+    dp.update.outer_middleware(activity)
+    activity.start()
+
+    # Старая история сообщений уходит в месячные архивы (data/archive),
+    # MESSAGE_RETENTION_DAYS=0 — хранить все в основной базе
+    retention = None
+    retention_days = int(os.getenv("MESSAGE_RETENTION_DAYS", "90"))
+    if retention_days > 0:
+        retention = RetentionWorker(db, days=retention_days,
+                                    interval=float(os.getenv("RETENTION_INTERVAL", "3600")))
+        retention.start()
+
     # Передаем db во все хэндлеры через middleware
     @dp.update.middleware()
     async def db_middleware(handler, event, data):
         data['db'] = db
+        data['broadcaster'] = broadcaster
+        data['jobs'] = jobs
         return await handler(event, data)
 
-    # Запускаем бота
+    # Метрики Prometheus на /metrics, если задан METRICS_PORT
+    metrics_runner = None
+    metrics_port = os.getenv("METRICS_PORT")
+    if metrics_port:
+        metrics.instrument_database(db)
+        metrics.instrument_bot(bot, dp)
+        metrics.add_database_collectors(db)
+        metrics_runner = await metrics.start_metrics_server(
+            os.getenv("METRICS_HOST", "0.0.0.0"), int(metrics_port)
+        )
+
+    # Продолжаем рассылки, прерванные рестартом
+    if worker is not None:
+        worker.start()
+
+    # Запускаем бота: вебхук, если задан WEBHOOK_URL, иначе long polling
     logger.info("Бот запущен")
     try:
-        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+        if webhook_url:
+            await run_webhook(
+                dp, bot, webhook_url,
+                path=os.getenv("WEBHOOK_PATH", "/webhook"),
+                secret_token=webhook_secret,
+                host=os.getenv("WEBHOOK_HOST", "0.0.0.0"),
+                port=int(os.getenv("WEBHOOK_PORT", "8080")),
+                max_concurrency=int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "100"))
+            )
+        else:
+            await bot.delete_webhook()
+            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
     finally:
+        if worker is not None:
+            await worker.stop()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        if retention is not None:
+            await retention.stop()
+        await activity.stop()
         await bot.session.close()
+        await db.close()
 
 
 if __name__ == "__main__":
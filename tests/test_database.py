@@ -0,0 +1,105 @@
+"""Database на временной базе: обход пользователей и отложенная запись.
+
+Как и в test_query_plans, без pytest-asyncio: каждый тест — один asyncio.run,
+в котором база открывается и закрывается (пул и очередь записи привязаны к
+event loop).
+"""
+import asyncio
+from contextlib import asynccontextmanager
+
+from bot.database.db import Database
+
+
+@asynccontextmanager
+async def open_db(tmp_path, **kwargs):
+    db = Database(str(tmp_path / "bot.db"), **kwargs)
+    await db.init_db()
+    try:
+        yield db
+    finally:
+        await db.close()
+
+
+async def add_users(db: Database, count: int, inactive=()):
+    async with db.pool.write() as conn:
+        await conn.executemany(
+            "INSERT INTO users (user_id, first_name, is_active) VALUES (?, ?, ?)",
+            [(i, f"User {i}", 0 if i in inactive else 1) for i in range(1, count + 1)]
+        )
+        await conn.commit()
+
+
+def test_iter_active_user_ids_streams_by_keyset(tmp_path):
+    async def scenario():
+        async with open_db(tmp_path) as db:
+            await add_users(db, 25, inactive={3, 10, 25})
+            # Пачка меньше числа пользователей: курсор переходит между пачками
+            ids = [user_id async for user_id in db.iter_active_user_ids(chunk_size=4)]
+            assert ids == [i for i in range(1, 25) if i not in (3, 10)]
+            # Ровно на границе пачки последняя пачка пустая
+            assert [u async for u in db.iter_active_user_ids(chunk_size=22)] == ids
+
+    asyncio.run(scenario())
+
+
+def fail_writes(db: Database, times: int):
+    """Следующие times вызовов db.pool.write() падают, как при "database is locked" """
+    write = db.pool.write
+    left = {"count": times}
+
+    def flaky_write():
+        if left["count"] > 0:
+            left["count"] -= 1
+            raise RuntimeError("database is locked")
+        return write()
+
+    db.pool.write = flaky_write
+
+
+async def count_messages(db: Database) -> int:
+    async with db.pool.read() as conn:
+        async with conn.execute("SELECT COUNT(*) FROM messages") as cursor:
+            return (await cursor.fetchone())[0]
+
+
+def test_failed_flush_keeps_rows_for_retry(tmp_path):
+    async def scenario():
+        async with open_db(tmp_path) as db:
+            await add_users(db, 3)
+            # Сбрасываем сами, фоновый сброс не должен успеть раньше
+            db.writes.max_delay = 60
+            for recipient in (2, 3):
+                db.queue_message(1, recipient, "Привет")
+            fail_writes(db, 2)
+            for _ in range(2):
+                try:
+                    await db.writes.flush()
+                except RuntimeError:
+                    pass
+                else:
+                    raise AssertionError("flush() должен пробросить ошибку записи")
+            db.queue_message(1, 3, "Еще раз")
+
+            await db.writes.flush()
+            assert await count_messages(db) == 3
+
+    asyncio.run(scenario())
+
+
+def test_flush_drops_rows_after_max_attempts(tmp_path):
+    async def scenario():
+        async with open_db(tmp_path) as db:
+            await add_users(db, 2)
+            db.writes.max_delay = 60
+            db.queue_message(1, 2, "Привет")
+            fail_writes(db, db.writes.max_attempts)
+            for _ in range(db.writes.max_attempts):
+                try:
+                    await db.writes.flush()
+                except RuntimeError:
+                    pass
+
+            await db.writes.flush()
+            assert await count_messages(db) == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,68 @@
+"""SQLiteStorage: чтение незаписанных изменений, сбой записи и рестарт."""
+import asyncio
+
+from aiogram.fsm.storage.base import StorageKey
+
+from bot.database.fsm_storage import SQLiteStorage
+from tests.test_database import fail_writes, open_db
+
+KEY = StorageKey(bot_id=1, chat_id=42, user_id=42)
+
+
+def test_reads_pending_changes_while_flush_waits_for_writer(tmp_path):
+    async def scenario():
+        async with open_db(tmp_path) as db:
+            storage = SQLiteStorage(db, flush_interval=60)
+            await storage.set_state(KEY, "Send:text")
+            await storage.set_data(KEY, {"selected": [1, 2]})
+
+            # Писатель занят: flush() ждет его, изменения уже в _flushing
+            async with db.pool.write():
+                flush = asyncio.create_task(storage.flush())
+                await asyncio.sleep(0.01)
+                assert not flush.done()
+                state = await asyncio.wait_for(storage.get_state(KEY), 1)
+                data = await asyncio.wait_for(storage.get_data(KEY), 1)
+            await flush
+
+            assert state == "Send:text"
+            assert data == {"selected": [1, 2]}
+            await storage.close()
+
+    asyncio.run(scenario())
+
+
+def test_failed_flush_keeps_newer_changes(tmp_path):
+    async def scenario():
+        async with open_db(tmp_path) as db:
+            storage = SQLiteStorage(db, flush_interval=60)
+            await storage.set_state(KEY, "old")
+            await storage.set_data(KEY, {"step": 1})
+            fail_writes(db, 1)
+            await storage.flush()
+            # Изменение после сбоя не должно затереться возвращенной пачкой
+            await storage.set_state(KEY, "new")
+            await storage.close()
+
+            reopened = SQLiteStorage(db, flush_interval=60)
+            assert await reopened.get_state(KEY) == "new"
+            assert await reopened.get_data(KEY) == {"step": 1}
+
+    asyncio.run(scenario())
+
+
+def test_cleared_state_is_deleted(tmp_path):
+    async def scenario():
+        async with open_db(tmp_path) as db:
+            storage = SQLiteStorage(db, flush_interval=60)
+            await storage.set_state(KEY, "Send:text")
+            await storage.flush()
+            await storage.set_state(KEY, None)
+            await storage.set_data(KEY, {})
+            await storage.close()
+
+            reopened = SQLiteStorage(db, flush_interval=60)
+            assert await reopened.get_state(KEY) is None
+            assert await reopened.get_data(KEY) == {}
+
+    asyncio.run(scenario())
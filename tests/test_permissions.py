@@ -0,0 +1,67 @@
+"""RoleCache: перезагрузка по ttl и изменения, пришедшие во время нее."""
+import asyncio
+
+from bot.utils.permissions import RoleCache
+
+
+class FakeDatabase:
+    """get_admin_ids с управляемой задержкой и уведомления, как у Database"""
+
+    def __init__(self, admins):
+        self.admins = set(admins)
+        self.loads = 0
+        self.reading = asyncio.Event()
+        self.release = asyncio.Event()
+        self.release.set()
+        self._listeners = []
+
+    def on_admins_changed(self, callback):
+        if callback not in self._listeners:
+            self._listeners.append(callback)
+
+    async def get_admin_ids(self):
+        self.loads += 1
+        snapshot = set(self.admins)
+        self.reading.set()
+        await self.release.wait()
+        return snapshot
+
+    def change(self, user_id, is_admin):
+        (self.admins.add if is_admin else self.admins.discard)(user_id)
+        for callback in self._listeners:
+            callback(user_id, is_admin)
+
+
+def test_expired_cache_is_reloaded_once_for_concurrent_checks():
+    async def scenario():
+        db = FakeDatabase({1})
+        cache = RoleCache(ttl=0.05)
+        await cache.load(db)
+        await asyncio.sleep(0.06)
+
+        db.release.clear()
+        checks = [asyncio.create_task(cache.is_admin(1, db)) for _ in range(20)]
+        await asyncio.sleep(0.01)
+        db.release.set()
+        assert await asyncio.gather(*checks) == [True] * 20
+        assert db.loads == 2
+
+    asyncio.run(scenario())
+
+
+def test_changes_during_reload_are_kept():
+    async def scenario():
+        db = FakeDatabase({1, 2})
+        cache = RoleCache(ttl=0)
+        db.release.clear()
+        load = asyncio.create_task(cache.load(db))
+        await db.reading.wait()
+        # Снимок уже прочитан: эти изменения в него не попали
+        db.change(3, True)
+        db.change(2, False)
+        db.release.set()
+        await load
+
+        assert cache._admins == {1, 3}
+
+    asyncio.run(scenario())
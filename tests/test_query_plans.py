@@ -0,0 +1,101 @@
+"""Планы SQL, который выполняют методы Database.
+
+Каждый сценарий из benchmarks.bench_db.CASES и EXTRA_CASES выполняется на
+небольшой базе, его SQL собирается trace callback'ом и проверяется через
+EXPLAIN QUERY PLAN: без полных проходов по таблицам и сортировок во
+временном B-дереве, кроме перечисленных в ALLOWED. ANALYZE бот не делает,
+поэтому и здесь планы строятся без статистики.
+"""
+import asyncio
+
+import pytest
+
+import bot.database.db as db_module
+from benchmarks.bench_db import CASES, case_state, generate, public_methods
+from benchmarks.query_plans import capture_plans, plan_problems
+from bot.database.db import Database
+from bot.database.search import MessageSearch
+
+USERS = 2000
+
+# Варианты вызовов, которых нет в замерах; имя — метод(вариант)
+EXTRA_CASES = {
+    "get_users_page(query)": lambda db, s, i: db.get_users_page(
+        limit=10, exclude_user_id=1, query="user1"),
+    "get_users_page(query, after)": lambda db, s, i: db.get_users_page(
+        limit=10, exclude_user_id=1, query="Dana", after=("2024-06-01 00:00:00", 500)),
+    "get_users_page(before)": lambda db, s, i: db.get_users_page(
+        limit=10, exclude_user_id=1, before=("2024-06-01 00:00:00", 500)),
+    "get_messages_page(before)": lambda db, s, i: db.get_messages_page(
+        limit=20, before=s["message_cursor"]),
+    "get_active_user_ids_range(segment)": lambda db, s, i: db.get_active_user_ids_range(
+        0, 200, s["segment"]),
+    "search_messages(to, after)": lambda db, s, i: db.search_messages(
+        MessageSearch.parse("сообщение to=5 after=2024-01-01")),
+}
+
+# (метод, строка плана), которые допустимы, и почему
+ALLOWED = {
+    # Сортируются только пользователи, найденные по префиксу в NOCASE-индексах
+    ("get_users_page", "UNION USING TEMP B-TREE"),
+    ("get_users_page", "USE TEMP B-TREE FOR ORDER BY"),
+    # Совпадения FTS5 упорядочены по rowid, а не по rank; сортируется не
+    # больше limit + offset сообщений на каждый найденный текст
+    ("search_messages", "USE TEMP B-TREE FOR ORDER BY"),
+    # Настройки FTS5, несколько строк
+    ("search_messages", "SCAN main.message_bodies_fts_config"),
+    # Три счетчика
+    ("get_user_stats", "SCAN stats_counters"),
+    ("rebuild_stats_counters", "SCAN stats_counters"),
+    # Только куски под действующей арендой
+    ("count_active_broadcast_workers", "USE TEMP B-TREE FOR count(DISTINCT)"),
+    # Админов единицы
+    ("get_admin_ids", "SCAN admins"),
+    ("get_all_admins", "SCAN a"),
+    ("get_all_admins", "USE TEMP B-TREE FOR ORDER BY"),
+}
+
+
+async def collect(path: str) -> dict:
+    """Планы каждого сценария: имя -> {запрос: план}"""
+    db = Database(path)
+    await db.init_db()
+    try:
+        await generate(db, USERS)
+        state = await case_state(db, USERS)
+        plans = {}
+        # Порядок CASES важен: куски сначала берутся, потом продлеваются и закрываются
+        for name, case in {**CASES, **EXTRA_CASES}.items():
+            _, plans[name] = await capture_plans(db, lambda: case(db, state, 0))
+        return plans
+    finally:
+        await db.close()
+
+
+@pytest.fixture(scope="module")
+def plans(tmp_path_factory):
+    # Кэш статистики спрятал бы сам запрос
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(db_module, "STATS_CACHE_TTL", 0)
+        return asyncio.run(collect(str(tmp_path_factory.mktemp("plans") / "plans.db")))
+
+
+def test_every_method_has_case():
+    assert sorted(set(public_methods()) - set(CASES)) == []
+
+
+@pytest.mark.parametrize("name", [*CASES, *EXTRA_CASES])
+def test_plan_uses_indexes(plans, name):
+    method = name.split("(", 1)[0]
+    problems = {}
+    for sql, plan in plans[name].items():
+        details = [d for d in plan_problems(plan) if (method, d) not in ALLOWED]
+        if details:
+            problems[sql] = plan
+    assert problems == {}
+
+
+def test_users_search_uses_nocase_indexes(plans):
+    details = [d for plan in plans["get_users_page(query)"].values() for d in plan]
+    assert any("idx_users_username_nocase" in d for d in details), details
+    assert any("idx_users_first_name_nocase" in d for d in details), details
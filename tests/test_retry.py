@@ -0,0 +1,89 @@
+"""RetryPolicy и повторы в Broadcaster.run: flood control, max_total_wait, дедлайн."""
+import asyncio
+import time
+
+from aiogram.exceptions import (TelegramForbiddenError, TelegramNetworkError,
+                                TelegramRetryAfter, TelegramServerError)
+from aiogram.methods import SendMessage
+
+from bot.services.broadcaster import Broadcaster
+from bot.services.retry import RetryPolicy
+
+METHOD = SendMessage(chat_id=1, text="Привет")
+
+
+def flood(seconds: int) -> TelegramRetryAfter:
+    return TelegramRetryAfter(METHOD, "Too Many Requests", retry_after=seconds)
+
+
+def test_classifies_errors():
+    policy = RetryPolicy()
+    assert policy.retry_after(flood(7)) == 7.0
+    assert policy.retry_after(TelegramNetworkError(METHOD, "timeout")) is None
+    assert policy.is_transient(TelegramNetworkError(METHOD, "timeout"))
+    assert policy.is_transient(TelegramServerError(METHOD, "Bad Gateway"))
+    assert not policy.is_transient(TelegramForbiddenError(METHOD, "blocked"))
+    assert not policy.is_transient(flood(1))
+
+
+def test_backoff_is_capped():
+    policy = RetryPolicy(base_delay=1.0, max_delay=5.0)
+    for attempt in range(10):
+        assert 0 <= policy.backoff(attempt) <= min(5.0, 2 ** attempt)
+
+
+def broadcast(errors: dict, policy: RetryPolicy, deadline_in: float = None, workers: int = 10):
+    """Разослать получателям из errors; errors[chat_id] — ошибки по очереди перед успехом"""
+    calls = {chat_id: 0 for chat_id in errors}
+
+    async def send(chat_id: int):
+        calls[chat_id] += 1
+        if errors[chat_id]:
+            raise errors[chat_id].pop(0)
+
+    async def scenario():
+        broadcaster = Broadcaster(rate=1000, workers=workers, per_chat_interval=0,
+                                  retry=policy)
+        deadline = time.monotonic() + deadline_in if deadline_in is not None else None
+        started = time.monotonic()
+        result = await broadcaster.run(list(errors), send, deadline=deadline)
+        return result, calls, time.monotonic() - started
+
+    return asyncio.run(scenario())
+
+
+def test_transient_errors_are_retried_up_to_max_attempts():
+    policy = RetryPolicy(max_attempts=3, base_delay=0.001, max_delay=0.001)
+    network = lambda: TelegramNetworkError(METHOD, "timeout")  # noqa: E731
+    result, calls, _ = broadcast({1: [network(), network()],
+                                  2: [network(), network(), network()],
+                                  3: [TelegramForbiddenError(METHOD, "blocked")]}, policy)
+    assert result.successful == [1]
+    assert sorted(result.failed) == [2, 3]
+    assert calls == {1: 3, 2: 3, 3: 1}
+
+
+def test_retry_after_is_waited_and_does_not_use_attempts():
+    policy = RetryPolicy(max_attempts=1)
+    result, calls, elapsed = broadcast({1: [flood(0), flood(0), flood(0)]}, policy)
+    assert result.successful == [1]
+    assert calls == {1: 4}
+
+
+def test_retry_after_beyond_max_total_wait_fails_without_waiting():
+    policy = RetryPolicy(max_total_wait=5)
+    result, calls, elapsed = broadcast({1: [flood(10)]}, policy)
+    assert result.failed == [1]
+    assert calls == {1: 1}
+    assert elapsed < 1
+
+
+def test_retry_after_beyond_deadline_fails_without_waiting():
+    policy = RetryPolicy(max_total_wait=300)
+    # Один поток отправки: 2 ждет паузу flood control, которую вызвал 1,
+    # и после дедлайна ему уже не отправляем
+    result, calls, elapsed = broadcast({1: [flood(10)], 2: []}, policy,
+                                       deadline_in=0.5, workers=1)
+    assert result.failed == [1, 2]
+    assert calls == {1: 1, 2: 0}
+    assert elapsed < 1
@@ -0,0 +1,36 @@
+"""MessageTemplate: подстановки, экранирование HTML и оценка длины подписи."""
+from bot.services.templates import MessageTemplate
+
+
+def test_values_are_html_escaped_but_text_is_not():
+    template = MessageTemplate("<b>Привет, {first_name}!</b> {x} {full_name}",
+                               prefix="{first_name}: ")
+    user = {'first_name': "<Tom & Jerry>", 'last_name': '"Q"'}
+    assert template.render(user) == (
+        "{first_name}: <b>Привет, &lt;Tom &amp; Jerry&gt;!</b> {x} "
+        "&lt;Tom &amp; Jerry&gt; \"Q\""
+    )
+
+
+def test_missing_fields_and_username_fallback():
+    template = MessageTemplate("{username}|{last_name}|{user_id}")
+    assert template.render({'user_id': 5, 'username': "dana"}) == "@dana||5"
+    assert template.render({'user_id': 5, 'first_name': "Dana"}) == "Dana||5"
+    assert template.render(None) == "||"
+
+
+def test_plain_text_is_not_personal():
+    template = MessageTemplate("Скидка {50%}", suffix="\n\n— Админ")
+    assert not template.is_personal
+    assert template.render_many([1, 2], {}) == {1: "Скидка {50%}\n\n— Админ",
+                                                2: "Скидка {50%}\n\n— Админ"}
+
+
+def test_max_length_bounds_longest_allowed_values():
+    template = MessageTemplate("Привет, {full_name} ({username}), твой ID {user_id}")
+    # Самые длинные значения, которые допускает Telegram; без username
+    # подставляется имя
+    user = {'first_name': "a" * 64, 'last_name': "b" * 64, 'user_id': 10 ** 19}
+    rendered = template.render(user)
+    assert len(rendered) == template.max_length()
+    assert len(template.render({'first_name': "Dana", 'user_id': 1})) < template.max_length()